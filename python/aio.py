@@ -0,0 +1,224 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+
+from constants import *
+from functions import *
+from fire import Fire
+from explorer import Explorer
+from ice import Ice
+from components import scan_bus
+from regseq import MASK_ALL
+from polling import *
+
+##################################################################################
+#   Asyncio driver layer.                                                        #
+#   AsyncFire, AsyncExplorer and AsyncIce wrap the blocking drivers: each I2C   #
+#   call runs in the executor of its bus, a single thread, so the calls of a    #
+#   bus keep their order while several buses are driven at the same time.      #
+#   Waits and polls (training, firmware ready, doorbell) are coroutines that    #
+#   sleep in the event loop, not in the bus thread. Methods without a coroutine #
+#   version are forwarded as is: await fire.i2cread(reg) runs Fire.i2cread in   #
+#   the bus executor.                                                            #
+#                                                                                #
+#   Sequences which need the mux path of a port to stay selected (eg training   #
+#   port a while another task reads port b of the same bus) must be run under  #
+#   bus_lock(bus):                                                               #
+#                                                                                #
+#       async def bring_up(busnum):                                              #
+#           fire = await AsyncFire.create(busnum)                                #
+#           async with bus_lock(busnum):                                         #
+#               ...                                                              #
+#       asyncio.run(asyncio.gather(*(bring_up(b) for b in (3, 4, 5))))          #
+##################################################################################
+
+bus_executors = {}
+bus_locks = {}
+
+def bus_executor(i2c_bus_num):
+    """ The thread running the blocking I2C calls of a bus """
+    executor = bus_executors.get(i2c_bus_num)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="i2c-{}".format(i2c_bus_num))
+        bus_executors[i2c_bus_num] = executor
+    return executor
+
+def bus_lock(i2c_bus_num):
+    """ asyncio.Lock of a bus, to keep the mux path of a port during a sequence """
+    lock = bus_locks.get(i2c_bus_num)
+    if lock is None:
+        lock = bus_locks[i2c_bus_num] = asyncio.Lock()
+    return lock
+
+def shutdown_executors():
+    for executor in bus_executors.values(): executor.shutdown(wait=True)
+    bus_executors.clear()
+
+def run_on_bus(i2c_bus_num, fn, *args, **kwargs):
+    """ Run a blocking call in the executor of a bus, returns an awaitable """
+    return asyncio.get_running_loop().run_in_executor(bus_executor(i2c_bus_num), partial(fn, *args, **kwargs))
+
+async def async_wait_until(read, mask, value, deadline=None, policy=POLL_DEFAULT):
+    """ polling.wait_until for a coroutine read(), sleeping in the event loop """
+    start = monotonic()
+    end = None if deadline is None else start + deadline
+    reads = 1
+    val = await read()
+    intervals = policy.intervals()
+    while (val & mask) != value:
+        now = monotonic()
+        if end is not None and now >= end:
+            record_wait(policy.name, now - start, reads, timeout=True)
+            return False, val
+        interval = next(intervals)
+        if end is not None: interval = min(interval, end - now)
+        await asyncio.sleep(interval)
+        val = await read()
+        reads += 1
+    record_wait(policy.name, monotonic() - start, reads)
+    return True, val
+
+
+class AsyncDriver:
+    def __init__(self, driver, i2c_bus_num):
+        self.driver = driver
+        self.i2c_bus_num = i2c_bus_num
+
+    def run(self, fn, *args, **kwargs):
+        return run_on_bus(self.i2c_bus_num, fn, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if not callable(attr): return attr
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return call
+
+
+HOST_CONF_STATUS_REGS = {'a': FIRE_DDIMMA_HOST_CONF_STATUS_REG, 'b': FIRE_DDIMMB_HOST_CONF_STATUS_REG}
+
+class AsyncFire(AsyncDriver):
+    @classmethod
+    async def create(cls, i2c_bus_num, freq=333, **kwargs):
+        """ Build the Fire (which reads its ID) in the bus executor """
+        fire = await run_on_bus(i2c_bus_num, Fire, i2c_bus_num, freq, **kwargs)
+        return cls(fire, i2c_bus_num)
+
+    """
+        Poll the host conf status of a port until its OMI link is up.
+        Same criteria, deadline and policy as Fire.check_sync.
+        """
+    async def wait_link_up(self, ddimm, deadline=POLL_FIRE_LINK_TIMEOUT):
+        up, status = await self.poll_host_status(ddimm, deadline)
+        return up
+
+    async def poll_host_status(self, ddimm, deadline=POLL_FIRE_LINK_TIMEOUT):
+        """ (link up, last host conf status read) of a port """
+        reg = HOST_CONF_STATUS_REGS.get(ddimm.lower())
+        if reg is None: return False, 0
+        return await async_wait_until(partial(self.i2cread, reg), 0xF, 0xF, deadline, POLL_FIRE_LINK)
+
+    async def check_sync(self, ddimm, verbose=0):
+        card = await self.run(scan_bus, self.i2c_bus_num)
+        for port in ddimm:
+            # as Fire.check_sync: the status of the first port, printed from the value polled
+            up, synch_reg = await self.poll_host_status(port)
+            return self.driver.report_sync(port, card, HOST_CONF_STATUS_REGS.get(port.lower(), 0), synch_reg, verbose)
+
+    async def retrain(self, ddimm, verbose=0):
+        for port in ddimm:
+            if port.lower() == 'a': reg = FIRE_DDIMMA_OPENCAPI_DL_CONTROL
+            elif port.lower() == 'b': reg = FIRE_DDIMMB_OPENCAPI_DL_CONTROL
+            else: continue
+            val = await self.cached_read(reg)
+            await self.i2cwrite(reg, (val | (1 << 24)))
+            await self.invalidate()
+            await self.check_sync(port, 1)
+
+    """
+        Wait for the Explorer firmware response to a command (outbound doorbell = 1),
+        then check the command status. Returns 0 when the command succeeded, 1 otherwise,
+        as omi.check_status.
+        """
+    async def check_status(self, ddimm, deadline=POLL_EXP_DOORBELL_TIMEOUT):
+        if ddimm not in FIRE_DDIMM_ADDR_ADJ:
+            print("ERROR !!: incorrect ddimm selection !!")
+            return 1
+        adj = FIRE_DDIMM_ADDR_ADJ[ddimm]
+        ready, val = await async_wait_until(partial(self.i2cread, FIRE_EXP_OUTBOUND_DOORBELL + adj), MASK_ALL, 0x1,
+                                            deadline, POLL_EXP_DOORBELL)
+        if not ready:
+            logging.info("Explorer firmware response not received on port {}".format(ddimm.upper()))
+            return 1
+        if await self.i2cread(0x300100010103FF20 + adj) != 1:
+            logging.info("Failure 0x30010x010103FF20 is not 0x1 !!")
+            return 1
+        return 0
+
+
+class AsyncExplorer(AsyncDriver):
+    @classmethod
+    async def create(cls, fire_freq, i2c_bus_num, **kwargs):
+        explorer = await run_on_bus(i2c_bus_num, Explorer, fire_freq, i2c_bus_num, **kwargs)
+        return cls(explorer, i2c_bus_num)
+
+    async def wait_ready(self):
+        """ Wait for the firmware to answer on reg 02 (boot done), returns the firmware API version """
+        ready, val = await async_wait_until(partial(self.i2c_simple_read, 0x2), 0xff000000, 0, policy=POLL_EXP_BOOT)
+        return (val & ~0xff00ffff) >> 16
+
+    async def wait_not_busy(self):
+        """ Wait for the status flag of reg 02 to leave busy """
+        done, val = await async_wait_until(partial(self.i2c_simple_read, 0x2), 0xff00, 0, policy=POLL_EXP_BUSY)
+        return val
+
+    """
+        Explorer.init with its waits in the event loop.
+        """
+    async def init(self):
+        if self.fire_freq == 333: b = 0x1
+        elif self.fire_freq == 400: b = 0x3
+        else:
+            print("Frequency unsupported. Expecting 333MHz or 400MHz.")
+            return
+
+        logging.info("---------- Step 11: exp_check_for_ready_wrap      ------------")
+        version = await self.wait_ready()
+        print("Explorer Firmware API version: {:#004x} Ready".format(version))
+        logging.info("---------- Step 12 exp_omi_setup_wrap            ------------")
+        await self.i2c_simple_write(0x010400008090 + b)
+        logging.info("DBG:Explorer Writing {} 4 bytes in reg 01 of Explorer".format(hex(0x010400008090 + b)))
+        logging.info("Waiting status flag to change from busy...")
+        await self.wait_not_busy()
+        await self.i2c_simple_read(0x2)
+        return b
+
+
+class AsyncIce(AsyncDriver):
+    @classmethod
+    async def create(cls, fire_freq, i2c_bus_num, **kwargs):
+        ice = await run_on_bus(i2c_bus_num, Ice, fire_freq, i2c_bus_num, **kwargs)
+        return cls(ice, i2c_bus_num)
@@ -0,0 +1,218 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import os
+import sys
+import io
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import contextlib
+import traceback
+
+# the learned polling intervals and the compiled DDIMM plans of the user are not used:
+# every run starts from the same (empty) state
+BENCH_DIR = tempfile.mkdtemp(prefix="omi_bench_")
+atexit.register(shutil.rmtree, BENCH_DIR, True)
+os.environ["OMI_POLL_STATS"] = os.path.join(BENCH_DIR, "poll_stats.json")
+os.environ["OMI_PLAN_CACHE"] = BENCH_DIR
+
+import click
+
+from constants import *
+from functions import *
+from ddimm_plan import DDIMM_CFG_VENDORS, DDIMM_CFG_SIZES
+from bustrace import tracer
+import metrics
+import polling
+import simulator
+import timeline
+import omi
+import firmware_update
+
+##################################################################################
+#   Bus traffic benchmark of the omi.py commands.                                #
+#   Each case runs a command on a fresh simulated board (after the commands     #
+#   needed to get there, which are not measured) and records:                  #
+#       transfers, messages, bytes written/read : as counted by metrics         #
+#       bus_time : time the transfers take on the simulated bus (100 kHz)       #
+#       sleep    : time the command asked to sleep (skipped, not waited)       #
+#       cpu      : host CPU time of the command                                 #
+#   The figures are compared with a baseline file: the run fails when the      #
+#   traffic of a command grows beyond the tolerance.                           #
+#                                                                                #
+#       python3 benchmark.py                  compare with the baseline        #
+#       python3 benchmark.py --save           record the baseline              #
+##################################################################################
+
+BENCH_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+BENCH_TOLERANCE = 5.0       # % of growth allowed on the traffic
+BENCH_FW_SIZE = 1000        # bytes of the firmware image: 3 bursts and a padded one
+BENCH_TRAFFIC = ("transfers", "messages", "written", "read", "bus_time")   # compared with the baseline
+
+BRINGUP = [["initpath", "-d", "a"], ["init"], ["sync", "-d", "a"]]
+
+
+class BenchCase:
+    def __init__(self, name, command, setup=(), cards=None):
+        self.name = name
+        self.command = command      # omi.py arguments, or a function
+        self.setup = setup          # omi.py commands run before, not measured
+        self.cards = cards          # simulated cards, a DDIMM on port A by default
+
+
+def firmware_image():
+    path = os.path.join(BENCH_DIR, "firmware.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(bytes((i * 7) & 0xff for i in range(BENCH_FW_SIZE)))
+    return path
+
+def run_firmware_update():
+    firmware_update.update(firmware_image(), log=False)
+
+
+def bench_cases():
+    cases = [BenchCase("init", ["init"], BRINGUP[:1]),
+             BenchCase("sync", ["sync", "-d", "a"], BRINGUP[:2])]
+    for vendor in DDIMM_CFG_VENDORS:
+        for size in DDIMM_CFG_SIZES:
+            cases.append(BenchCase("ddimmcfg {} {}GB".format(vendor, size), ["ddimmcfg", "-d", "a"], BRINGUP,
+                                   {'a': simulator.SimDdimm(vendor, size)}))
+    cases += [BenchCase("fbistcfg", ["fbistcfg", "-d", "a", "-e", "1", "-a", "2", "-s", "0", "--read"],
+                        BRINGUP + [["ddimmcfg", "-d", "a"]]),
+              BenchCase("info exp", ["info", "-c", "exp"], BRINGUP[:2]),
+              BenchCase("firmware_update", run_firmware_update, BRINGUP)]
+    return cases
+
+
+def run(command):
+    """ Returns None when the command ran, the error otherwise """
+    try:
+        if callable(command): command()
+        else: omi.main.main(args=list(command), prog_name="omi.py", standalone_mode=False)
+    except SystemExit as err:
+        if err.code not in (None, 0): return "exit({})".format(err.code)
+    except Exception:
+        return traceback.format_exc().strip().splitlines()[-1]
+    return None
+
+def run_case(case, verbose=False):
+    """ Figures of a case (a dict) """
+    simulator.install(case.cards)
+    out = sys.stdout if verbose else io.StringIO()
+    with contextlib.redirect_stdout(out):
+        for command in case.setup:
+            error = run(command)
+            if error: return {"error": "setup {}: {}".format(" ".join(command), error)}
+        metrics.reset()
+        polling.wait_stats.clear()
+        tracer.clear()
+        transfers0, bus_time0, skipped0 = sum(b.transfers for b in simulator.boards.values()), simulator.bus_time(), timeline.skipped
+        cpu0 = time.process_time()
+        error = run(case.command)
+        cpu = time.process_time() - cpu0
+    devices = metrics.snapshot()["devices"].values()
+    res = {"transfers": sum(d["transfers"] for d in devices), "messages": sum(d["messages"] for d in devices),
+           "written": sum(d["written"] for d in devices), "read": sum(d["read"] for d in devices),
+           "bus_time": round(sum(t - bus_time0.get(bus, 0.0) for bus, t in simulator.bus_time().items()), 6),
+           "sleep": round(timeline.skipped - skipped0, 3), "cpu": round(cpu, 4)}
+    if res["transfers"] != sum(b.transfers for b in simulator.boards.values()) - transfers0:
+        res["error"] = "transfers not seen by the metrics"
+    if error: res["error"] = error
+    return res
+
+
+def compare(name, res, base, tolerance):
+    """ Regressions of a case against its baseline (list of texts) """
+    if base is None: return []
+    regressions = []
+    for key in BENCH_TRAFFIC:
+        if key in base and res[key] > base[key] * (1 + tolerance / 100) + 1e-9:
+            regressions.append("{}: {} {} -> {} (+{:.1f}%)".format(name, key, base[key], res[key],
+                               100 * (res[key] - base[key]) / base[key] if base[key] else float("inf")))
+    return regressions
+
+def print_table(results, baseline):
+    print("{:<22}{:>10}{:>10}{:>10}{:>10}{:>11}{:>9}{:>9}".format("command", "transfers", "messages", "written",
+                                                                  "read", "bus time", "sleep", "cpu"))
+    for name, res in results.items():
+        if "error" in res and "transfers" not in res:
+            print("{:<22}ERROR {}".format(name, res["error"])); continue
+        line = "{:<22}{:>10}{:>10}{:>10}{:>10}{:>10.3f}s{:>8.2f}s{:>8.3f}s".format(name, res["transfers"],
+                res["messages"], res["written"], res["read"], res["bus_time"], res["sleep"], res["cpu"])
+        base = baseline.get(name)
+        if base is not None and base.get("transfers"):
+            line += "  ({:+d} transfers)".format(res["transfers"] - base["transfers"])
+        print(line)
+        if "error" in res: print("{:<22}ERROR {}".format("", res["error"]))
+
+
+@click.command()
+@click.option('--baseline', '_baseline', type=click.Path(dir_okay=False), default=BENCH_BASELINE, help='Baseline file (default=benchmark_baseline.json next to this script)')
+@click.option('--save', '_save', is_flag=True, default=False, help='Record the results as the new baseline')
+@click.option('-t', '--tolerance', '_tolerance', type=float, default=BENCH_TOLERANCE, help='Growth of the traffic allowed, in % (default=5)')
+@click.option('-k', '--case', '_filter', type=str, default=None, help='Only run the cases whose name contains this text')
+@click.option('-v', '--verbose', '_verbose', is_flag=True, default=False, help='Show the output of the commands')
+def main(_baseline, _save, _tolerance, _filter, _verbose):
+    " Measures the bus traffic of the omi.py commands on the simulator and compares it with a baseline. "
+    baseline = {}
+    try:
+        with open(_baseline) as f: baseline = json.load(f)
+    except (OSError, ValueError):
+        if not _save: print("No baseline in {}: run with --save to record one".format(_baseline))
+
+    timeline.fast_forward()
+    metrics.enable()
+    results = {}
+    for case in bench_cases():
+        if _filter is not None and _filter not in case.name: continue
+        results[case.name] = run_case(case, _verbose)
+    metrics.disable()
+    print_table(results, baseline)
+
+    errors = [name for name, res in results.items() if "error" in res]
+    if _save:
+        if errors:
+            print("ERROR !! Baseline not saved: {} failed".format(", ".join(errors)))
+            exit(1)
+        baseline.update(results)
+        with open(_baseline, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("Baseline saved in", _baseline)
+        return
+
+    regressions = []
+    for name, res in results.items():
+        if "error" not in res: regressions += compare(name, res, baseline.get(name), _tolerance)
+    for line in regressions: print("REGRESSION", line)
+    if errors or regressions:
+        print("ERROR !! {} failed, {} regressions".format(len(errors), len(regressions)))
+        exit(1)
+    print("OK: no traffic growth beyond {}%".format(_tolerance))
+
+
+if __name__ == "__main__":
+    main()
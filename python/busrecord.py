@@ -0,0 +1,323 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import os
+import sys
+import atexit
+import mmap
+import errno
+import bisect
+import struct
+import ctypes
+import hashlib
+import logging
+import threading
+from time import perf_counter
+
+from constants import *
+from functions import bus_pool
+from components import use_bus_factory
+import timeline
+
+##################################################################################
+#   Record and replay of the I2C transactions of a session.                      #
+#   record() wraps the buses: every transaction (the request, what was read    #
+#   back, or the errno of a NAK) is kept and saved in a binary file at exit.   #
+#   replay() opens ReplayBus instead of SMBus: each request is answered with   #
+#   the response recorded for the same request, so the drivers run offline,    #
+#   at full CPU speed (the sleeps are skipped), on the answers of a real DDIMM. #
+#                                                                                #
+#   The replay follows the recording: a request answered several times (eg the #
+#   status register of a poll) gets its answers in the recorded order, a poll  #
+#   lasting longer than recorded gets the same answer again (see answer()).    #
+#   A request never recorded NAKs (OSError EREMOTEIO) and is counted as a miss. #
+#                                                                                #
+#   File (little endian), read through mmap without decoding it all:           #
+#       header  : 'OMIR', version (u16), record size (u16), number of records   #
+#                 (u32), offset of the index (u64), offset of the data (u64)    #
+#       records : timestamp (f64), bus (u16), kind (u8), errno (u8),            #
+#                 data offset (u32), request length (u32), response length (u32)#
+#       index   : (key (u64), record number (u32)) sorted, the key being a hash #
+#                 of (bus, kind, request): the records of an operation          #
+#       data    : request then response bytes of each record                    #
+##################################################################################
+
+# kinds of transaction, request encoding
+REC_RDWR        = 0     # i2c_rdwr: per message address (u8), flags (u16), length (u16), data if written
+REC_READ_BYTE   = 1     # address
+REC_WRITE_QUICK = 2     # address
+REC_READ_BLOCK  = 3     # address, register, length
+REC_WRITE_BLOCK = 4     # address, register, data
+REC_NAMES = {REC_RDWR: "rdwr", REC_READ_BYTE: "rbyte", REC_WRITE_QUICK: "quick", REC_READ_BLOCK: "rblock",
+             REC_WRITE_BLOCK: "wblock"}
+
+RECORD_FILE_MAGIC = b"OMIR"
+RECORD_FILE_VERSION = 1
+I2C_M_RD = 0x0001
+
+HEADER = struct.Struct("<4sHHIQQ")
+RECORD = struct.Struct("<dHBBIII")
+INDEX = struct.Struct("<QI")
+MSG = struct.Struct("<BHH")
+
+
+def request_key(i2c_bus_num, kind, request):
+    return int.from_bytes(hashlib.blake2b(struct.pack("<HB", i2c_bus_num, kind) + request, digest_size=8).digest(), "little")
+
+def encode_msgs(msgs):
+    request = bytearray()
+    for msg in msgs:
+        request += MSG.pack(msg.addr, msg.flags, msg.len)
+        if not msg.flags & I2C_M_RD: request += ctypes.string_at(msg.buf, msg.len)
+    return bytes(request)
+
+def decode_msgs(request):
+    """ [(address, flags, length, data written or None), ...] of a REC_RDWR request """
+    msgs, pos = [], 0
+    while pos < len(request):
+        addr, flags, length = MSG.unpack_from(request, pos); pos += MSG.size
+        if flags & I2C_M_RD: msgs.append((addr, flags, length, None))
+        else:
+            msgs.append((addr, flags, length, request[pos:pos + length])); pos += length
+    return msgs
+
+
+class BusRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = bytearray()
+        self.keys = []
+        self.data = bytearray()
+        self.t0 = perf_counter()
+
+    def add(self, i2c_bus_num, kind, request, response=b"", err=0):
+        with self.lock:
+            self.records += RECORD.pack(perf_counter() - self.t0, i2c_bus_num, kind, err, len(self.data), len(request), len(response))
+            self.keys.append(request_key(i2c_bus_num, kind, request))
+            self.data += request
+            self.data += response
+
+    def save(self, path):
+        with self.lock:
+            index = sorted((key, i) for i, key in enumerate(self.keys))
+            index_offset = HEADER.size + len(self.records)
+            data_offset = index_offset + INDEX.size * len(index)
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(RECORD_FILE_MAGIC, RECORD_FILE_VERSION, RECORD.size, len(self.keys), index_offset, data_offset))
+                f.write(self.records)
+                f.write(b"".join(INDEX.pack(key, i) for key, i in index))
+                f.write(self.data)
+        logging.info("{} I2C transactions recorded in {}".format(len(self.keys), path))
+
+
+class RecordingBus:
+    """ Bus wrapper recording the transactions in recorder """
+    def __init__(self, bus, i2c_bus_num):
+        self.bus = bus
+        self.i2c_bus_num = i2c_bus_num
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def call(self, kind, request, fn, *args):
+        try:
+            res = fn(*args)
+        except OSError as err:
+            recorder.add(self.i2c_bus_num, kind, request, err=err.errno or 0)
+            raise
+        return res
+
+    def i2c_rdwr(self, *msgs):
+        request = encode_msgs(msgs)
+        self.call(REC_RDWR, request, self.bus.i2c_rdwr, *msgs)
+        response = b"".join(ctypes.string_at(msg.buf, msg.len) for msg in msgs if msg.flags & I2C_M_RD)
+        recorder.add(self.i2c_bus_num, REC_RDWR, request, response)
+
+    def read_byte(self, i2c_addr, *args):
+        request = bytes([i2c_addr])
+        res = self.call(REC_READ_BYTE, request, self.bus.read_byte, i2c_addr, *args)
+        recorder.add(self.i2c_bus_num, REC_READ_BYTE, request, bytes([res]))
+        return res
+
+    def write_quick(self, i2c_addr, *args):
+        request = bytes([i2c_addr])
+        res = self.call(REC_WRITE_QUICK, request, self.bus.write_quick, i2c_addr, *args)
+        recorder.add(self.i2c_bus_num, REC_WRITE_QUICK, request)
+        return res
+
+    def read_i2c_block_data(self, i2c_addr, register, length, *args):
+        request = bytes([i2c_addr, register, length])
+        res = self.call(REC_READ_BLOCK, request, self.bus.read_i2c_block_data, i2c_addr, register, length, *args)
+        recorder.add(self.i2c_bus_num, REC_READ_BLOCK, request, bytes(res))
+        return res
+
+    def write_i2c_block_data(self, i2c_addr, register, data, *args):
+        request = bytes([i2c_addr, register] + list(data))
+        res = self.call(REC_WRITE_BLOCK, request, self.bus.write_i2c_block_data, i2c_addr, register, data, *args)
+        recorder.add(self.i2c_bus_num, REC_WRITE_BLOCK, request)
+        return res
+
+
+class BusRecording:
+    """ A recording file, mapped in memory """
+    def __init__(self, data):
+        self.map = data
+        magic, version, rec_size, self.count, self.index_offset, self.data_offset = HEADER.unpack_from(data, 0)
+        self.occurrences = {}   # (bus, kind, request) -> its record numbers
+        self.position = -1      # record of the last answer served in sequence
+        self.last = None        # last request served, and the record which answered it
+        self.last_record = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        if len(data) < HEADER.size or data[0:4] != RECORD_FILE_MAGIC:
+            print("ERROR !! {} is not an I2C recording".format(path)); return None
+        magic, version, rec_size, count, index_offset, data_offset = HEADER.unpack_from(data, 0)
+        if version != RECORD_FILE_VERSION or rec_size != RECORD.size:
+            print("ERROR !! Unsupported I2C recording version"); return None
+        return cls(data)
+
+    def record(self, i):
+        """ (timestamp, bus, kind, errno, request, response) of record i """
+        ts, i2c_bus_num, kind, err, offset, req_len, resp_len = RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size)
+        start = self.data_offset + offset
+        return ts, i2c_bus_num, kind, err, self.map[start:start + req_len], self.map[start + req_len:start + req_len + resp_len]
+
+    def find(self, i2c_bus_num, kind, request):
+        """ Record numbers of this request, in recorded order (binary search of the index) """
+        key = request_key(i2c_bus_num, kind, request)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INDEX.unpack_from(self.map, self.index_offset + mid * INDEX.size)[0] < key: lo = mid + 1
+            else: hi = mid
+        found = []
+        while lo < self.count:
+            k, i = INDEX.unpack_from(self.map, self.index_offset + lo * INDEX.size)
+            if k != key: break
+            rec = self.record(i)
+            if rec[1] == i2c_bus_num and rec[2] == kind and rec[4] == request: found.append(i)
+            lo += 1
+        return found
+
+    """
+        Recorded (errno, response) of a request, None if it was never recorded.
+        The requests follow the recording: a request gets the answer of its next occurrence after the
+        last one served. A request repeated more times than recorded (a poll lasting longer) gets the
+        same answer again, and after its last occurrence a request keeps its last answer.
+    """
+    def answer(self, i2c_bus_num, kind, request):
+        req = (i2c_bus_num, kind, request)
+        with self.lock:
+            found = self.occurrences.get(req)
+            if found is None: found = self.occurrences[req] = self.find(i2c_bus_num, kind, request)
+            if not found: return None
+            nxt = bisect.bisect_right(found, self.position)
+            if req == self.last and (nxt == len(found) or found[nxt] != self.position + 1): i = self.last_record
+            elif nxt < len(found): i = self.position = found[nxt]
+            else: i = found[-1]
+            self.last, self.last_record = req, i
+            ts, bus, kind, err, req, response = self.record(i)
+            return err, response
+
+    def format(self, i):
+        ts, i2c_bus_num, kind, err, request, response = self.record(i)
+        line = "{:12.6f} bus {} {:<6}".format(ts, i2c_bus_num, REC_NAMES.get(kind, str(kind)))
+        if kind == REC_RDWR:
+            pos = 0
+            for addr, flags, length, data in decode_msgs(request):
+                if data is not None: line += " {:#04x} W {}".format(addr, data.hex().upper())
+                else:
+                    line += " {:#04x} R {}".format(addr, response[pos:pos + length].hex().upper() if not err else "")
+                    pos += length
+        elif kind == REC_WRITE_BLOCK: line += " {:#04x} {:#04x} W {}".format(request[0], request[1], request[2:].hex().upper())
+        elif kind == REC_READ_BLOCK: line += " {:#04x} {:#04x} R {}".format(request[0], request[1], response.hex().upper())
+        else: line += " {:#04x} {}".format(request[0], response.hex().upper()).rstrip()
+        if err: line += " {}".format(errno.errorcode.get(err, err))
+        return line
+
+    def dump(self, out=None):
+        out = out if out is not None else sys.stdout
+        for i in range(self.count): out.write(self.format(i) + "\n")
+
+
+class ReplayBus:
+    """ smbus2.SMBus stand-in answering from a recording """
+    def __init__(self, i2c_bus_num, recording):
+        self.i2c_bus_num = i2c_bus_num
+        self.recording = recording
+
+    def serve(self, kind, request):
+        global served, misses
+        answer = self.recording.answer(self.i2c_bus_num, kind, request)
+        if answer is None:
+            misses += 1
+            logging.info("Replay: {} {} on bus {} was not recorded".format(REC_NAMES[kind], request.hex(), self.i2c_bus_num))
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        served += 1
+        err, response = answer
+        if err: raise OSError(err, os.strerror(err))
+        return response
+
+    def i2c_rdwr(self, *msgs):
+        response, pos = self.serve(REC_RDWR, encode_msgs(msgs)), 0
+        for msg in msgs:
+            if msg.flags & I2C_M_RD:
+                ctypes.memmove(msg.buf, response[pos:pos + msg.len], msg.len)
+                pos += msg.len
+
+    def read_byte(self, i2c_addr, force=None):
+        return self.serve(REC_READ_BYTE, bytes([i2c_addr]))[0]
+
+    def write_quick(self, i2c_addr, force=None):
+        self.serve(REC_WRITE_QUICK, bytes([i2c_addr]))
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        return list(self.serve(REC_READ_BLOCK, bytes([i2c_addr, register, length])))
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self.serve(REC_WRITE_BLOCK, bytes([i2c_addr, register] + list(data)))
+
+    def close(self):
+        pass
+
+
+recorder = BusRecorder()
+served = 0      # replayed requests answered
+misses = 0      # and not recorded
+
+def record(path):
+    """ Record the transactions of the buses opened from now on (and the open ones), saved in path at exit """
+    bus_pool.add_wrapper(RecordingBus)
+    atexit.register(recorder.save, path)
+
+def replay(path):
+    """ Answer from a recording instead of the I2C adapter from now on, without sleeping """
+    recording = BusRecording.load(path)
+    if recording is None: exit(1)
+    use_bus_factory(lambda i2c_bus_num: ReplayBus(i2c_bus_num, recording))
+    timeline.fast_forward()
+    atexit.register(lambda: logging.info("Replay: {} requests answered, {} not recorded".format(served, misses)))
+    return recording
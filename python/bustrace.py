@@ -0,0 +1,223 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import os
+import sys
+import struct
+import logging
+from time import perf_counter
+
+from constants import *
+
+##################################################################################
+#   Always-on trace of the register accesses.                                   #
+#   The drivers record (timestamp, device, op, address, data, status) into a    #
+#   fixed size ring of binary records, the oldest ones being overwritten. No    #
+#   text is built when recording: records are decoded only when the ring is   #
+#   dumped, or its tail when an error is reported with tracer.error().         #
+#   With echo on (omi.py --log), each record is also sent to logging as it is  #
+#   recorded, as the per-access logging.info lines of the drivers used to be.  #
+#                                                                                #
+#   Explorer frames (command, length, payload) are up to 10 bytes: a TR_FRAME  #
+#   record keeps the register address of the payload in its address field,     #
+#   the command and length bytes and the data in its data field.               #
+##################################################################################
+
+# devices
+DEV_FIRE     = 1
+DEV_EXPLORER = 2
+DEV_ICE      = 3
+DEV_MUX      = 4
+DEV_PMIC     = 5
+DEV_EEPROM   = 6
+DEV_NAMES = {DEV_FIRE: "FIRE", DEV_EXPLORER: "Explorer", DEV_ICE: "ICE", DEV_MUX: "MUX", DEV_PMIC: "PMIC", DEV_EEPROM: "EEPROM"}
+
+# operations
+TR_READ   = 0   # register read: address, data read
+TR_WRITE  = 1   # register write: address, data written
+TR_FRAME  = 2   # raw I2C frame written (Explorer/ICE command)
+TR_DREAD  = 3   # Explorer/ICE double read (SCOM address, result)
+TR_DWRITE = 4   # Explorer/ICE double write (SCOM address, data)
+TR_OMI    = 5   # Explorer read through Fire MMIO (SCOM address, result)
+TR_SHADOW = 6   # Fire read served by the shadow cache
+TR_MARK   = 7   # text marker, address is the index of the text in tracer.marks
+TR_NAMES = {TR_READ: "read", TR_WRITE: "write", TR_FRAME: "frame", TR_DREAD: "dread", TR_DWRITE: "dwrite",
+            TR_OMI: "omi", TR_SHADOW: "shadow", TR_MARK: "mark"}
+
+TRACE_FILE_MAGIC = b"OMIT"
+TRACE_FILE_VERSION = 2
+M64 = 0xFFFFFFFFFFFFFFFF
+
+
+class TraceRing:
+    RECORD = struct.Struct("<dBBIQQ")   # timestamp, device, op, status, address, data
+
+    def __init__(self, size=TRACE_RING_SIZE):
+        self.size = size
+        self.buf = bytearray(self.RECORD.size * size)
+        self.count = 0          # records written since the start (the ring keeps the last size ones)
+        self.marks = []         # texts of the TR_MARK records
+        self.mark_ids = {}
+        self.echoing = False
+        self.t0 = perf_counter()  # origin of the echoed timestamps
+        self.stream_out = None  # text file the records are streamed to (see stream)
+        self.streamed = 0       # records already written to stream_out
+        self.stream_limit = -1  # count at which the ring would overwrite a record not streamed yet
+        self.stream_t0 = None
+
+    def record(self, dev, op, addr, data=0, status=0):
+        if self.count == self.stream_limit: self.flush_stream()
+        self.RECORD.pack_into(self.buf, (self.count % self.size) * self.RECORD.size, perf_counter(), dev, op, status, addr & M64, data & M64)
+        self.count += 1
+
+    def record_frame(self, dev, frame):
+        """ Explorer/ICE command frame: 0x03/0x04 <address>, 0x05 <address> <data>, 0x01 <config> """
+        n = 1 + ((frame.bit_length() + 3) // 4) // 2     # bytes, as frame_length()
+        if n < 2:
+            self.record(dev, TR_FRAME, 0, frame << 56)
+            return
+        cmd, length = frame >> (8 * (n - 1)), (frame >> (8 * (n - 2))) & 0xff
+        payload = frame & ((1 << (8 * (n - 2))) - 1)
+        if n - 2 == 8: addr, data = payload >> 32, payload & 0xffffffff
+        elif cmd in (0x03, 0x04): addr, data = payload, 0
+        else: addr, data = 0, payload
+        self.record(dev, TR_FRAME, addr, (cmd << 56) | (length << 48) | (data & 0xffffffffffff))
+
+    def record_echo(self, dev, op, addr, data=0, status=0):
+        TraceRing.record(self, dev, op, addr, data, status)
+        logging.info(self.format(self.last(), self.t0))
+
+    def echo(self, on=True):
+        """ Also log every record when it is recorded """
+        self.echoing = on
+        if on: self.record = self.record_echo
+        else: self.__dict__.pop("record", None)
+
+    def mark(self, text):
+        """ Record a text marker (the text is stored once) """
+        mark_id = self.mark_ids.get(text)
+        if mark_id is None:
+            mark_id = self.mark_ids[text] = len(self.marks)
+            self.marks.append(text)
+        self.record(0, TR_MARK, mark_id)
+
+    def last(self):
+        return self.RECORD.unpack_from(self.buf, ((self.count - 1) % self.size) * self.RECORD.size)
+
+    def records(self, last=None):
+        """ Decoded records (timestamp, device, op, status, address, data), oldest first """
+        n = min(self.count, self.size)
+        if last is not None: n = min(n, last)
+        for i in range(self.count - n, self.count):
+            yield self.RECORD.unpack_from(self.buf, (i % self.size) * self.RECORD.size)
+
+    def format(self, rec, t0=0.0):
+        ts, dev, op, status, addr, data = rec
+        dev_name = DEV_NAMES.get(dev, "")
+        if op == TR_MARK:
+            text = self.marks[addr] if addr < len(self.marks) else "?"
+            return "{:12.6f} {:<8} {}".format(ts - t0, dev_name, text)
+        if op == TR_FRAME:
+            return "{:12.6f} {:<8} frame  {:#018x} {:#018x} cmd {:#04x} len {}".format(ts - t0, dev_name, addr,
+                   data & 0xffffffffffff, data >> 56, (data >> 48) & 0xff)
+        line = "{:12.6f} {:<8} {:<6} {:#018x} {:#018x}".format(ts - t0, dev_name, TR_NAMES.get(op, str(op)), addr, data)
+        if status: line += " status {:#x}".format(status)
+        return line
+
+    def lines(self, last=None):
+        recs = list(self.records(last))
+        t0 = recs[0][0] if recs else 0.0
+        return [self.format(rec, t0) for rec in recs]
+
+    def dump(self, out=None, last=None):
+        """ Write the records as text (to stdout by default) """
+        out = out if out is not None else sys.stdout
+        dropped = self.count - min(self.count, self.size)
+        if dropped and last is None: out.write("({} older records overwritten)\n".format(dropped))
+        for line in self.lines(last): out.write(line + "\n")
+
+    def error(self, text, last=TRACE_ERROR_TAIL):
+        """ An error was seen: log it with the last records which led to it """
+        self.mark(text)
+        logging.info("{} - last register accesses:".format(text))
+        for line in self.lines(last): logging.info("    " + line)
+
+    def clear(self):
+        if self.stream_out is not None: self.flush_stream()
+        self.count = 0
+        if self.stream_out is not None: self.streamed, self.stream_limit = 0, self.size
+
+    def stream(self, out):
+        """ Write the records recorded from now on to out as text: the ring is written out each
+            time it is full, before a record is overwritten, and the rest at end_stream() """
+        self.end_stream()
+        self.stream_out = out
+        self.streamed = self.count
+        self.stream_limit = self.count + self.size
+        self.stream_t0 = None
+
+    def flush_stream(self):
+        for i in range(self.streamed, self.count):
+            rec = self.RECORD.unpack_from(self.buf, (i % self.size) * self.RECORD.size)
+            if self.stream_t0 is None: self.stream_t0 = rec[0]
+            self.stream_out.write(self.format(rec, self.stream_t0) + "\n")
+        self.streamed = self.count
+        self.stream_limit = self.count + self.size
+
+    def end_stream(self):
+        if self.stream_out is None: return
+        self.flush_stream()
+        self.stream_out = None
+        self.stream_limit = -1
+
+    """
+        File format (little endian):
+            'OMIT', version (u16), record size (u16), number of records (u32),
+            number of marks (u32), marks joined with '\\0' (u32 length + bytes),
+            records, oldest first
+    """
+    def save(self, path):
+        recs = list(self.records())
+        marks = "\0".join(self.marks).encode()
+        with open(path, "wb") as f:
+            f.write(TRACE_FILE_MAGIC + struct.pack("<HHII", TRACE_FILE_VERSION, self.RECORD.size, len(recs), len(self.marks)))
+            f.write(struct.pack("<I", len(marks)) + marks)
+            for rec in recs: f.write(self.RECORD.pack(*rec))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[0:4] != TRACE_FILE_MAGIC:
+            print("ERROR !! {} is not a trace file".format(path)); return None
+        version, rec_size, n, nb_marks = struct.unpack_from("<HHII", data, 4)
+        if version != TRACE_FILE_VERSION or rec_size != cls.RECORD.size:
+            print("ERROR !! Unsupported trace file version"); return None
+        pos = 16
+        marks_len, = struct.unpack_from("<I", data, pos); pos += 4
+        ring = cls(max(n, 1))
+        ring.marks = data[pos:pos+marks_len].decode().split("\0") if nb_marks else []; pos += marks_len
+        ring.buf[0:n * rec_size] = data[pos:pos + n * rec_size]
+        ring.count = n
+        return ring
+
+
+tracer = TraceRing(int(os.environ.get("OMI_TRACE_SIZE", TRACE_RING_SIZE)))
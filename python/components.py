@@ -22,6 +22,10 @@
 from constants import *
 from functions import *
 from time import sleep
+import polling
+from polling import wait_until, POLL_EEPROM_WRITE
+from bustrace import *
+from timeline import spanned
 #
 #
 #
@@ -46,24 +50,92 @@ from time import sleep
 #               write 0x1 to @0x71.                                              #
 ##################################################################################
 class Mux:
-    def __init__(self, i2c_addr, i2c_bus_num):
+    def __init__(self, i2c_addr, i2c_bus_num, i2c_bus=None):
         self.i2c_addr = i2c_addr
-        self.i2c_bus = init_bus(i2c_bus_num)
+        self.i2c_bus_num = i2c_bus_num
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
     
     def detect(self):
-        alive_addresses = get_alive_addresses(self.i2c_bus)
+        alive_addresses = get_alive_addresses(self.i2c_bus, [self.i2c_addr])
         return self.i2c_addr in alive_addresses
 
     def i2cwrite(self, data):
         msg = smbus.i2c_msg.write(self.i2c_addr, [data])
         self.i2c_bus.i2c_rdwr(msg)
-        logging.info("Mux with address ({:#02x}) is set to {:#02x}".format(self.i2c_addr, data))
+        topology.set_mux(self.i2c_bus_num, self.i2c_addr, data)
+        tracer.record(DEV_MUX, TR_WRITE, self.i2c_addr, data)
     
     def i2cread(self):
         res = self.i2c_bus.read_byte(self.i2c_addr)
+        topology.set_mux(self.i2c_bus_num, self.i2c_addr, res)
+        tracer.record(DEV_MUX, TR_READ, self.i2c_addr, res)
         return res
 
 
+##################################################################################
+#   Keeps track of the settings of the muxes of a bus (in the topology cache)   #
+#   so a path change only writes the muxes that must change.                     #
+#   A mux applies a new channel selection on the STOP condition: a mux behind   #
+#   one being changed can't be reached in the same transfer. Writes are thus    #
+#   grouped per mux level (MUX_LEVELS), one I2C_RDWR per level that changes.    #
+##################################################################################
+class MuxRouter:
+    def __init__(self, i2c_bus_num, i2c_bus=None):
+        self.i2c_bus_num = i2c_bus_num
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
+        self.writes = 0         # mux writes sent
+        self.skipped = 0        # mux writes not needed
+
+    def get(self, mux_addr):
+        """ Setting of a mux, read from the bus only if not known """
+        val = topology.get_mux(self.i2c_bus_num, mux_addr)
+        if val is None: val = Mux(mux_addr, self.i2c_bus_num, self.i2c_bus).i2cread()
+        return val
+
+    def set(self, settings):
+        """ Apply [(mux address, value), ...], upstream muxes first. Returns the number of writes """
+        levels = {}
+        for mux_addr, value in settings:
+            if topology.get_mux(self.i2c_bus_num, mux_addr) == value:
+                self.skipped += 1
+                continue
+            levels.setdefault(MUX_LEVELS.get(mux_addr, 0), []).append((mux_addr, value))
+        nb_writes = 0
+        for level in sorted(levels):
+            msgs = [smbus.i2c_msg.write(mux_addr, [value]) for mux_addr, value in levels[level]]
+            self.i2c_bus.i2c_rdwr(*msgs)
+            for mux_addr, value in levels[level]:
+                topology.set_mux(self.i2c_bus_num, mux_addr, value)
+                tracer.record(DEV_MUX, TR_WRITE, mux_addr, value)
+            nb_writes += len(msgs)
+        self.writes += nb_writes
+        return nb_writes
+
+    def invalidate(self):
+        """ Forget the mux settings (changed outside of this process, power cycle...) """
+        topology.forget_muxes(self.i2c_bus_num)
+
+
+mux_routers = {}
+
+def get_router(busnum):
+    router = mux_routers.get(busnum)
+    if router is None:
+        router = mux_routers[busnum] = MuxRouter(busnum)
+    return router
+
+def use_bus_factory(factory):
+    """ Open the buses with factory(bus number) from now on (simulated or replayed buses).
+        What was known of the previous buses (mux settings, scans, routers holding their handles) is dropped.
+        The polling stats of such a run are not saved, they are not hardware latencies """
+    bus_pool.close()
+    bus_pool.bus_factory = factory
+    polling.persist_wait_stats = False
+    for i2c_bus_num in list(topology.muxes): topology.forget_muxes(i2c_bus_num)
+    mux_routers.clear()
+    topology.invalidate()
+
+
 ##################################################################################
 #   This class represents the pmics that give access to the Explorer chip        #
 #   They are visible only when the path to a DDIMM is open.                      #
@@ -71,22 +143,26 @@ class Mux:
 #   Default value is 0x00 at @0x32.                                              #
 ##################################################################################
 class Pmic:
-    def __init__(self, i2c_addr, i2c_bus_num):
+    def __init__(self, i2c_addr, i2c_bus_num, i2c_bus=None):
         self.i2c_addr = i2c_addr
-        self.i2c_bus = init_bus(i2c_bus_num)
+        self.i2c_bus_num = i2c_bus_num
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
     
     def detect(self):
-        alive_addresses = get_alive_addresses(self.i2c_bus)
+        alive_addresses = get_alive_addresses(self.i2c_bus, [self.i2c_addr])
         return self.i2c_addr in alive_addresses
 
     def i2cwrite(self, data):
         self.i2c_bus.write_i2c_block_data(self.i2c_addr, 0x32, [data])
+        tracer.record(DEV_PMIC, TR_WRITE, self.i2c_addr, data)
+        topology.invalidate(self.i2c_bus_num)     # the Explorer is powered on or off
         res = self.i2cread()
         if res == data: logging.info("PMIC {} value successfully changed to {}.".format(hex(self.i2c_addr), hex(data)))
         else : logging.info("Couldn't change PMIC {} value ({}) to {}.".format(hex(self.i2c_addr), hex(res), hex(data)))
     
     def i2cread(self):
         res = self.i2c_bus.read_i2c_block_data(self.i2c_addr, 0x32, 1)[0]
+        tracer.record(DEV_PMIC, TR_READ, self.i2c_addr, res)
         return res
 
 
@@ -95,32 +171,34 @@ class Pmic:
 #   It contains useful information about the firmware of the chip.               #
 ##################################################################################
 class Eeprom:
-    def __init__(self, i2c_bus_num):
-        self.i2c_bus = init_bus(i2c_bus_num)
+    def __init__(self, i2c_bus_num, i2c_bus=None):
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
 
     def detect(self):
-        alive_addresses = get_alive_addresses(self.i2c_bus)
+        alive_addresses = get_alive_addresses(self.i2c_bus, [EEPROM_I2C_ADDR])
         return EEPROM_I2C_ADDR in alive_addresses
     
     def i2cwrite(self, reg_addr, data):
         data = list(reg_addr.to_bytes(2, "big")) + data
         msg = smbus.i2c_msg.write(EEPROM_I2C_ADDR, data)
 
-        try:
-            self.i2c_bus.i2c_rdwr(msg)
-            return
-        except OSError as e:
-            if e.errno == 121: # Remote I/O error aka slave NAK
-                pass
+        def try_write():
+            try:
+                self.i2c_bus.i2c_rdwr(msg)
+                return 1
+            except OSError as e:
+                if e.errno == 121: return 0 # Remote I/O error aka slave NAK: write cycle in progress
+                raise
 
-        sleep(0.005)
-        self.i2c_bus.i2c_rdwr(msg)
+        done, _ = wait_until(try_write, 1, 1, POLL_EEPROM_WRITE_TIMEOUT, POLL_EEPROM_WRITE)
+        if not done: self.i2c_bus.i2c_rdwr(msg)   # last try, raises the NAK
 
     def i2cread(self, reg_addr, length=1):
         self.i2cwrite(reg_addr, [])
         msg = smbus.i2c_msg.read(EEPROM_I2C_ADDR, length)
         self.i2c_bus.i2c_rdwr(msg)
         data = list(msg)
+        tracer.record(DEV_EEPROM, TR_READ, reg_addr, data[0])
         return data[0]
     
     def read_regs(self):
@@ -168,18 +246,17 @@ class Eeprom:
 def open_path(busnum):
     """ Open path from first level mux for second level mux 
         to be visible (not DDIMMs) """
-    mux = Mux(MUX2_I2C_ADDR, busnum)
-    mux.i2cwrite(0x01)
+    get_router(busnum).set([(MUX2_I2C_ADDR, 0x01)])
 
 def close_path(busnum):
     """ Close the first level mux """
-    mux = Mux(MUX2_I2C_ADDR, busnum)
-    mux.i2cwrite(0x00)
+    get_router(busnum).set([(MUX2_I2C_ADDR, 0x00)])
 
 """Information regarding the I2C commands for the DDIMM PMICs is available in the JEDEC Standard Document JESD301-1A available here: https://www.jedec.org/standards-documents/docs/jesd301-1a"""
 """ Ice has a single Power Managment Chip (UPM) and starts by itself"""
+@spanned("PMIC power-up")
 def set_pmics(busnum):
-    card = scan_bus()
+    card = scan_bus(busnum)
     if card in ["DDIMM"]:
         try:
             pmic1 = Pmic(PMIC1_I2C_ADDR, busnum)
@@ -189,7 +266,7 @@ def set_pmics(busnum):
             print("Activated DDIMM's both PMICs to provide access to the Explorer chip")
         except:
             print("ERROR !! : DDIMM's PMICS not detected !")
-            exit()
+            exit(1)
     elif card in ["GEMINI"]:
         print("GEMINI Card detected, UPM started by itself")
     else : print("WARNING : unknown card or no card")
@@ -201,28 +278,64 @@ def clear_pmics(busnum):
     pmic1.i2cwrite(0x00)
     pmic2.i2cwrite(0x00)
 
+@spanned("I2C path setup")
 def setup_ddimm_path(ddimm, busnum, verbose):
-    """ Open path for given ddimm, only one at a time """
-    open_path(busnum)
-    mux = Mux(MUX3_I2C_ADDR, busnum)
-    if ddimm.lower() == "none":
-        mux.i2cwrite(0x00)
-    elif 'a' in ddimm.lower():
-        mux.i2cwrite(1 << DDIMMA)
-        #set_pmics(busnum, verbose)
-    elif 'b' in ddimm.lower():
-        mux.i2cwrite(1 << DDIMMB)
-        #set_pmics(busnum, verbose)
+    """ Open path for given ddimm, only one at a time. Muxes already set are not written again """
+    if ddimm.lower() == "none": val = 0x00
+    elif 'a' in ddimm.lower(): val = 1 << DDIMMA
+    elif 'b' in ddimm.lower(): val = 1 << DDIMMB
+    else: val = None
+    settings = [(MUX2_I2C_ADDR, 0x01)]
+    if val is not None: settings.append((MUX3_I2C_ADDR, val))
+    get_router(busnum).set(settings)
+    #set_pmics(busnum, verbose)
+
+def current_port(busnum):
+    """ Port the I2C path is currently set to ('a', 'b'), None if no DDIMM path is open """
+    router = get_router(busnum)
+    if router.get(MUX2_I2C_ADDR) != 0x1: return None
+    val = router.get(MUX3_I2C_ADDR)
+    if val == (1 << DDIMMA): return 'a'
+    if val == (1 << DDIMMB): return 'b'
+    return None
+
+def port_cards(busnum, fire, ports="ab"):
+    """ Card type per port ("DDIMM", "GEMINI" or "None").
+        Every port is scanned (after opening its path) to tell the card type. Fire's DDIMM
+        detect register is only a hint, its bit layout is not confirmed: when it disagrees
+        with the scan, the scan wins and the disagreement is logged.
+        Results are kept in the topology cache until a reset. """
+    cards = {}
+    present = None
+    for port in ports.lower():
+        card = topology.cards.get((busnum, port))
+        if card is None:
+            if present is None: present = fire.ddimm_present() or {}
+            setup_ddimm_path(port, busnum, verbose=0)
+            card = scan_bus(busnum)
+            if present and present.get(port, False) != (card != "None"):
+                logging.info("DDIMM detect register says port {} is {}, scan found {}".format(
+                    port, "populated" if present.get(port, False) else "empty", card))
+            topology.cards[(busnum, port)] = card
+        cards[port] = card
+    return cards
+
+def current_card(busnum, fire):
+    """ Card type behind the current I2C path """
+    port = current_port(busnum)
+    if port is None: return scan_bus(busnum)
+    return port_cards(busnum, fire, port)[port]
 
 def path_status(busnum):
-    """ Get current path status (which DDIMM is accessible) """
-    mux1 = Mux(MUX2_I2C_ADDR, busnum)
-    if mux1.i2cread() == 0x0: print("I2C Path is not connected to any DDIMM port.")
-    if mux1.i2cread() == 0x1:
-        mux2 = Mux(MUX3_I2C_ADDR, busnum)
-        if mux2.i2cread() == 0x0: print("No I2C path is open for any DDIMM")
-        elif mux2.i2cread() == 0x1: print("I2C Path is set to PORT 0/A")
-        elif mux2.i2cread() == 0x2: print("I2C Path is set to PORT 1/B")
+    """ Get current path status (which DDIMM is accessible), without bus access when known """
+    router = get_router(busnum)
+    mux1 = router.get(MUX2_I2C_ADDR)
+    if mux1 == 0x0: print("I2C Path is not connected to any DDIMM port.")
+    if mux1 == 0x1:
+        mux2 = router.get(MUX3_I2C_ADDR)
+        if mux2 == 0x0: print("No I2C path is open for any DDIMM")
+        elif mux2 == 0x1: print("I2C Path is set to PORT 0/A")
+        elif mux2 == 0x2: print("I2C Path is set to PORT 1/B")
 
 
 if __name__ == "__main__":
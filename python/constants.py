@@ -164,6 +164,15 @@ FIRE_FML_DDIMMC_RESET_BIT    = (1 << 1)
 FIRE_FML_DDIMMD_RESET_BIT    = (1 << 0)
 FIRE_FML_DDIMMW_RESET_BIT    = (1 << 4)
 
+# DDIMM detect register: one presence bit per port, assumed in the same bit order as the reset bits.
+# This layout is not confirmed by a Fire register definition, it is only used as a hint (see port_cards)
+FIRE_FML_DDIMMA_DETECT_BIT   = (1 << 3)
+FIRE_FML_DDIMMB_DETECT_BIT   = (1 << 2)
+FIRE_FML_DDIMMC_DETECT_BIT   = (1 << 1)
+FIRE_FML_DDIMMD_DETECT_BIT   = (1 << 0)
+FIRE_FML_DDIMM_DETECT_BITS   = {'a': FIRE_FML_DDIMMA_DETECT_BIT, 'b': FIRE_FML_DDIMMB_DETECT_BIT,
+                                'c': FIRE_FML_DDIMMC_DETECT_BIT, 'd': FIRE_FML_DDIMMD_DETECT_BIT}
+
 FIRE_ID_DIRTY_BIT = (1 << 28)
 FIRE_ID_FREQ_DEF  = (7 << 29)
 
@@ -204,6 +213,55 @@ FIRE_DDIMMB_HOST_CONF_STATUS_REG = FIRE_DDIMMB_HOST_CONF_BASE_ADDR + 0x20
 
 DDIMM_HOST_CONF_UP_BIT = (1 << 3)
 
+# Port relocation of the step tables addresses (tables are written for port A)
+FIRE_DDIMM_ADDR_ADJ = {'a': 0x0000000000000000, 'b': (0x00000400 << 32)}
+
+# Explorer registers reached through Fire whose writes have a side effect (doorbells, self
+# clearing command register): they are always written, even when they already hold the
+# value, and what they read back is not checked (port A addresses)
+FIRE_EXP_INBOUND_DOORBELL_SET   = 0x3001000140084730
+FIRE_EXP_INBOUND_DOORBELL_CLEAR = 0x3001000140084738
+FIRE_EXP_OUTBOUND_DOORBELL      = 0x2001000100002058
+FIRE_EXP_DOORBELL_REGS = [FIRE_EXP_INBOUND_DOORBELL_SET, FIRE_EXP_INBOUND_DOORBELL_CLEAR, FIRE_EXP_OUTBOUND_DOORBELL]
+FIRE_EXP_PHY_COMMAND_REG        = 0x300100014008C528    # reads 0 once the command is taken (steps_26b0/b2)
+FIRE_EXP_SIDE_EFFECT_REGS = FIRE_EXP_DOORBELL_REGS + [FIRE_EXP_PHY_COMMAND_REG]
+
+# Explorer registers seen through the Fire OpenCAPI MMIO window (port A, see FIRE_DDIMM_ADDR_ADJ):
+#   64 bits SCOM register 0x08xxxxxx -> FIRE_EXP_MMIO_SCOM_BASE + ((addr & ~(1 << 27)) << 3)
+#   32 bits register                  -> FIRE_EXP_MMIO_REG32_BASE + addr
+FIRE_EXP_MMIO_SCOM_BASE  = 0x3001000140000000
+FIRE_EXP_MMIO_REG32_BASE = 0x2001000100000000
+
+# Explorer register access transport
+TRANSPORT_AUTO = "auto"     # OMI when the link of the port is up, I2C otherwise
+TRANSPORT_I2C  = "i2c"      # Explorer I2C sideband
+TRANSPORT_OMI  = "omi"      # Fire MMIO over the trained OMI link
+TRANSPORTS     = [TRANSPORT_AUTO, TRANSPORT_I2C, TRANSPORT_OMI]
+OMI_LINK_CHECK_PERIOD = 1.0 # seconds between two link state checks in auto mode
+
+# Register access trace (see bustrace.py)
+TRACE_RING_SIZE  = 65536    # records kept (30 bytes each)
+TRACE_ERROR_TAIL = 16       # records logged with an error
+
+# Polling deadlines (s), see polling.py
+POLL_FIRE_LINK_TIMEOUT    = 1.0     # OMI link up after training
+POLL_EXP_DOORBELL_TIMEOUT = 50      # Explorer firmware response to a command
+POLL_FW_READY_TIMEOUT     = 0.25    # firmware update: response to a data burst
+POLL_FW_COMMIT_TIMEOUT    = 60      # firmware update: response to the commit command
+FW_COMMIT_QUIET           = 30      # firmware update: no access while the image is committed, before polling
+POLL_EEPROM_WRITE_TIMEOUT = 0.02    # EEPROM write cycle
+
+# Fire registers changed by the hardware: never served from the Fire shadow cache
+FIRE_VOLATILE_REGS = [FIRE_FML_DDMIMM_DETECT_REG, FIRE_DDIMMA_HOST_CONF_STATUS_REG, FIRE_DDIMMB_HOST_CONF_STATUS_REG]
+# (base, size): FBIST counters and status, and everything behind the Explorer MMIO window
+FIRE_VOLATILE_RANGES = [(FIRE_FBIST_REG_BASE_ADDR, 0x0001000000000000), (0x2000000000000000, 0x2000000000000000)]
+
+# Registers diff-apply always writes besides the Explorer side effect ones (FIRE_EXP_SIDE_EFFECT_REGS):
+# the Fire status registers and the FBIST status and counters. Unlike the shadow cache, the diff
+# does not treat the Explorer window as volatile: its registers hold what the tables wrote.
+FIRE_DIFF_ALWAYS_REGS = FIRE_VOLATILE_REGS
+FIRE_DIFF_ALWAYS_RANGES = [(FIRE_FBIST_REG_BASE_ADDR, 0x0001000000000000)]
+
 
 #########################################################
 #                                                       #
@@ -214,6 +272,7 @@ DDIMM_HOST_CONF_UP_BIT = (1 << 3)
 MUX1_I2C_ADDR    = 0x70
 MUX2_I2C_ADDR    = 0x73
 MUX3_I2C_ADDR    = 0x71
+MUX_LEVELS       = {MUX1_I2C_ADDR: 0, MUX2_I2C_ADDR: 1, MUX3_I2C_ADDR: 2}  # distance from the I2C master
 
 PMIC1_I2C_ADDR   = 0x4f
 PMIC2_I2C_ADDR   = 0x67
@@ -222,10 +281,25 @@ GEM_CLK_GEN_ADDR = 0x7c
 
 DDIMMA = 0
 DDIMMB = 1
+APOLLO16_SLOTS = 16     # DDIMMs of an Apollo16 board (see mux_tree.py)
 
 EEPROM_I2C_ADDR = 0x50
 POWER_CTRL_I2C_ADDR = 0x64
 I2C_ADDR_RANGE = 127
+I2C_RDWR_MAX_MSGS = 42     # I2C_RDWR_IOCTL_MAX_MSGS of the linux kernel: max messages in one I2C_RDWR ioctl
+
+# Write verify policies (see functions.WriteVerifier)
+VERIFY_ALWAYS   = "always"      # read back every write
+VERIFY_DEFERRED = "deferred"    # read back all the writes at once, at flush
+VERIFY_SAMPLED  = "sampled"     # read back one write out of VERIFY_SAMPLE_RATE
+VERIFY_OFF      = "off"         # no read back (write only registers, doorbells)
+VERIFY_POLICIES = [VERIFY_ALWAYS, VERIFY_DEFERRED, VERIFY_SAMPLED, VERIFY_OFF]
+VERIFY_SAMPLE_RATE = 8
+
+# Status (register 0x2) checking of the Explorer/ICE I2C protocol (see functions.StatusChecker)
+STATUS_EACH     = "each"        # status read around every access
+STATUS_DEFERRED = "deferred"    # status read at the end of a batch (or every status_interval accesses)
+STATUS_MODES    = [STATUS_EACH, STATUS_DEFERRED]
 
 EXPLORER   = {"name": "EXPLORER/ICE", "addr": EXP_I2C_ADDR}
 FIRE       = {"name": "FIRE", "addr": FIRE_I2C_ADDR}
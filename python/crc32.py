@@ -81,7 +81,7 @@ def crc32_array(data_array, len):
         data = data_array[c]
         #print(data)
         #data_int=int(data, 0)   # converts data into an int with autobase(0)
-        data_int=int(data, base=16)   # converts data into an int from hexa
+        data_int=data if type(data) == int else int(data, base=16)   # int, or an hexa string converted into an int
         #print("data_int    = {:#018x}".format(data_int))
 
         for i in range (0, 32, 8):   # to compute byte per byte on current 32b word
@@ -0,0 +1,327 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import os
+import re
+import logging
+
+from constants import *
+from regseq import *
+from polling import wait_until, POLL_DEFAULT, POLL_EXP_BUSY
+
+##################################################################################
+#   Import of CRONUS logs.                                                       #
+#   The PUTI2C/GETI2C and i2c_double_read/i2c_double_write lines of a CRONUS    #
+#   log (Explorer at 0x20, see the docstrings of explorer.py) are turned into   #
+#   Explorer register accesses, as given to i2c_double_read (64 bits SCOM       #
+#   registers with bit 27 set, 32 bits registers otherwise):                    #
+#       - the word accesses (0x03/0x04 frames, 0x05 writes) are paired back     #
+#         into 64 bits accesses, the expansion of an i2c_double_* is skipped    #
+#       - the status reads of register 0x2 are dropped                          #
+#       - a read of a value already known (read or written since the last      #
+#         frame or doorbell) is dropped, as is the read back of a write         #
+#       - a write of the value the register already holds is dropped            #
+#       - a register read again and again until it changes (a poll) becomes a  #
+#         wait for its last value                                               #
+#       - the other frames (commands to register 0x1, a write of half a SCOM    #
+#         register, ...) are kept as they are                                   #
+#   The result is a CronusRecipe: RegSequences run in batch (Fire MMIO when the #
+#   OMI link is up, Explorer run_batch otherwise), separated by the frames and  #
+#   the waits. Each RegSequence can be printed as a Fire step table.            #
+#                                                                                #
+#       recipe = load_log("bringup.log")                                         #
+#       recipe.run(fire, explorer)                                              #
+##################################################################################
+
+CRONUS_WAIT_TIMEOUT = 2.0       # s, wait replacing a poll of the log
+EXP_SCOM_BIT = 1 << 27
+
+CRONUS_I2C_LINE    = re.compile(r"^\s*(PUTI2C|GETI2C)\s*:\s*\S+\s*:\s*(.*)$")
+CRONUS_DOUBLE_LINE = re.compile(r"^\s*(i2c_double_read|i2c_double_write)\s*:\s*\S+\s*:\s*(.*)$")
+
+# parsed operations: (kind, address, value, mask), kind being OP_READ, OP_WRITE (regseq) or
+OP_FRAME = 2    # raw frame written to the Explorer, address is the frame
+OP_WAIT  = 3    # read until the register holds value
+
+
+class CronusFrame:
+    """ A frame written as is to the Explorer, followed by a wait for register 0x2 not busy """
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __str__(self):
+        return "frame {:#x}".format(self.frame)
+
+
+class CronusWait:
+    """ Read a register until its bits of mask hold value (a poll of the log) """
+    def __init__(self, reg_addr, value, mask=MASK_ALL):
+        self.reg_addr = reg_addr
+        self.value = value & mask
+        self.mask = mask
+
+    def __str__(self):
+        return "wait {:#010x} == {:#x}".format(self.reg_addr, self.value)
+
+
+class ImportStats:
+    def __init__(self):
+        self.lines = 0
+        self.transactions = 0       # PUTI2C/GETI2C of the log
+        self.status_reads = 0       # dropped
+        self.repeated_reads = 0     # dropped
+        self.verify_reads = 0       # dropped
+        self.repeated_writes = 0    # dropped
+        self.polls = 0              # reads turned into waits
+        self.unsupported = 0        # lines ignored
+
+    def __str__(self):
+        return ("{} lines, {} I2C transactions: dropped {} status reads, {} repeated reads, {} verify reads, "
+                "{} repeated writes, {} poll reads turned into waits, {} unsupported lines").format(
+                self.lines, self.transactions, self.status_reads, self.repeated_reads, self.verify_reads,
+                self.repeated_writes, self.polls, self.unsupported)
+
+
+def mmio_addr(reg_addr, ddimm="a"):
+    """ Fire MMIO address of an Explorer register (as Explorer.mmio_addr) """
+    if reg_addr & EXP_SCOM_BIT: addr = FIRE_EXP_MMIO_SCOM_BASE + ((reg_addr & ~EXP_SCOM_BIT) << 3)
+    else:                       addr = FIRE_EXP_MMIO_REG32_BASE + reg_addr
+    return addr + FIRE_DDIMM_ADDR_ADJ[ddimm]
+
+def side_effect(reg_addr):
+    return mmio_addr(reg_addr) in FIRE_EXP_SIDE_EFFECT_REGS
+
+
+"""
+    Parse the lines of a CRONUS log into [(kind, address, value, mask)], kind being OP_READ, OP_WRITE
+    (Explorer register, the value read or written) or OP_FRAME. Status reads are dropped here.
+"""
+def parse_log(lines, stats=None):
+    stats = stats if stats is not None else ImportStats()
+    ops, words = [], []         # words: (OP_READ/OP_WRITE, word address, value) not paired yet
+    double, pending = None, None    # i2c_double_* being expanded, GETI2C waiting for its COMPLETE line
+
+    def flush_words():
+        i = 0
+        while i < len(words):
+            op, word, value = words[i]
+            if word & EXP_SCOM_BIT:
+                reg_addr = ((word & ~EXP_SCOM_BIT) >> 3) | EXP_SCOM_BIT
+                nxt = words[i+1] if i + 1 < len(words) else None
+                if word % 8 == 0 and nxt is not None and nxt[0] == op and nxt[1] == word + 4:
+                    ops.append((op, reg_addr, (value << 32) | nxt[2], MASK_ALL)); i += 2
+                    continue
+                # lone half of a SCOM register
+                shift = 32 if word % 8 == 0 else 0
+                if op == OP_READ: ops.append((OP_READ, reg_addr, value << shift, 0xFFFFFFFF << shift))
+                else: ops.append((OP_FRAME, 0x0508A000000000000000 + (word << 32) + value, 0, MASK_NONE))
+            else:
+                ops.append((op, word, value, MASK_ALL))
+            i += 1
+        words.clear()
+
+    for line in lines:
+        stats.lines += 1
+        m = CRONUS_DOUBLE_LINE.match(line)
+        if m:
+            tokens = m.group(2).split()
+            if tokens and tokens[0] == "COMPLETE":
+                if double is not None:
+                    cmd, reg_addr, value = double
+                    if cmd == "i2c_double_read" and len(tokens) > 1: value = int(tokens[1], 16)
+                    flush_words()
+                    ops.append((OP_READ if cmd == "i2c_double_read" else OP_WRITE, reg_addr, value, MASK_ALL))
+                double = None
+            elif tokens:
+                double = (m.group(1), int(tokens[0], 16), int(tokens[1], 16) if len(tokens) > 1 else 0)
+            continue
+        m = CRONUS_I2C_LINE.match(line)
+        if not m: continue
+        cmd, rest = m.group(1), m.group(2)
+        if rest.startswith("COMPLETE"):
+            if pending is not None:
+                tokens = rest.split()
+                if double is None and len(tokens) > 1: words.append((OP_READ, pending, int(tokens[1], 16) & 0xFFFFFFFF))
+                pending = None
+            continue
+        stats.transactions += 1
+        fields = dict(f.split(":", 1) for f in rest.split("|") if ":" in f)
+        if int(fields.get("A", "0x20").split()[0], 16) != EXP_I2C_ADDR:
+            stats.unsupported += 1; continue
+        offset = int(fields.get("O", "0x0").split()[0], 16)
+        if cmd == "GETI2C":
+            if offset == 0x2: stats.status_reads += 1
+            elif (offset >> 32) == 0x404: pending = (offset & 0xFFFFFFFF) - EXP_ADDR_OFFSET
+            else: stats.unsupported += 1
+            continue
+        if double is not None: continue     # expansion of the i2c_double_*, the result is on its COMPLETE line
+        data = rest.split()[-1]
+        if ":" in data:
+            stats.unsupported += 1; continue
+        frame = int(data, 16)
+        if data.startswith("0304"): continue    # address of the next 0x04 read
+        if data.startswith("0508") and len(data) == 20:
+            words.append((OP_WRITE, ((frame >> 32) & 0xFFFFFFFF) - EXP_ADDR_OFFSET, frame & 0xFFFFFFFF))
+            continue
+        flush_words()
+        ops.append((OP_FRAME, frame, 0, MASK_NONE))
+    flush_words()
+    return ops
+
+
+"""
+    Drop what the log does and the batched executors do not need (see the banner),
+    returns [(kind, address, value, mask)] with OP_WAIT for the polls.
+"""
+def optimize(ops, stats=None):
+    stats = stats if stats is not None else ImportStats()
+    out = []
+    known = {}      # register -> value known since the last frame (read or written)
+    i = 0
+    while i < len(ops):
+        kind, reg_addr, value, mask = ops[i]
+        if kind == OP_FRAME:
+            out.append(ops[i]); known.clear(); i += 1
+            continue
+        if kind == OP_READ and not side_effect(reg_addr):
+            # a poll: the same register read in a row until its value changes
+            j = i
+            while j + 1 < len(ops) and ops[j+1][0] == OP_READ and ops[j+1][1] == reg_addr and ops[j+1][3] == mask: j += 1
+            if j > i and any(ops[k][2] != value for k in range(i + 1, j + 1)):
+                stats.polls += j - i + 1
+                out.append((OP_WAIT, reg_addr, ops[j][2], mask))
+                known[reg_addr] = ops[j][2]
+                i = j + 1
+                continue
+            stats.repeated_reads += j - i
+            i = j
+            if reg_addr in known and (known[reg_addr] & mask) == (value & mask):
+                if out and out[-1][0] == OP_WRITE and out[-1][1] == reg_addr: stats.verify_reads += 1
+                else: stats.repeated_reads += 1
+                i += 1
+                continue
+            known[reg_addr] = value
+        elif kind == OP_WRITE and side_effect(reg_addr):
+            known.clear()       # the firmware answers a doorbell (the PHY a command): registers may change
+        elif kind == OP_WRITE:
+            if known.get(reg_addr) == value:
+                stats.repeated_writes += 1; i += 1
+                continue
+            known[reg_addr] = value
+        out.append(ops[i])
+        i += 1
+    return out
+
+
+class CronusRecipe:
+    def __init__(self, name, steps, stats):
+        self.name = name
+        self.steps = steps      # RegSequence (Explorer registers), CronusFrame or CronusWait
+        self.stats = stats
+
+    def __len__(self):
+        return sum(len(step) if isinstance(step, RegSequence) else 1 for step in self.steps)
+
+    def sequences(self):
+        return [step for step in self.steps if isinstance(step, RegSequence)]
+
+    def fire_table(self, seq):
+        """ Flat Fire step table of a sequence, port A (see regseq.compile_steps) """
+        table = [seq.name]
+        for op, reg_addr, value, mask, label in seq.steps():
+            if op == OP_READ and mask != MASK_ALL: value = 'X' * 16
+            table += ['R' if op == OP_READ else 'W', mmio_addr(reg_addr), value, label]
+        return tuple(table)
+
+    def format_tables(self):
+        """ Python source of the Fire step tables, with the frames and waits as comments """
+        lines = []
+        for step in self.steps:
+            if not isinstance(step, RegSequence):
+                lines.append("# " + str(step)); continue
+            table = self.fire_table(step)
+            lines.append("{} = ('{}',".format(step.name, step.name))
+            for i in range(1, len(table), 4):
+                value = "'{}'".format(table[i+2]) if type(table[i+2]) == str else "0x{:016X}".format(table[i+2])
+                lines.append("    '{}', 0x{:016X}, {}, '{}',".format(table[i], table[i+1], value, table[i+3]))
+            lines.append(")")
+        return "\n".join(lines)
+
+    def run_omi(self, fire, seq, ddimm):
+        omi_seq = RegSequence(seq.name)
+        for op, reg_addr, value, mask, label in seq.steps():
+            omi_seq.append(op, mmio_addr(reg_addr, ddimm), value, mask, label)
+        result = fire.run_sequence(omi_seq)
+        fire.print_mismatches(result)
+        return result.ok()
+
+    def run_i2c(self, explorer, seq):
+        values = explorer.run_batch([(op, reg_addr, value) for op, reg_addr, value, mask, label in seq.steps()])
+        ok = True
+        for (op, reg_addr, value, mask, label), res in zip(seq.steps(), values):
+            if op == OP_READ and res is not None and (res & mask) != (value & mask):
+                print("!!! WARNING: EXPLORER: READ DATA Not expected !!!!")
+                print("for Register {:#010x}: {:#x} (expected {:#x})".format(reg_addr, res, value))
+                ok = False
+        return ok
+
+    """
+        Run the recipe on the DDIMM of explorer (Explorer built with fire and its port):
+        the sequences through Fire MMIO when the OMI link is up, batched I2C accesses otherwise.
+        Returns True when every read and wait got its expected value.
+    """
+    def run(self, fire, explorer):
+        ok = True
+        for step in self.steps:
+            if isinstance(step, CronusFrame):
+                explorer.i2c_simple_write(step.frame)
+                wait_until(lambda: explorer.i2c_simple_read(0x2), 0xff00, 0, policy=POLL_EXP_BUSY)
+            elif isinstance(step, CronusWait):
+                if explorer.use_omi(): read = lambda: fire.i2cread(mmio_addr(step.reg_addr, explorer.ddimm))
+                else: read = lambda: explorer.i2c_double_read(step.reg_addr)
+                done, val = wait_until(read, step.mask, step.value, CRONUS_WAIT_TIMEOUT, POLL_DEFAULT)
+                if not done:
+                    print("WARNING !! {}: register {:#010x} is {:#x}".format(step, step.reg_addr, val))
+                    ok = False
+            elif explorer.use_omi(): ok = self.run_omi(fire, step, explorer.ddimm) and ok
+            else: ok = self.run_i2c(explorer, step) and ok
+        return ok
+
+
+def import_log(lines, name="cronus"):
+    """ CronusRecipe of the lines of a CRONUS log """
+    stats = ImportStats()
+    ops = optimize(parse_log(lines, stats), stats)
+    steps = []
+    for kind, reg_addr, value, mask in ops:
+        if kind == OP_FRAME: steps.append(CronusFrame(reg_addr))
+        elif kind == OP_WAIT: steps.append(CronusWait(reg_addr, value, mask))
+        else:
+            if not steps or not isinstance(steps[-1], RegSequence):
+                steps.append(RegSequence("{}_{}".format(name, sum(isinstance(step, RegSequence) for step in steps))))
+            steps[-1].append(kind, reg_addr, value, mask, "{:#010x}".format(reg_addr))
+    logging.info("CRONUS import {}: {}".format(name, stats))
+    return CronusRecipe(name, steps, stats)
+
+def load_log(path, name=None):
+    with open(path) as f:
+        return import_log(f, name if name is not None else re.sub(r"\W", "_", os.path.splitext(os.path.basename(path))[0]))
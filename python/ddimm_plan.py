@@ -0,0 +1,199 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import os
+import struct
+import hashlib
+import logging
+
+from constants import *
+from regseq import *
+from fire import Fire
+
+##################################################################################
+#   DDIMM configuration plan (ddimmcfg).                                         #
+#   The Fire step tables to run depend on the DDIMM vendor, its memory size and #
+#   the port. A plan resolves them once for a (vendor, size, port) key into a   #
+#   few RegSequences, separated by the points where we must wait for the        #
+#   Explorer firmware to answer (check_status). Plans are kept in memory and in #
+#   a small binary file cache, keyed by a hash of the Fire step tables, so      #
+#   configuring a rack of identical DDIMMs resolves the plan only once.         #
+##################################################################################
+
+CHECK_STATUS = None     # barrier: wait for the Explorer firmware response
+
+DDIMM_CFG_STEPS = (
+    "steps2122_exp", "steps25_a0", "steps25_a1_{vendor}", "steps25_a2", "steps25_a3_{size}", "steps25_a4",
+    "steps25_a5_{size}", "steps25_a6", "steps25_a7_{size}", "steps25_a8", "steps25_a9_{vendor}", "steps25_a10",
+    "steps25_a11_{vendor}_{size}",
+    CHECK_STATUS,
+    "steps25_b", "step26_a0_{size}", "step26_a1", "step26_a2_{vendor}", "steps26_a3", "steps26_a4_{vendor}_{size}",
+    CHECK_STATUS,
+    "steps_26b0", "steps_26b1_{vendor}", "steps_26b2", "steps27_a0", "steps27_a1_{size}", "steps27_a2",
+)
+
+DDIMM_CFG_VENDORS = ["MICRON", "SMART"]
+DDIMM_CFG_SIZES   = [32, 64]
+
+PLAN_CACHE_DIR = os.environ.get("OMI_PLAN_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "omi_enablement"))
+PLAN_FILE_MAGIC = b"OMIP"
+PLAN_FILE_VERSION = 3
+
+
+class DdimmPlan:
+    def __init__(self, key, segments):
+        self.key = key              # (vendor, memory size, port)
+        self.segments = segments    # RegSequences, a CHECK_STATUS barrier sits between two segments
+
+    def __len__(self):
+        return sum(len(seg) for seg in self.segments)
+
+    """
+        Run the plan with the batched executor of Fire, calling barrier() between segments.
+        In diff mode, each segment is diff-applied: its target registers are read first (after
+        the barrier, as the firmware may have changed them) and only needed writes are issued.
+        Returns True when no barrier failed (barrier() returns a true value on failure) and
+        no register mismatched.
+    """
+    def run(self, fire, barrier=None, diff=False):
+        applied, skipped = 0, 0
+        ok = True
+        for n, seg in enumerate(self.segments):
+            if n > 0 and barrier is not None and barrier(): ok = False
+            if diff:
+                result, report = fire.diff_apply(seg)
+                applied += len(report.applied)
+                skipped += len(report.skipped)
+            else:
+                result = fire.run_sequence(seg)
+            fire.print_mismatches(result)
+            if not result.ok(): ok = False
+        if diff: print("Diff-apply: {} writes applied, {} writes skipped (already set)".format(applied, skipped))
+        return ok
+
+
+def resolve_tables(_vendor, _memory_size):
+    """ Return the ordered Fire table names (and CHECK_STATUS barriers), None if unsupported """
+    if _vendor not in DDIMM_CFG_VENDORS:
+        print("ERROR !!: Unsupported Vendor ID"); return None
+    if _memory_size not in DDIMM_CFG_SIZES:
+        print("ERROR !!: Bad Memory size"); return None
+    return [step if step is CHECK_STATUS else step.format(vendor=_vendor, size=_memory_size) for step in DDIMM_CFG_STEPS]
+
+
+step_tables_hash = None
+
+def get_step_tables_hash():
+    """ Hash of every Fire step table (plus the port relocation), used to key the plan cache """
+    global step_tables_hash
+    if step_tables_hash is None:
+        h = hashlib.sha1()
+        for name in sorted(vars(Fire)):
+            table = getattr(Fire, name)
+            if type(table) == tuple and len(table) > 0 and type(table[0]) == str:
+                h.update(name.encode())
+                h.update(repr(table).encode())
+        h.update(repr(sorted(FIRE_DDIMM_ADDR_ADJ.items())).encode())
+        step_tables_hash = h.hexdigest()[:16]
+    return step_tables_hash
+
+
+def plan_file(key):
+    _vendor, _memory_size, _ddimm = key
+    return os.path.join(PLAN_CACHE_DIR, "ddimm_plan_{}_{}_{}_{}.bin".format(get_step_tables_hash(), _vendor, _memory_size, _ddimm))
+
+"""
+    File format (native byte order):
+        'OMIP', version (u16), number of segments (u16)
+        for each segment: name length (u16), name, number of steps (u32),
+                          opcodes (u8 x n), addresses, values, masks (u64 x n),
+                          labels length (u32), labels joined with '\\0'
+"""
+def save_plan(plan):
+    try:
+        os.makedirs(PLAN_CACHE_DIR, exist_ok=True)
+        with open(plan_file(plan.key), "wb") as f:
+            f.write(PLAN_FILE_MAGIC + struct.pack("=HH", PLAN_FILE_VERSION, len(plan.segments)))
+            for seg in plan.segments:
+                name = seg.name.encode()
+                labels = "\0".join(seg.labels).encode()
+                f.write(struct.pack("=H", len(name)) + name + struct.pack("=I", len(seg)))
+                f.write(seg.ops.tobytes() + seg.addrs.tobytes() + seg.values.tobytes() + seg.masks.tobytes())
+                f.write(struct.pack("=I", len(labels)) + labels)
+    except OSError as err:
+        logging.info("Could not save ddimmcfg plan in cache: {}".format(err))
+
+def load_plan(key):
+    try:
+        with open(plan_file(key), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        if data[0:4] != PLAN_FILE_MAGIC: return None
+        version, nb_segments = struct.unpack_from("=HH", data, 4)
+        if version != PLAN_FILE_VERSION: return None
+        pos = 8
+        segments = []
+        for s in range(nb_segments):
+            name_len, = struct.unpack_from("=H", data, pos); pos += 2
+            seg = RegSequence(data[pos:pos+name_len].decode()); pos += name_len
+            n, = struct.unpack_from("=I", data, pos); pos += 4
+            seg.ops.frombytes(data[pos:pos+n]); pos += n
+            for arr in (seg.addrs, seg.values, seg.masks):
+                arr.frombytes(data[pos:pos+8*n]); pos += 8*n
+            labels_len, = struct.unpack_from("=I", data, pos); pos += 4
+            seg.labels = data[pos:pos+labels_len].decode().split("\0") if n else []; pos += labels_len
+            segments.append(seg)
+        return DdimmPlan(key, segments)
+    except (struct.error, ValueError, UnicodeDecodeError):
+        logging.info("Ignoring corrupted ddimmcfg plan cache file {}".format(plan_file(key)))
+        return None
+
+
+ddimm_plans = {}
+
+def get_plan(_vendor, _memory_size, _ddimm):
+    """ Return the DdimmPlan of a (vendor, memory size, port), from memory, disk cache, or built """
+    key = (_vendor, _memory_size, _ddimm)
+    plan = ddimm_plans.get(key)
+    if plan is not None: return plan
+
+    plan = load_plan(key)
+    if plan is not None:
+        logging.info("ddimmcfg plan {} loaded from cache".format(key))
+    else:
+        tables = resolve_tables(_vendor, _memory_size)
+        if tables is None: return None
+        segments = [RegSequence()]
+        for name in tables:
+            if name is CHECK_STATUS:
+                segments.append(RegSequence())
+                continue
+            seq = compile_steps(getattr(Fire, name), _ddimm)
+            if seq is None: return None
+            segments[-1].extend(seq)
+        for n, seg in enumerate(segments): seg.name = "ddimmcfg_{}_{}_{}_{}".format(_vendor, _memory_size, _ddimm, n)
+        plan = DdimmPlan(key, segments)
+        save_plan(plan)
+
+    ddimm_plans[key] = plan
+    return plan
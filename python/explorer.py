@@ -21,8 +21,12 @@
 
 from constants import *
 from functions import *
+from regseq import OP_READ, OP_WRITE
 from components import Eeprom
-from time import sleep
+from polling import wait_until, POLL_EXP_BOOT, POLL_EXP_BUSY
+from bustrace import *
+from timeline import span
+from time import sleep, monotonic
 
 ##################################################################################
 #    This class represents the Explorer firmware which is responsible            #
@@ -35,22 +39,67 @@ class Explorer:
 
     """ 
         Initialize i2c bus and get IDs of the Explorer 
+        With the Fire driving its OMI link (and the port of the DDIMM), register accesses
+        go through the Fire MMIO window once the link is trained (see use_omi).
         """
-    def __init__(self, fire_freq, i2c_bus_num):
+    def __init__(self, fire_freq, i2c_bus_num, i2c_bus=None, verify=VERIFY_ALWAYS, status_mode=STATUS_EACH, status_interval=0,
+                 fire=None, ddimm="a", transport=TRANSPORT_AUTO):
         self.i2c_bus_num = i2c_bus_num
-        self.i2c_bus = init_bus(i2c_bus_num)
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
         self.fire_freq = fire_freq
+        self.fire = fire
+        self.ddimm = ddimm.lower()
+        self.transport = transport
+        self.omi_up = False
+        self.omi_checked = None     # time of the last OMI link check
+        self.verifier = WriteVerifier("Explorer", verify)
+        self.status = StatusChecker("Explorer", status_mode, status_interval)
+        self.pipelined_read = True  # cleared if the adapter can't take the read_many frames in one I2C_RDWR
         
         
     def getinfo(self):
         self.ecid, self.ese_mode_status = self.get_ecid()
         self.card_id = hex(self.i2c_double_read(EXP_ID_NUM_REG))
 
+    """
+        Transport of the register accesses: Fire MMIO over the OMI link when it is trained
+        (checked at most every OMI_LINK_CHECK_PERIOD seconds in auto mode), I2C otherwise.
+        """
+    def use_omi(self):
+        if self.fire is None or self.transport == TRANSPORT_I2C: return False
+        if self.transport == TRANSPORT_OMI: return True
+        now = monotonic()
+        if self.omi_checked is None or now - self.omi_checked > OMI_LINK_CHECK_PERIOD:
+            self.omi_up = self.fire.link_up(self.ddimm)
+            self.omi_checked = now
+            logging.info("Explorer: OMI link of port {} is {}".format(self.ddimm.upper(), "up" if self.omi_up else "down"))
+        return self.omi_up
+
+    def omi_link_lost(self):
+        self.omi_up = False
+        self.omi_checked = monotonic()
+        print("WARNING !! Explorer MMIO access through Fire failed, using I2C")
+
+    def mmio_addr(self, reg_addr):
+        """ Fire MMIO address of an Explorer register (64 bits SCOM if bit 27 is set, 32 bits otherwise) """
+        if reg_addr & (1 << 27): mmio_addr = FIRE_EXP_MMIO_SCOM_BASE + ((reg_addr & ~(1 << 27)) << 3)
+        else:                    mmio_addr = FIRE_EXP_MMIO_REG32_BASE + reg_addr
+        return mmio_addr + FIRE_DDIMM_ADDR_ADJ[self.ddimm]
+
+    def omi_read(self, reg_addr):
+        """ Read through Fire MMIO, None if the access failed """
+        odata = self.fire.i2cread(self.mmio_addr(reg_addr))
+        if (odata >> 8) == 0xdec0de:
+            self.omi_link_lost()
+            return None
+        tracer.record(DEV_EXPLORER, TR_OMI, reg_addr, odata)
+        return odata
+
     """ 
         Detect if Explorer i2c address is visible on the bus 
         """
     def detect(self):
-        alive_addresses = get_alive_addresses(self.i2c_bus)
+        alive_addresses = get_alive_addresses(self.i2c_bus, [EXP_I2C_ADDR])
         return EXP_I2C_ADDR in alive_addresses
     
     """ 
@@ -75,8 +124,8 @@ class Explorer:
         res = self.i2c_bus.read_i2c_block_data(EXP_I2C_ADDR, reg_addr, 5)
         
         # format result and remove the MSB (0x04 indicates a read operation)
-        odata = int(''.join(format(val, '02x') for val in res[1:5]), 16)
-        logging.info("Explorer Reading {:#010x} from {:#010x}".format(odata, reg_addr))
+        odata = int.from_bytes(bytes(res[1:5]), 'big')
+        tracer.record(DEV_EXPLORER, TR_READ, reg_addr, odata)
         
         return odata
 
@@ -89,10 +138,10 @@ class Explorer:
         explorer.i2c_simple_write(0304A80940B8)
         """
     def i2c_simple_write(self, data):
-        logging.info("Explorer Writing {:#010x}".format(data))
+        tracer.record_frame(DEV_EXPLORER, data)
 
         # calculate the number of bytes in provided data 
-        length = int(len(str(hex(data)))/2)
+        length = frame_length(data)
         
         # convert to a list of bytes and then write
         msg = smbus.i2c_msg.write(EXP_I2C_ADDR, list(data.to_bytes(length, 'big')))
@@ -152,23 +201,24 @@ class Explorer:
         explorer.i2c_double_read(0x20B080)
         """
     def i2c_double_read(self, reg_addr):
+        if self.use_omi():
+            odata = self.omi_read(reg_addr)
+            if odata is not None: return odata
+        if self.status.deferred(): return self.run_batch([(OP_READ, reg_addr, 0)])[0]
         bit_64 = reg_addr & (1 << 27)    # if bit64 this means we need to achieve 2 I2C transactions
 
         if bit_64:
             raw_reg_addr = reg_addr & ~(1 << 27)
             new_reg_addr = (raw_reg_addr << 3) | (1 << 27)
-            logging.info("DBG: Explorer 64bits DRead at Scom Addr: {:#010x}".format(reg_addr)) 
         else:
             raw_reg_addr = reg_addr
             new_reg_addr = reg_addr
-            logging.info("       Explorer 32bits  Read at Scom Addr: {:#010x}".format(reg_addr))
-        logging.info("       Explorer read at Register Addr:     {:#010x}".format(new_reg_addr))
 
         try:
             self.i2c_simple_read(0x2)
         except:
             print("WARNING ! EXP read failed")
-            exit()
+            exit(1)
         self.i2c_simple_write(0x0304A0000000 + new_reg_addr)
         self.i2c_simple_read(0x2)
         # EXPLORER we use a trick to get the result
@@ -183,13 +233,12 @@ class Explorer:
         
         if bit_64:
             new_reg_addr_2 = new_reg_addr + 4
-            logging.info("       Explorer read at Register Addr:     {:#010x}".format(new_reg_addr_2))
             
             try:
                 self.i2c_simple_read(0x2)
             except:
                 print("WARNING ! EXP read failed")
-                exit()
+                exit(1)
             
             self.i2c_simple_write(0x0304A0000000 + new_reg_addr_2)
             self.i2c_simple_read(0x2)
@@ -199,14 +248,15 @@ class Explorer:
 
             self.i2c_simple_read(0x2) # previous command status
 
+            tracer.record(DEV_EXPLORER, TR_DREAD, reg_addr, (res_msb << 32) + res_lsb)
             return ((res_msb << 32) + res_lsb)
 
-        else: return res_msb
+        tracer.record(DEV_EXPLORER, TR_DREAD, reg_addr, res_msb)
+        return res_msb
 
     def i2c_simple_readreg(self, reg_addr):
         raw_reg_addr = reg_addr
         new_reg_addr = reg_addr
-        logging.info("       Explorer read at Register Addr:     {:#010x}".format(new_reg_addr))
 
         self.i2c_simple_write(0x0304A0000000 + new_reg_addr)
         self.i2c_simple_read(0x2)
@@ -217,6 +267,93 @@ class Explorer:
         
         return res_msb
 
+    """
+        Read a set of registers (64 bits SCOM addresses with bit 27 set, or 32 bits addresses)
+        in a row. The address translation is done once for the whole set, then every 32 bits
+        word is read with its 0x03 and 0x04 frames followed by the read of register 0x2,
+        pipelined in I2C_RDWR transfers. Register 0x2 status is only checked before and
+        after the whole set, not around each word: if it shows an error, the set is read
+        again with i2c_double_read.
+        Returns a dict {address: value} in the order of addrs.
+        Over the OMI link, the set is read with a single Fire batch.
+
+        explorer.read_many([0x08012811, 0x0020B080])
+        """
+    def read_many(self, addrs):
+        if self.use_omi():
+            with self.fire.batch(name="explorer_read_many") as batch:
+                for reg_addr in addrs: batch.read(self.mmio_addr(reg_addr))
+            if not any((odata >> 8) == 0xdec0de for odata in batch.result.values):
+                return dict(zip(addrs, batch.result.values))
+            self.omi_link_lost()
+
+        words = []
+        for reg_addr in addrs:
+            if reg_addr & (1 << 27):
+                new_reg_addr = ((reg_addr & ~(1 << 27)) << 3) | (1 << 27)
+                words += [new_reg_addr, new_reg_addr + 4]
+            else:
+                words.append(reg_addr)
+        logging.info("       Explorer bulk read of {} registers ({} words)".format(len(addrs), len(words)))
+
+        try:
+            self.i2c_simple_read(0x2)
+        except:
+            print("WARNING ! EXP read failed")
+            exit(1)
+        values = self.read_words(words)
+        status = self.i2c_simple_read(0x2)   # previous command status
+        if self.status.error(status):
+            tracer.error("Explorer: bulk read ended with status {:#010x}".format(status))
+            return dict(zip(addrs, self.status.replay([(OP_READ, reg_addr, 0) for reg_addr in addrs], self.slow_op)))
+        self.status.skip(3 * len(words) - 2)
+
+        res = {}
+        i = 0
+        for reg_addr in addrs:
+            if reg_addr & (1 << 27):
+                res[reg_addr] = (values[i] << 32) + values[i+1]; i += 2
+            else:
+                res[reg_addr] = values[i]; i += 1
+        return res
+
+    """
+        Read count consecutive registers from start (SCOM step for 64 bits addresses, 4 otherwise).
+        """
+    def read_range(self, start, count):
+        step = 1 if start & (1 << 27) else 4
+        return self.read_many([start + i * step for i in range(count)])
+
+    def read_words(self, words):
+        values = []
+        nb_words = I2C_RDWR_MAX_MSGS // 4   # 4 messages per word
+        for start in range(0, len(words), nb_words):
+            chunk = words[start:start + nb_words]
+            if self.pipelined_read:
+                msgs, reads = [], []
+                for word in chunk:
+                    msg_r = smbus.i2c_msg.read(EXP_I2C_ADDR, 5)
+                    msgs.append(smbus.i2c_msg.write(EXP_I2C_ADDR, list((0x0304A0000000 + word).to_bytes(6, 'big'))))
+                    msgs.append(smbus.i2c_msg.write(EXP_I2C_ADDR, list((0x0404A0000000 + word).to_bytes(6, 'big'))))
+                    msgs.append(smbus.i2c_msg.write(EXP_I2C_ADDR, [0x2]))
+                    msgs.append(msg_r)
+                    reads.append(msg_r)
+                try:
+                    self.i2c_bus.i2c_rdwr(*msgs)
+                    for word, msg_r in zip(chunk, reads):
+                        odata = int.from_bytes(bytes(list(msg_r)[1:5]), 'big')
+                        tracer.record(DEV_EXPLORER, TR_READ, word, odata)
+                        values.append(odata)
+                    continue
+                except OSError:
+                    logging.info("Explorer: pipelined I2C_RDWR rejected by the adapter, reading word by word")
+                    self.pipelined_read = False
+            for word in chunk:
+                self.i2c_simple_write(0x0304A0000000 + word)
+                self.i2c_simple_write(0x0404A0000000 + word)
+                values.append(self.i2c_simple_read(0x2))
+        return values
+
     """
         Equivalent to i2c_double_write in CRONUS
         i2c_double_write   : explorer:k0:n0:s0:p00 : 08012811             0000040000000059
@@ -245,8 +382,9 @@ class Explorer:
 
         explorer.i2c_double_write(0x08012811, 0x0000040000000059)
         """
-    def i2c_simple_writereg(self, reg_addr, data):
-        logging.info("Explorer DWrite Reg: {:#010x} with Data:{:#010x}".format(reg_addr, data))
+    def i2c_simple_writereg(self, reg_addr, data, verify=None):
+        policy, read_back = self.verifier.select(verify)
+        tracer.record(DEV_EXPLORER, TR_DWRITE, reg_addr, data)
         
         left_reg_addr = (reg_addr >> 3) << 3
         right_reg_addr = left_reg_addr + 4
@@ -266,12 +404,19 @@ class Explorer:
         self.i2c_simple_write(0x0508A000000000000000 + (right_reg_addr << 32) + data_right)
         self.i2c_simple_read(0x2)
         
+        if policy == VERIFY_DEFERRED: self.verifier.defer(reg_addr, data)
+        if not read_back: return True
         r_data = self.i2c_simple_readreg(reg_addr)
         return (r_data == data)
 
-    def i2c_double_write(self, reg_addr, data):
+    """
+        The write is read back with a full i2c_double_read depending on the verify policy
+        (session one unless given). Returns True when not read back now.
+        """
+    def i2c_double_write(self, reg_addr, data, verify=None):
         bit_64 = reg_addr & (1 << 27)
-        logging.info("Explorer DWrite Reg: {:#010x} with Data:{:#010x}".format(reg_addr, data))
+        policy, read_back = self.verifier.select(verify)
+        tracer.record(DEV_EXPLORER, TR_DWRITE, reg_addr, data)
 
         if bit_64:
             raw_reg_addr = reg_addr & ~(1 << 27)
@@ -284,16 +429,64 @@ class Explorer:
             data_msb = data & 0xffffffff
             data_lsb = data & 0xffffffff
 
-        self.i2c_simple_write(0x0508A000000000000000 + (new_reg_addr << 32) + data_msb)
-        self.i2c_simple_read(0x2)
-        
-        if bit_64:
-            self.i2c_simple_write(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb)
+        if self.use_omi():
+            self.fire.i2cwrite(self.mmio_addr(reg_addr), data, VERIFY_OFF)
+        elif self.status.deferred():
+            self.run_batch([(OP_WRITE, reg_addr, data)])
+        else:
+            self.i2c_simple_write(0x0508A000000000000000 + (new_reg_addr << 32) + data_msb)
             self.i2c_simple_read(0x2)
+            
+            if bit_64:
+                self.i2c_simple_write(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb)
+                self.i2c_simple_read(0x2)
         
+        if policy == VERIFY_DEFERRED: self.verifier.defer(reg_addr, data)
+        if not read_back: return True
         r_data = self.i2c_double_read(reg_addr)
         return (r_data == data)
 
+    """
+        Run a batch of accesses (OP_READ/OP_WRITE, reg_addr, data) with the status of register 0x2
+        only read at the end of the batch (or every status_interval accesses). Returns the read
+        values (None for writes). On a status error, the batch is replayed with the status
+        checked around every access. Writes of a batch are not read back.
+
+        explorer.run_batch([(OP_WRITE, 0x08012811, 0x000005000000006f), (OP_READ, 0x08012810, 0)])
+        """
+    def run_batch(self, ops):
+        return self.status.run(ops, self.fast_op, self.slow_op, lambda: self.i2c_simple_read(0x2))
+
+    def fast_op(self, op, reg_addr, data):
+        if reg_addr & (1 << 27):
+            new_reg_addr = ((reg_addr & ~(1 << 27)) << 3) | (1 << 27)
+            words = [(new_reg_addr, data >> 32), (new_reg_addr + 4, data & 0xffffffff)]
+        else:
+            words = [(reg_addr, data & 0xffffffff)]
+        if op == OP_WRITE:
+            for word, word_data in words:
+                self.i2c_simple_write(0x0508A000000000000000 + (word << 32) + word_data)
+            self.status.skip(len(words))
+            return None
+        res = 0
+        for word, word_data in words:
+            self.i2c_simple_write(0x0304A0000000 + word)
+            self.i2c_simple_write(0x0404A0000000 + word)
+            res = (res << 32) + self.i2c_simple_read(0x2)
+        self.status.skip(3 * len(words))
+        return res
+
+    def slow_op(self, op, reg_addr, data):
+        if op == OP_READ: return self.i2c_double_read(reg_addr)
+        self.i2c_double_write(reg_addr, data, VERIFY_OFF)
+
+    """
+        Read back the writes done with the deferred verify policy.
+        Returns the list of (address, written, read) that don't match.
+        """
+    def flush_verify(self):
+        return self.verifier.flush(lambda regs: list(self.read_many(regs).values()))
+
 
     """ 
         Retrieve explorer firmware info 
@@ -315,16 +508,13 @@ class Explorer:
         self.i2c_simple_write(0x0404A0002058)
         self.i2c_simple_read(0x2)
 
+        values = self.read_many([reg['addr'] - EXP_ADDR_OFFSET for reg in EXP_FW_REGISTERS])
         for reg in EXP_FW_REGISTERS:
-            self.i2c_simple_write(reg['addr'] + 0x030400000000)
-            res = self.i2c_simple_read(0x2) 
-            self.i2c_simple_write(reg['addr'] + 0x040400000000)
-            res = self.i2c_simple_read(0x2)
+            res = values[reg['addr'] - EXP_ADDR_OFFSET]
             print("{}: {}".format(reg['label'], hex(res)), "-",res)
-            res = self.i2c_simple_read(0x2)
         
         self.i2c_double_write(0x080108E7, 0x8000000000000000)
-        self.i2c_double_write(0x00002058, 0x0000000000000001)
+        self.i2c_double_write(0x00002058, 0x0000000000000001, VERIFY_OFF)   # doorbell
 
     def cfg_ddimm(self, ddimm):
         self.getinfo()
@@ -346,29 +536,31 @@ class Explorer:
 
        # Execute exp_omi_setup_wrap
        #("---------- STEP12 : Explorer  OMI Training Sequence ------------")
-       # next sleep is not clean, but we miss a criteria to check reg02 reading capability
        # When reg 02 is not available system prevent I2C reading without crashing though
         logging.info("---------- Step 11: exp_check_for_ready_wrap      ------------")
-        while (self.i2c_simple_read(0x2) & ~0x00ffffff ) >> 24 != 0: sleep(6)  
-        version=(self.i2c_simple_read(0x2) & ~0xff00ffff) >> 16
+        with span("Explorer ready"):
+            ready, reg02 = wait_until(lambda: self.i2c_simple_read(0x2), 0xff000000, 0, policy=POLL_EXP_BOOT)
+        version=(reg02 & ~0xff00ffff) >> 16
         print("Explorer Firmware API version: {:#004x} Ready".format(version ))
         logging.info("---------- Step 12 exp_omi_setup_wrap            ------------")
-        self.i2c_simple_write(0x010400008090 + b)
-        logging.info("DBG:Explorer Writing {} 4 bytes in reg 01 of Explorer".format(hex(0x010400008090 + b)))
-        logging.info("DBG:To trigger SerDes initialization (Explorer side)")
-        logging.info("Waiting status flag to change from busy...")
-        while (self.i2c_simple_read(0x2) & ~0xffff00ff ) >> 8 != 0: pass
-        self.i2c_simple_read(0x2)
+        with span("SerDes init"):
+            self.i2c_simple_write(0x010400008090 + b)
+            logging.info("DBG:Explorer Writing {} 4 bytes in reg 01 of Explorer".format(hex(0x010400008090 + b)))
+            logging.info("DBG:To trigger SerDes initialization (Explorer side)")
+            logging.info("Waiting status flag to change from busy...")
+            wait_until(lambda: self.i2c_simple_read(0x2), 0xff00, 0, policy=POLL_EXP_BUSY)
+            self.i2c_simple_read(0x2)
         #logging.info("---------- End of Bootconfig in Init             ------------")
         return b
 
     """ 
         Start the sync/training on the explorer side. it expects Fire's frequency
         as an argument (retreived from Fire's ID).
+        verify overrides the write verify policy for the training writes.
         This should be followed by a Fire's sync/training procedure for the 
         complete training.
         """
-    def sync(self):
+    def sync(self, verify=None):
         if self.fire_freq == 333: b = 0x1
         elif self.fire_freq == 400: b = 0x3
         else: 
@@ -386,42 +578,44 @@ class Explorer:
         self.i2c_double_read(0x08012807)
         self.i2c_double_read(0x08040017)
 
-        self.i2c_double_write(0x08040017, 0xf800000000000000)
-        self.i2c_double_write(0x08040010, 0x0)
-        self.i2c_double_write(0x08040011, 0xffffffffffffffff)
-        self.i2c_double_write(0x0804000e, 0xFFFFF59E7E01FFFF)
-        self.i2c_double_write(0x08012406, 0x0)
-        self.i2c_double_write(0x08012407, 0x8000000000000000)
-        self.i2c_double_write(0x08012404, 0x00ffffffffffffff)
-        self.i2c_double_write(0x08012803, 0xffffffffffffffff)
-        self.i2c_double_write(0x08012806, 0x0)
-        self.i2c_double_write(0x08012807, 0x0560000000000000)
-        self.i2c_double_write(0x08012804, 0x3A9FFFFFFFFFFFFF)
+        self.i2c_double_write(0x08040017, 0xf800000000000000, verify)
+        self.i2c_double_write(0x08040010, 0x0, verify)
+        self.i2c_double_write(0x08040011, 0xffffffffffffffff, verify)
+        self.i2c_double_write(0x0804000e, 0xFFFFF59E7E01FFFF, verify)
+        self.i2c_double_write(0x08012406, 0x0, verify)
+        self.i2c_double_write(0x08012407, 0x8000000000000000, verify)
+        self.i2c_double_write(0x08012404, 0x00ffffffffffffff, verify)
+        self.i2c_double_write(0x08012803, 0xffffffffffffffff, verify)
+        self.i2c_double_write(0x08012806, 0x0, verify)
+        self.i2c_double_write(0x08012807, 0x0560000000000000, verify)
+        self.i2c_double_write(0x08012804, 0x3A9FFFFFFFFFFFFF, verify)
 
         self.i2c_double_read(0x08012812)
-        self.i2c_double_write(0x08012812, 0x0000FFD100040000)
+        self.i2c_double_write(0x08012812, 0x0000FFD100040000, verify)
 
         self.i2c_double_read(0x08040002)
-        self.i2c_double_write(0x08040002, 0x6627FFE000000000)
+        self.i2c_double_write(0x08040002, 0x6627FFE000000000, verify)
 
         self.i2c_double_read(0x08040007)
-        self.i2c_double_write(0x08040007, 0x0)
+        self.i2c_double_write(0x08040007, 0x0, verify)
 
-        self.i2c_double_write(0x080108e4, 0x0)
+        self.i2c_double_write(0x080108e4, 0x0, verify)
         self.i2c_double_read(0x080108e4)
 
         self.i2c_double_read(0x08012811)
-        self.i2c_double_write(0x08012811, 0x000005000000006f)
+        self.i2c_double_write(0x08012811, 0x000005000000006f, verify)
 
         self.i2c_double_read(0x08012810)
-        self.i2c_double_write(0x08012810, 0x8122640700112620)
+        self.i2c_double_write(0x08012810, 0x8122640700112620, verify)
         
         self.i2c_double_read(0x08012811)
+        if (verify or self.verifier.policy) == VERIFY_DEFERRED: self.flush_verify()
         
         logging.info("---------- Step 14 : Explorer OMI Training Sequence ------------")
         
         logging.info("---------- Step 15 : Explorer OMI Training Sequence ------------")
-        self.i2c_simple_write(0x010400008190 + b)
+        with span("DL training start"):
+            self.i2c_simple_write(0x010400008190 + b)
         logging.info("DBG:Explorer Writing {} 4 bytes in reg 01 of Explorer".format(hex(0x010400008190 + b)))
         logging.info("DBG:To start DL training (Stage 1 Firmware Explorer side)")
         logging.info("---------- End of Step 15                         ------------")
@@ -457,12 +651,9 @@ class Explorer:
         Retreive Explorer's ECID and Entreprise Mode Status.
         """
     def get_ecid(self):
-        ese_mode_status = self.i2c_double_read(0x0020B080)
-        addr_i = 0x0020B0C4
-        ecid = []
-        while addr_i >= 0x0020B090:
-            ecid.append(self.i2c_double_read(addr_i))
-            addr_i -= 4
+        regs = self.read_many([0x0020B080] + list(range(0x0020B0C4, 0x0020B090 - 4, -4)))
+        ese_mode_status = regs.pop(0x0020B080)
+        ecid = list(regs.values())
         ecid_n = int(''.join(format(val, '02x') for val in ecid), 16)
         return hex(ecid_n), hex(ese_mode_status)
 
@@ -471,8 +662,8 @@ class Explorer:
         res = self.i2c_bus.read_i2c_block_data(EXP_I2C_ADDR, reg_addr, 5)
         
         # format result and remove the MSB (0x04 indicates a read operation)
-        odata = int(''.join(format(val, '02x') for val in res[1:5]), 16)
-        logging.info("Explorer Reading {:#010x} from {:#010x}".format(odata, reg_addr))
+        odata = int.from_bytes(bytes(res[1:5]), 'big')
+        tracer.record(DEV_EXPLORER, TR_READ, reg_addr, odata)
         
         return odata
     
@@ -485,10 +676,10 @@ class Explorer:
         explorer.i2cwrite(0304A80940B8)
         """
     def i2cwrite(self, data):
-        logging.info("Explorer Writing {:#010x}".format(data))
+        tracer.record_frame(DEV_EXPLORER, data)
 
         # calculate the number of bytes in provided data 
-        length = int(len(str(hex(data)))/2)
+        length = frame_length(data)
         
         # convert to a list of bytes and then write
         msg = smbus.i2c_msg.write(EXP_I2C_ADDR, list(data.to_bytes(length, 'big')))
@@ -22,6 +22,7 @@
 from re import I
 from constants import *
 from functions import *
+from regseq import *
 from time import sleep
 from fire import *
 from explorer import *
@@ -32,8 +33,25 @@ from explorer import *
 
 class Fbist:
 
-	def fbist(self, _busnum, _ddimm):
-		fire = Fire(_busnum)
+	""" 
+		A Fire instance can be provided to avoid re-opening the bus and re-reading the Fire ID
+		in every FBIST step. Otherwise one is built on first use and kept for the next ones.
+	"""
+	def __init__(self, fire=None):
+		self.fire = fire
+
+	def get_fire(self, _busnum):
+		if (self.fire is None) or (self.fire.i2c_bus_num != _busnum):
+			self.fire = Fire(_busnum)
+		return self.fire
+
+	""" 
+		engines, access (2 for 64B, 4 for 128B), spacing (hex string) and read can be given
+		so the procedure runs unattended (fleet mode). Those left to None are asked for.
+		Returns False when the procedure can't run (bad port selection), True otherwise.
+	"""
+	def fbist(self, _busnum, _ddimm, engines=None, access=None, spacing=None, read=None):
+		fire = self.get_fire(_busnum)
 		
 		print("")
 		print("======================================================")
@@ -54,18 +72,18 @@ class Fbist:
 			port_B_active = 1
 		else:
 			print("ERROR: incorrect ddimm selection !!")
-			return
+			return False
 	
 		print("#=============================")
 		print(" Commands configuration for DDIMM located in port", _ddimm)
 
-		number_of_engines_word = input(">> Number of Engines to enable ? (Type 1 to 8): ")
-		number_of_engines = int(number_of_engines_word)
+		if engines is None: engines = input(">> Number of Engines to enable ? (Type 1 to 8): ")
+		number_of_engines = int(engines)
 
-		access_type_word = input(">> Number of Bytes to test access? (Type 2 for 64B and 4 for 128B): ")
-		access_type_int = int(access_type_word)
+		if access is None: access = input(">> Number of Bytes to test access? (Type 2 for 64B and 4 for 128B): ")
+		access_type_int = int(access)
 
-		flit_spacing_word = input(">> Number of cycles between flits (from FF to 0, typical is 0): ")
+		flit_spacing_word = spacing if spacing is not None else input(">> Number of cycles between flits (from FF to 0, typical is 0): ")
 		flit_spacing_int = int(flit_spacing_word, 16)
 		flit_spacing = int(0x0000000000000000 + flit_spacing_int)
 
@@ -126,8 +144,8 @@ class Fbist:
 
 		#==============
 		#READ PROCEDURE
-		read_procedure = input(">> Type 'q' to quit or any key to continue with Read fbist procedure.")
-		if (read_procedure == 'q'): return
+		if read is None: read = input(">> Type 'q' to quit or any key to continue with Read fbist procedure.") != 'q'
+		if not read: return True
 
 		print(">>                                                       ")
 		if (access_type_int == 4):
@@ -175,6 +193,7 @@ class Fbist:
 
 		if (port_A_active): self.fbist_stats_rd(_busnum, "a")
 		if (port_B_active): self.fbist_stats_rd(_busnum, "b")
+		return True
 
 	steps_fbist_writes = ("steps_fbist_writes",
 		'W' ,0x010200000000002C,0x0000000000000000,"FBIST POOL 0 ENGINE 0 ADDRESS START 32b LOW",
@@ -243,7 +262,7 @@ class Fbist:
 
 
 	def fbist_stats_wr(self, _busnum, _ddimm):
-		fire = Fire(_busnum)
+		fire = self.get_fire(_busnum)
 
 		logging.info(_ddimm)
 		print("-------------------------")
@@ -385,7 +404,7 @@ class Fbist:
 		print("-------------------------")
 
 	def fbist_stats_rd(self, _busnum, _ddimm):
-		fire = Fire(_busnum)
+		fire = self.get_fire(_busnum)
 
 		logging.info(_ddimm)
 		print("-------------------------")
@@ -548,37 +567,17 @@ class Fbist:
 		print("-------------------------")
 
 	def reg_ops(self, reg_list, _busnum, _ddimm):
-		fire = Fire(_busnum)
+		fire = self.get_fire(_busnum)
 		logging.info(_ddimm)
 		logging.info(reg_list[0])
-		if _ddimm == "a":
-			ddimm_add_adj=0x00000000
-		elif _ddimm == "b":
-			ddimm_add_adj=0x00000400
-		else: 
-			print("ERROR: incorrect ddimm selection !!")
-		logging.info("{:d}".format(len(reg_list)//4) + " registers to be R/W:")
-		
-		for i in range(1, len(reg_list), 4):
-			""" Address is computed with port, based on port0 address """
-			reg=reg_list[i+1]+(ddimm_add_adj<<32)
-			logging.info("0x{:0>16x}".format(reg))
-			#print(reg_list[i+3])
-			if reg_list[i] == 'R':
-				if  (type(reg_list[i+2])  == str):
-					#print("READ  REG: " + "0x{:0>16x}".format(reg) + " .  .  .  .  .  .  .  .  " + " READ: "  + "0x{:0>16x}".format(fire.i2cread(reg)))
-					fire.i2cread(reg)
-				else:
-					#print("READ  REG: " + "0x{:0>16x}".format(reg) + " EXP : " + "0x{:0>16x}".format(reg_list[i+2]) + " READ: "  + "0x{:0>16x}".format(fire.i2cread(reg)))
-					fire.i2cread(reg)
-					if ("0x{:0>16x}".format(reg_list[i+2]) != "0x{:0>16x}".format(fire.i2cread(reg))):
-						print("!!! WARNING: READ DATA Not expected !!!!")
-						print("READ  REG: " + "0x{:0>16x}".format(reg) + " EXP : " + \
-						      "0x{:0>16x}".format(reg_list[i+2]) + " READ: "  + \
-						      "0x{:0>16x}".format(fire.i2cread(reg)))
-			else:
-				#print("WRITE REG: " + "0x{:0>16x}".format(reg) + " DATA: " + "0x{:0>16x}".format(reg_list[i+2]));fire.i2cwrite(reg, reg_list[i+2])
-				fire.i2cwrite(reg, reg_list[i+2])
+		seq = compile_steps(reg_list, _ddimm)
+		if seq is None: return None
+		logging.info("%d registers to be R/W, verify policy %s:", len(seq), fire.verifier.policy)
+
+		# same path as Fire.reg_ops: writes verified as the session policy of the Fire says
+		result = fire.run_sequence(seq)
+		fire.print_mismatches(result)
+		return result
 
 if __name__ == "__main__":
 	# logging.basicConfig(level=logging.INFO)
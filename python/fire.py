@@ -20,10 +20,155 @@
 #
 
 from re import I
+from collections import namedtuple
 from constants import *
 from functions import *
+from regseq import *
+from polling import wait_until, POLL_FIRE_LINK
+from bustrace import *
 from time import sleep
 
+FireMismatch = namedtuple('FireMismatch', ['index', 'op', 'reg_addr', 'expected', 'read', 'label'])
+
+##################################################################################
+#    Result of a FireBatch: one value per operation (read value, or verify       #
+#    read-back for writes, None when not read) and the list of mismatches.       #
+#    Only read mismatches fail a batch, write read-backs are informative.        #
+##################################################################################
+class FireBatchResult:
+	def __init__(self, seq, policy=VERIFY_ALWAYS):
+		self.seq = seq
+		self.policy = policy    # verify policy the writes were run with
+		self.values = [None] * len(seq)
+		self.mismatches = []
+		self.transfers = 0      # number of I2C_RDWR ioctls used
+		self.messages = 0       # number of I2C messages sent
+
+	def ok(self):
+		return len(self.read_mismatches()) == 0
+
+	def read_mismatches(self):
+		return [m for m in self.mismatches if m.op == 'R']
+
+	def write_mismatches(self):
+		return [m for m in self.mismatches if m.op == 'W']
+
+##################################################################################
+#    Collects Fire register writes and reads and sends them packed in            #
+#    multi-message I2C_RDWR transfers (up to I2C_RDWR_MAX_MSGS per ioctl).       #
+#    A read is a (8 bytes address write, 8 bytes read) pair of messages, a       #
+#    write is one 16 bytes message, followed by a read pair when verified.       #
+#    Writes are verified as the WriteVerifier of the Fire says (session policy   #
+#    unless one is given): read back in the batch, or deferred to flush_verify.  #
+#    Operations are stored in a RegSequence, so compiled step tables can be      #
+#    added as they are with extend().                                            #
+#                                                                                #
+#        with fire.batch() as batch:                                             #
+#            batch.write(reg, data)                                              #
+#            batch.read(reg, expect)                                             #
+#        print(batch.result.mismatches)                                          #
+##################################################################################
+class FireBatch:
+	def __init__(self, fire, policy=None, name=""):
+		self.fire = fire
+		self.policy = policy    # verify policy of the writes, session one of the Fire if None
+		self.verify = False     # writes read back in the batch, selected at submit
+		self.seq = RegSequence(name)
+		self.result = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if exc_type is None: self.submit()
+		return False
+
+	""" Queue a read. With expect=None (or a string such as 'XXXX') the value is not checked. """
+	def read(self, reg_addr, expect=None, mask=MASK_ALL, label=""):
+		if (expect is None) or (type(expect) == str): expect, mask = 0, MASK_NONE
+		self.seq.append(OP_READ, reg_addr, expect, mask, label)
+
+	""" Queue a write, verified as the policy of this batch says. """
+	def write(self, reg_addr, data, label=""):
+		self.seq.append(OP_WRITE, reg_addr, data, MASK_ALL, label)
+
+	""" Queue all the steps of a compiled RegSequence. """
+	def extend(self, seq):
+		self.seq.extend(seq)
+
+	def op_messages(self, index):
+		reg_addr = self.seq.addrs[index]
+		addr = list(reg_addr.to_bytes(8, 'big'))
+		msgs = []
+		if self.seq.ops[index] == OP_WRITE:
+			msgs.append(smbus.i2c_msg.write(FIRE_I2C_ADDR, addr + list(self.seq.values[index].to_bytes(8, 'big'))))
+			if not self.verify: return msgs, None
+		msgs.append(smbus.i2c_msg.write(FIRE_I2C_ADDR, addr))
+		msg_r = smbus.i2c_msg.read(FIRE_I2C_ADDR, 8)
+		msgs.append(msg_r)
+		return msgs, msg_r
+
+	""" Send all queued operations and return a FireBatchResult. """
+	def submit(self):
+		if OP_WRITE in self.seq.ops: self.policy, self.verify = self.fire.verifier.select(self.policy)
+		result = FireBatchResult(self.seq, self.policy)
+		i = 0
+		while i < len(self.seq):
+			# pack as many complete operations as possible in one ioctl
+			msgs, reads, j = [], [], i
+			while j < len(self.seq):
+				op_msgs, msg_r = self.op_messages(j)
+				if msgs and len(msgs) + len(op_msgs) > I2C_RDWR_MAX_MSGS: break
+				msgs += op_msgs
+				reads.append((j, msg_r))
+				j += 1
+			try:
+				self.fire.i2c_bus.i2c_rdwr(*msgs)
+			except OSError:
+				logging.info("FIRE: batched I2C_RDWR rejected by the adapter, running remaining operations one by one")
+				self.submit_one_by_one(result, i)
+				break
+			result.transfers += 1
+			result.messages += len(msgs)
+			for index, msg_r in reads:
+				if msg_r is not None:
+					self.store(result, index, int.from_bytes(bytes(list(msg_r)), 'big'))
+				else:
+					self.not_read_back(self.seq.addrs[index], self.seq.values[index])
+			i = j
+		self.result = result
+		return result
+
+	def submit_one_by_one(self, result, start):
+		for index in range(start, len(self.seq)):
+			reg_addr = self.seq.addrs[index]
+			if self.seq.ops[index] == OP_WRITE:
+				data = self.seq.values[index]
+				msg = smbus.i2c_msg.write(FIRE_I2C_ADDR, list(reg_addr.to_bytes(8, 'big')) + list(data.to_bytes(8, 'big')))
+				self.fire.i2c_bus.i2c_rdwr(msg)
+				result.transfers += 1
+				result.messages += 1
+				if not self.verify:
+					self.not_read_back(reg_addr, data)
+					continue
+			self.store(result, index, self.fire.i2cread(reg_addr))
+			result.transfers += 1
+			result.messages += 2
+
+	def not_read_back(self, reg_addr, data):
+		self.fire.shadow_store(reg_addr, data)
+		if self.policy == VERIFY_DEFERRED: self.fire.verifier.defer(reg_addr, data)
+
+	def store(self, result, index, odata):
+		op, reg_addr, value, mask = self.seq.ops[index], self.seq.addrs[index], self.seq.values[index], self.seq.masks[index]
+		result.values[index] = odata
+		if op == OP_WRITE: tracer.record(DEV_FIRE, TR_WRITE, reg_addr, value)
+		tracer.record(DEV_FIRE, TR_READ, reg_addr, odata)
+		self.fire.check_read_error(odata)
+		self.fire.shadow_store(reg_addr, odata)
+		if (odata & mask) != (value & mask):
+			result.mismatches.append(FireMismatch(index, 'W' if op == OP_WRITE else 'R', reg_addr, value, odata, self.seq.labels[index]))
+
 ##################################################################################
 #    This class represents the Fire design that generates traffic and checks     #
 #    results in regard to OCMBs.                                                 #
@@ -35,10 +180,16 @@ class Fire:
 
 	""" 
 		Initialize i2c bus and get the ID and frequency of Fire 
+		The bus handle is taken from the shared pool unless one is provided.
 	"""
-	def __init__(self, i2c_bus_num, freq=333):
+	def __init__(self, i2c_bus_num, freq=333, i2c_bus=None, shadow=False, verify=VERIFY_ALWAYS):
 		self.i2c_bus_num = i2c_bus_num
-		self.i2c_bus = init_bus(i2c_bus_num)
+		self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
+		self.verifier = WriteVerifier("FIRE", verify)
+		self.combined_read = True   # cleared if the adapter can't do write+read in one I2C_RDWR
+		self.shadow = {} if shadow else None   # last value read or written per address (see cached_read)
+		self.shadow_hits = 0
+		self.shadow_misses = 0
 		self.id, self.is_dirty, self.freq_def = self.get_id()
 		#print(self.freq_def)
 		#logging.info('{:#03x} {}'.format(self.freq_def))
@@ -60,32 +211,96 @@ class Fire:
 		Detect if Fire's i2c address is visible on the bus 
 	"""
 	def detect(self):
-		alive_addresses = get_alive_addresses(self.i2c_bus)
+		alive_addresses = get_alive_addresses(self.i2c_bus, [FIRE_I2C_ADDR])
 		return FIRE_I2C_ADDR in alive_addresses
 	
 	"""
 		Read a Fire's register value.
 		The operation will write a 8 bytes value representing the register address to read its value, 
-		followed by 8 reads of 1 byte each that form the register content.
+		followed by a read of 8 bytes that form the register content.
 		Both the I2C operations are done without providing any register addresses. 
 		The hardware automatically puts the result in a FIFO tied directly to I2C bus.
+		Write and read are sent as a single I2C_RDWR transfer (one ioctl, repeated start).
+		If the adapter rejects it, we fall back to the address write followed by 8 read_byte.
 	"""
 	def i2cread(self, reg_addr):
 		#if ((reg_addr & 0xFFFFFFFFFFFFFC0) == 0x100000000000000) & (reg_addr % 4 != 0):
 			#print("FML address should by multiple of 4"); exit()
 
-		msg = smbus.i2c_msg.write(FIRE_I2C_ADDR, list(reg_addr.to_bytes(8, 'big')))
-		self.i2c_bus.i2c_rdwr(msg)
-		
-		block = []
-		for i in range(8):
-			d = self.i2c_bus.read_byte(FIRE_I2C_ADDR)
-			block.append(d)
+		block = None
+		if self.combined_read:
+			msg_w = smbus.i2c_msg.write(FIRE_I2C_ADDR, list(reg_addr.to_bytes(8, 'big')))
+			msg_r = smbus.i2c_msg.read(FIRE_I2C_ADDR, 8)
+			try:
+				self.i2c_bus.i2c_rdwr(msg_w, msg_r)
+				block = list(msg_r)
+			except OSError:
+				logging.info("FIRE: combined write+read not supported by the adapter, using byte reads")
+				self.combined_read = False
+
+		if block is None:
+			msg = smbus.i2c_msg.write(FIRE_I2C_ADDR, list(reg_addr.to_bytes(8, 'big')))
+			self.i2c_bus.i2c_rdwr(msg)
+			
+			block = []
+			for i in range(8):
+				d = self.i2c_bus.read_byte(FIRE_I2C_ADDR)
+				block.append(d)
 
 		# format result
 		
-		odata = int(''.join(format(val, '02x') for val in block), 16)
-		logging.info("FIRE: Reading {} from {}".format(hex(odata), hex(reg_addr)))
+		odata = int.from_bytes(bytes(block), 'big')
+		tracer.record(DEV_FIRE, TR_READ, reg_addr, odata)
+		if (odata >> 8) == 0xdec0de: self.check_read_error(odata)
+		self.shadow_store(reg_addr, odata)
+
+		return odata
+
+	"""
+		Shadow cache: when enabled, the last value read or written in each register is kept,
+		so read-modify-write helpers can skip the read with cached_read().
+		Volatile registers (status, detect, FBIST, Explorer side) are never cached.
+	"""
+	def is_volatile(self, reg_addr):
+		if reg_addr in FIRE_VOLATILE_REGS: return True
+		for base, size in FIRE_VOLATILE_RANGES:
+			if base <= reg_addr < base + size: return True
+		return False
+
+	""" Registers diff_apply always writes (status), the doorbells aside """
+	def diff_always(self, reg_addr):
+		if reg_addr in FIRE_DIFF_ALWAYS_REGS: return True
+		for base, size in FIRE_DIFF_ALWAYS_RANGES:
+			if base <= reg_addr < base + size: return True
+		return False
+
+	def shadow_store(self, reg_addr, odata):
+		if self.shadow is None or self.is_volatile(reg_addr): return
+		if (odata >> 8) == 0xdec0de: self.shadow.pop(reg_addr, None)   # access error, not a register value
+		else: self.shadow[reg_addr] = odata
+
+	def cached_read(self, reg_addr):
+		if self.shadow is not None and reg_addr in self.shadow:
+			self.shadow_hits += 1
+			tracer.record(DEV_FIRE, TR_SHADOW, reg_addr, self.shadow[reg_addr])
+			return self.shadow[reg_addr]
+		if self.shadow is not None: self.shadow_misses += 1
+		return self.i2cread(reg_addr)
+
+	""" Forget the cached value of a register, or of all registers (after a reset or a retrain). """
+	def invalidate(self, reg_addr=None):
+		if self.shadow is None: return
+		if reg_addr is None: self.shadow.clear()
+		else: self.shadow.pop(reg_addr, None)
+
+	def shadow_stats(self):
+		return "Fire shadow cache: {} hits, {} misses, {} registers".format(
+			self.shadow_hits, self.shadow_misses, len(self.shadow) if self.shadow is not None else 0)
+
+	"""
+		Fire returns 0xdec0deXX codes instead of data when the access could not be done.
+	"""
+	def check_read_error(self, odata):
 		if odata   == 0xdec0de00:
 			print("WARNING !! Fire address has not been set yet by hardware")
 		elif odata == 0xdec0de0b:
@@ -94,25 +309,76 @@ class Fire:
 			print("ERROR !! Fire address is out of AXI range")
 		elif odata == 0xdec0deff:
 			print("WARNING !! Fire address is not modulo 4 aligned")
-		
+		else: return
+		tracer.error("FIRE: access error {:#x}".format(odata))
 
-		return odata
+	"""
+		Start a batch of register operations sent as multi-message I2C_RDWR transfers.
+		Can be used as a context (submitted at the end of the block) or submitted explicitly.
+		Writes are verified with the given policy, the session one if None.
+	"""
+	def batch(self, policy=None, name=""):
+		return FireBatch(self, policy, name)
+
+	"""
+		Run a compiled RegSequence (see regseq.compile_steps) in batched transfers.
+		Every step is a single bus access: the value of a read is both logged and compared.
+	"""
+	def run_sequence(self, seq, policy=None):
+		batch = self.batch(policy, seq.name)
+		batch.extend(seq)
+		return batch.submit()
+
+	"""
+		Diff-apply a compiled RegSequence: bulk-read every register it writes, then only
+		issue the writes that change the hardware state. Status registers are always accessed,
+		dropped reads are checked against the known content and reported in the FireBatchResult.
+		Returns (FireBatchResult, DiffReport).
+	"""
+	def diff_apply(self, seq, policy=None):
+		targets = write_targets(seq, self.diff_always)
+		with self.batch(name=seq.name + "_diff") as batch:
+			for reg_addr in targets: batch.read(reg_addr)
+		current = dict(zip(targets, batch.result.values))
+		diff_seq, report = diff_sequence(seq, current, self.diff_always)
+		logging.info(str(report))
+		result = self.run_sequence(diff_seq, policy)
+		for step, reg_addr, expected, read, label in report.mismatches:
+			result.mismatches.append(FireMismatch(step, 'R', reg_addr, expected, read, label))
+		return result, report
 	
 	"""
 		Write data in a Fire's register.
 		The operation will write a 16 bytes value representing the register address
 		to modify its value (8 bytes) + the data to write (8 bytes).
-		It also checks if the write operation has succeeded or not.
+		It also checks if the write operation has succeeded or not, depending on the
+		verify policy (session one unless given). Returns True when not read back now.
 		"""
-	def i2cwrite(self, reg_addr, data):
+	def i2cwrite(self, reg_addr, data, verify=None):
 		new_data = list(reg_addr.to_bytes(8, 'big')) + list(data.to_bytes(8, 'big'))
 
 		msg = smbus.i2c_msg.write(FIRE_I2C_ADDR, new_data)
 		self.i2c_bus.i2c_rdwr(msg)
-		logging.info("Fire Writing {:#010x} into {:#010x}".format(data, reg_addr))
+		policy, read_back = self.verifier.select(verify)
+		tracer.record(DEV_FIRE, TR_WRITE, reg_addr, data)
 		
+		if policy == VERIFY_DEFERRED: self.verifier.defer(reg_addr, data)
+		if not read_back:
+			self.shadow_store(reg_addr, data)
+			return True
 		r_data = self.i2cread(reg_addr)
 		return (r_data == data)
+
+	"""
+		Read back the writes done with the deferred verify policy, in one batch.
+		Returns the list of (address, written, read) that don't match.
+	"""
+	def flush_verify(self):
+		def read_many(regs):
+			with self.batch(name="deferred_verify") as batch:
+				for reg_addr in regs: batch.read(reg_addr)
+			return batch.result.values
+		return self.verifier.flush(read_many)
 	
 	"""
 		Get the ID of FIRE and check the Dirty bit. 
@@ -127,17 +393,33 @@ class Fire:
 		logging.info('{:#010x} {}'.format(id, "Dirty" if is_dirty else ""))
 		return id, is_dirty, freq_def
 
+	"""
+		Read which DDIMM ports are populated from the DDIMM detect register (one access).
+		Returns {port: True/False}, or None when the register tells nothing usable
+		(access error, or no port seen at all as with Fire versions without it).
+	"""
+	def ddimm_present(self):
+		val = self.i2cread(FIRE_FML_DDMIMM_DETECT_REG)
+		if (val >> 8) == 0xdec0de: return None
+		present = {port: bool(val & bit) for port, bit in FIRE_FML_DDIMM_DETECT_BITS.items()}
+		if not any(present.values()): return None
+		logging.info("FIRE: DDIMM detect {:#x}: ports {} populated".format(val, [p for p in present if present[p]]))
+		return present
+
 	"""
 		Make provided DDIMM(s) enter Reset State.
 		RESET STATE = ON
 		"""
 	def set_ddimm_on_reset(self, ddimm):
-		val = self.i2cread(FIRE_FML_RESET_CONTROL_REG)
+		val = self.cached_read(FIRE_FML_RESET_CONTROL_REG)
 		if 'a' in ddimm.lower(): val = val & ~FIRE_FML_DDIMMA_RESET_BIT
 		if 'b' in ddimm.lower(): val = val & ~FIRE_FML_DDIMMB_RESET_BIT
 		if 'c' in ddimm.lower(): val = val & ~FIRE_FML_DDIMMC_RESET_BIT
 		if 'd' in ddimm.lower(): val = val & ~FIRE_FML_DDIMMD_RESET_BIT
 		if 'w' in ddimm.lower(): val = val & ~FIRE_FML_DDIMMW_RESET_BIT
+		# the DDIMM host side registers are reset too: only the reset control value stays valid
+		self.invalidate()
+		topology.invalidate(self.i2c_bus_num)
 		self.i2cwrite(FIRE_FML_RESET_CONTROL_REG, val)
 	
 	"""
@@ -145,12 +427,14 @@ class Fire:
 		RESET STATE = OFF
 		"""
 	def set_ddimm_off_reset(self, ddimm):
-		val = self.i2cread(FIRE_FML_RESET_CONTROL_REG)
+		val = self.cached_read(FIRE_FML_RESET_CONTROL_REG)
 		if 'a' in ddimm.lower(): val = val | FIRE_FML_DDIMMA_RESET_BIT
 		if 'b' in ddimm.lower(): val = val | FIRE_FML_DDIMMB_RESET_BIT
 		if 'c' in ddimm.lower(): val = val | FIRE_FML_DDIMMC_RESET_BIT
 		if 'd' in ddimm.lower(): val = val | FIRE_FML_DDIMMD_RESET_BIT
 		if 'w' in ddimm.lower(): val = val | FIRE_FML_DDIMMW_RESET_BIT
+		self.invalidate()
+		topology.invalidate(self.i2c_bus_num)
 		self.i2cwrite(FIRE_FML_RESET_CONTROL_REG, val)
 
 	""" 
@@ -180,34 +464,45 @@ class Fire:
 		"""
 	def check_sync(self, ddimm, verbose=0):
 		# On Host side, we check bit 3 link up and bit 2:0 State Machine = 111
-		card = scan_bus()
+		card = scan_bus(self.i2c_bus_num)
 		for i in range (0, len(ddimm)):
 			if ddimm[i].lower() == 'a': reg = FIRE_DDIMMA_HOST_CONF_STATUS_REG   #0x0104000000000020
 			elif ddimm[i].lower() == 'b': reg = FIRE_DDIMMB_HOST_CONF_STATUS_REG #0x0104040000000020
 			
-			synch_reg = self.i2cread(reg)
-
-			c = 0
-			while((hex(synch_reg & 0xF) != "0xf") & (c < 100)):  # waiting for or checking if synchronization
-				sleep(0.01)
-				if verbose:print(".",end="")
-				synch_reg = self.i2cread(reg)
-				c = c+1
-			if hex(self.i2cread(reg) & 0xF) == "0xf":
-				if verbose:
-					print("\nFIRE's PORT {} sync Reg {}: {}".format(ddimm[i].upper(),hex(reg),hex(synch_reg)))
-					print("Host is synchronized with", card, "on Port {}".format(ddimm[i].upper()))
-					print("> Suggested next command -> python3 omi.py ddimmcfg -d <a/b>")
-				return 1
-			else :
-				if verbose:
-					print("\nFIRE's", card, "on PORT {} sync Reg {}: {}".format(ddimm[i].upper(),hex(reg),hex(synch_reg)))
-					print("===WARNING=== DDIMM{} is NOT in sync".format(ddimm[i].upper()))
-					print("              It is recommended to restart the full training sequence")
-				return 0
+			# waiting for or checking if synchronization
+			in_sync, synch_reg = wait_until(lambda: self.i2cread(reg), 0xF, 0xF, POLL_FIRE_LINK_TIMEOUT, POLL_FIRE_LINK)
+			return self.report_sync(ddimm[i], card, reg, synch_reg, verbose)
 
 			#print(hex(ice.i2c_double_read(0x08012424)))
 
+	"""
+		Print the sync status of a port from the value already read in its host conf
+		status register reg (no bus access). Returns 1 when in sync, 0 otherwise.
+		"""
+	def report_sync(self, ddimm, card, reg, synch_reg, verbose=0):
+		if (synch_reg & 0xF) == 0xF:
+			if verbose:
+				print("\nFIRE's PORT {} sync Reg {}: {}".format(ddimm.upper(),hex(reg),hex(synch_reg)))
+				print("Host is synchronized with", card, "on Port {}".format(ddimm.upper()))
+				print("> Suggested next command -> python3 omi.py ddimmcfg -d <a/b>")
+			return 1
+		else :
+			if verbose:
+				print("\nFIRE's", card, "on PORT {} sync Reg {}: {}".format(ddimm.upper(),hex(reg),hex(synch_reg)))
+				print("===WARNING=== DDIMM{} is NOT in sync".format(ddimm.upper()))
+				print("              It is recommended to restart the full training sequence")
+			return 0
+
+	"""
+		Single read version of check_sync: True if the OMI link of the port is up
+		(bit 3 link up and bits 2:0 state machine = 111 in the host conf status).
+		"""
+	def link_up(self, ddimm):
+		if ddimm.lower() == 'a': reg = FIRE_DDIMMA_HOST_CONF_STATUS_REG
+		elif ddimm.lower() == 'b': reg = FIRE_DDIMMB_HOST_CONF_STATUS_REG
+		else: return False
+		return (self.i2cread(reg) & 0xF) == 0xF
+
 	def retrain(self, ddimm, verbose=0):
 		for i in range (0, len(ddimm)):
 			if ddimm[i].lower() == 'a': 
@@ -217,8 +512,10 @@ class Fire:
 				reg = FIRE_DDIMMB_OPENCAPI_DL_CONTROL
 				check_reg = FIRE_DDIMMB_HOST_CONF_STATUS_REG
 
-			val = self.i2cread(reg)
+			val = self.cached_read(reg)
 			self.i2cwrite(reg, (val | (1 << 24)))
+			# the retrain bit is handled by the hardware: cached values of the port are stale
+			self.invalidate()
 
 			# use the check_sync to benefit from State machine tests
 			self.check_sync(ddimm[i],1)
@@ -341,12 +638,12 @@ class Fire:
 		'R',	0x30010001400843B0	,0x0000000000000000	,"",
 		'R',	0x30010001400843B8	,0x0000000000000000	,"",
 		'R',	0x3001000140092030	,0x0000000000000000	,"",
-		'R',	0x3001000140092038	,0x0000000000000000	,"",
+		'R',	0x3001000140092038	,0x8000000000000000	,"set by Explorer.sync",
 		'R',	0x3001000140200080	,0x0000000000000000	,"",
-		'R',	0x3001000140200088	,0x0000000000000000	,"",
+		'R',	0x3001000140200088	,0xFFFFFFFFFFFFFFFF	,"set by Explorer.sync",
 		'R',	0x3001000140094030	,0x0000000000000000	,"",
-		'R',	0x3001000140094038	,0x0000000000000000	,"",
-		'R',	0x30010001402000B8	,0x0000000000000000	,"",
+		'R',	0x3001000140094038	,0x0560000000000000	,"set by Explorer.sync",
+		'R',	0x30010001402000B8	,0xF800000000000000	,"set by Explorer.sync",
 		'W',	0x30010001402000B8	,0x0000000000000000	,"",
 		'W',	0x30010001400843B0	,0x0000000000000000	,"",
 		'W',	0x30010001400843B8	,0x2200000000000000	,"",
@@ -364,7 +661,7 @@ class Fire:
 		'W',	0x30010001400920A0	,0x0080000000000062	,"",
 		'R',	0x30010001400920A8	,0x0000000000000000	,"",
 		'W',	0x30010001400920A8	,0x0000000002000000	,"",
-		'R',	0x3001000140092068	,0x0000000000000000	,"",
+		'R',	0x3001000140092068	,0x0000000000000123	,"",
 		'W',	0x3001000140092068	,0x0200000000000000	,"",
 
 		'W',	0x010400000000000C	,0x00000800,"",
@@ -793,28 +1090,25 @@ class Fire:
 	def reg_ops(self, reg_list, _ddimm, _vendor, _size):
 		logging.info(_ddimm)
 		logging.info(reg_list[0])
-		if _ddimm == "a":
-			ddimm_add_adj=0x00000000
-		elif _ddimm == "b":
-			ddimm_add_adj=0x00000400
-		else: print("ERROR: incorrect ddimm selection !!")
-		logging.info("{:d}".format(len(reg_list)//4) + " registers to be R/W:")
-		
-		for i in range(1, len(reg_list), 4):
-			""" Address is computed with port, based on port0 address """
-			reg=reg_list[i+1]+(ddimm_add_adj<<32)
-			logging.info("0x{:0>16x}".format(reg))
-			
-			if reg_list[i] == 'R':
-				if  (type(reg_list[i+2])  == str):
-					logging.info("FIRE: READ  REG: " + "0x{:0>16x}".format(reg) + " No expectation")
-				else:
-					logging.info("FIRE: READ  REG: " + "0x{:0>16x}".format(reg) + " EXP : " + "0x{:0>16x}".format(reg_list[i+2]) + " READ: "  + "0x{:0>16x}".format(self.i2cread(reg)))
-					if ("0x{:0>16x}".format(reg_list[i+2]) != "0x{:0>16x}".format(self.i2cread(reg))):
-						print("!!! WARNING: FIRE: READ DATA Not expected !!!!")
-						print("for Register 0x{:0>16x}".format(reg))
-			else:
-				logging.info("FIRE: WRITE REG: " + "0x{:0>16x}".format(reg) + " DATA: " + "0x{:0>16x}".format(reg_list[i+2]));self.i2cwrite(reg, reg_list[i+2])
+		seq = compile_steps(reg_list, _ddimm)
+		if seq is None: return None
+		logging.info("%d registers to be R/W, verify policy %s:", len(seq), self.verifier.policy)
+
+		# the whole table is sent in batched I2C_RDWR transfers, the writes are read back or not as
+		# the session verify policy says (deferred: at flush_verify), mismatches are reported at the end
+		result = self.run_sequence(seq)
+		self.print_mismatches(result)
+		return result
+
+	""" Write read-backs are only reported when every write was verified (VERIFY_ALWAYS) """
+	def print_mismatches(self, result):
+		for m in result.read_mismatches():
+			print("!!! WARNING: FIRE: READ DATA Not expected !!!!")
+			print("for Register 0x{:0>16x}".format(m.reg_addr))
+		if result.policy != VERIFY_ALWAYS: return
+		for m in result.write_mismatches():
+			print("!!! WARNING: FIRE: WRITE DATA Not read back !!!!")
+			print("for Register 0x{:0>16x}: wrote 0x{:0>16x}, read 0x{:0>16x}".format(m.reg_addr, m.expected, m.read))
 
 if __name__ == "__main__":
 	# logging.basicConfig(level=logging.INFO)
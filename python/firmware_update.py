@@ -24,12 +24,14 @@
 # Assumes Fire is set at 333MHz and I2C bus is 3
 
 import resource
+import atexit
 import os
 from time import sleep
 import binascii
 import array
 import struct
 from crc32 import crc32_array
+from polling import wait_until, POLL_FW_READY, POLL_FW_COMMIT
 from fire import *
 from explorer import *
 from datetime import datetime
@@ -56,17 +58,23 @@ for i in range(16):
 # Rename the follwing variable with the relaese name eg : 
 #firmware_file = "CL444714.bin"
 firmware_file = "<release>.bin"
-#Uncomment the following lines if you don't want to log (see next print_to_log() function)
+#Comment the following line if you don't want to log (the whole register access trace is streamed to it)
 log_file = "./firmware_update.log"
 #comparison_log_file="./excel_compa.log"
+compa_log = None
 
-def print_to_log(data_to_print):       # to log sequence of 
-    try:
-        log_file
-        log.write(data_to_print)
-        log.write("\n")
-    except:
-        pass # print(data_to_print)
+def print_to_log(data_to_print):       # marks a step in the register access trace
+    tracer.mark(data_to_print)
+
+log_out = None     # log file open during an update
+
+def write_log():
+    """ Write the end of the register access trace streamed to the log, and close it """
+    global log_out
+    if log_out is None: return
+    tracer.end_stream()
+    log_out.close()
+    log_out = None
 
 # the following will split the 64b word in 2 and fill the data_buff accordingly
 def split_word_fill_data_buff(word):
@@ -76,11 +84,9 @@ def split_word_fill_data_buff(word):
     data = struct.unpack('<Q', word)   # extract in little endian mode (<)
     Ldata = data[0] & 0xFFFFFFFF
     Hdata = data[0]>>32
-    Ldata_txt = ("{:08x} ".format(Ldata))
-    Hdata_txt = ("{:08x} ".format(Hdata))
     #Contribution to the crc32
-    data_buff[data_index]   = "0x"+Ldata_txt  # storing the data 2 by 2 for data buffer crc32 calc
-    data_buff[data_index+1] = "0x"+Hdata_txt
+    data_buff[data_index]   = Ldata  # storing the data 2 by 2 for data buffer crc32 calc
+    data_buff[data_index+1] = Hdata
     #print("Ldata is: {:08X}".format(Ldata))   # {:#08X} => 0xbff72a5e | {:08X} => bff72a5e
     #print("Hdata is: {:08X}".format(Hdata))
 
@@ -91,35 +97,25 @@ def send_data_to_explorer():
     global Ldata
     global Hdata
 
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         write_str = "        'W' , 0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Ldata)+" ,")
         compa_log.write(write_str)
         compa_log.write("\n")
-    except: pass
 
-    # writing 2 data burst
-    print_to_log("W 0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Ldata)))
-    write_data = "0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Ldata))
-    write_data_int=int(write_data, 0)    # converts hexa str into an int with autobase(0) 
-    explorer.i2c_simple_write(write_data_int)
+    # writing 2 data burst: 0x0508A102FF<addr_index><Ldata>
+    explorer.i2c_simple_write((0x0508A102FF << 40) | (addr_index << 32) | Ldata)
     #print(explorer.i2c_simple_read(write_data_int))
 
     addr_index = addr_index + 4  # preparing next addr_index
 
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         write_str = "        'W' , 0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Hdata)+" ,")
         compa_log.write(write_str)
         compa_log.write("\n")    
-    except: pass
 
-    print_to_log("W 0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Hdata)))
-    write_data = "0x0508A102FF" + "{:02X}".format(addr_index) + ("{:08X}".format(Hdata))
-    write_data_int=int(write_data, 0)    # converts hexa str into an int with autobase(0)
-    explorer.i2c_simple_write(write_data_int)
+    explorer.i2c_simple_write((0x0508A102FF << 40) | (addr_index << 32) | Hdata)
 
     addr_index = addr_index + 4  # preparing next addr addr_index
 
@@ -188,115 +184,85 @@ def send_command_burst(commit):
     cmd_buff[15] = "{:08X}".format(crc32_cmd)  # suppressing the 0x
 
     for cmd in cmd_buff:
-        try:
-            compa_log
+        if compa_log is not None:
             # to compare with excel cleaned cronus log
             cmd_str = ("        'W' , 0x0508A103FF" + "{:02X}".format(addr_index) + cmd  + " ,")
             compa_log.write(cmd_str)
             compa_log.write("\n")
-        except: pass
 
-        print_to_log("W 0x0508A103FF" + "{:02X}".format(addr_index) + cmd)
-        cmd = "0x0508A103FF" + "{:02X}".format(addr_index) + cmd
-        cmd_int=int(cmd, 0)    # converts hexa str into an int with autobase(0)
-        explorer.i2c_simple_write(cmd_int)
+        # 0x0508A103FF<addr_index><cmd>
+        explorer.i2c_simple_write((0x0508A103FF << 40) | (addr_index << 32) | int(cmd, 16))
 
         addr_index = addr_index + 4
 
 def clr_inbound_doorbell():
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         db_str = "        'W' , 0x0508A808473880000000 ,\n        'W' , 0x0508A808473C00000000 ,"
         compa_log.write(db_str)
         compa_log.write("\n")               
-    except: pass
 
-    print_to_log("W 0x0508A808473880000000")
     explorer.i2c_simple_write(0x0508A808473880000000)
-    print_to_log("W 0x0508A808473C00000000")
     explorer.i2c_simple_write(0x0508A808473C00000000)
 
 
 def clr_outbound_doorbell():
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         db_str = "        'W' , 0x0508A000205800000001 ,"
         compa_log.write(db_str)
         compa_log.write("\n")               
-    except: pass
 
-    print_to_log("W 0x0508A000205800000001")
     explorer.i2c_simple_write(0x0508A000205800000001)
 
 def set_inbound_doorbell():
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         str = "        'W' , 0x0508A808473080000000 ,\n        'W' , 0x0508A808473400000000 ,"
         compa_log.write(str)
         compa_log.write("\n")
-    except: pass
 
-    print_to_log("W 0x0508A808473080000000")
     explorer.i2c_simple_write(0x0508A808473080000000)
-    print_to_log("W 0x0508A808473400000000")
     explorer.i2c_simple_write(0x0508A808473400000000)    
 
-def waiting_fw_rdy():
+def waiting_fw_rdy(deadline=POLL_FW_READY_TIMEOUT, policy=POLL_FW_READY):
     explorer.i2c_simple_write(0x0304A0002058);  
     #explorer.i2c_simple_read(0x2);
     explorer.i2c_simple_write(0x0404A0002058);
 
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         str = "        'R' , 0x0404A0002058 ,"
         compa_log.write(str)
         compa_log.write("\n")
-    except: pass
-
-    print_to_log("R 0x0404A0002058")
-
-    fc = 0  # number of failing tests (Failing counter)
-    reg02 = hex(explorer.i2c_simple_read(0x2))
-    print_to_log(reg02)
-    
-    
-    while (reg02 != "0x1"):
-        print_to_log("waiting for response RDY")   ###
-        #preparing next read steps for 0x404A0002058
-        explorer.i2c_simple_write(0x0304A0002058);
-        print_to_log("W 0x0404A0002058")           ####
-        explorer.i2c_simple_write(0x0404A0002058);
-        sleep(0.05);  # allow 10 msec to obtain firmware readyness
-        fc=fc+1;
-        #logging.info(fc);
-        
-        if (fc == 5):
-            print("4 failing tests on 0x4040A0002058 test for 0x1");exit()
-        
-        reg02 = hex(explorer.i2c_simple_read(0x2))
-        print_to_log(reg02)
+
+    reads = [0]
+    def read_reg02():
+        if reads[0] > 0:
+            print_to_log("waiting for response RDY")   ###
+            #preparing next read steps for 0x404A0002058
+            explorer.i2c_simple_write(0x0304A0002058);
+            explorer.i2c_simple_write(0x0404A0002058);
+        reads[0] += 1
+        return explorer.i2c_simple_read(0x2)
+
+    ready, reg02 = wait_until(read_reg02, MASK_ALL, 0x1, deadline, policy)
+    if not ready:
+        print("{} failing tests on 0x4040A0002058 test for 0x1".format(reads[0]))
+        tracer.error("Firmware response not ready");exit(1)
 
 def sanity_check(last):
     explorer.i2c_simple_write(0x0304A103FF20);
-    #print_to_log("0x0304A103FF20")
     #explorer.i2c_simple_read(0x2);
     explorer.i2c_simple_write(0x0404A103FF20);
-    print_to_log("R 0x0404A103FF20")
     ff20_content = explorer.i2c_simple_read(0x2)
 
-    try:
-        compa_log
+    if compa_log is not None:
         # to compare with excel cleaned cronus log
         str = "        'R' , 0x0404A103FF20 ,"
         compa_log.write(str)
         compa_log.write("\n")
-    except: pass
 
-    print_to_log(hex(ff20_content))
     if last==1:
         if ff20_content == 0x4c00:
             print("firmware upload is successful")
@@ -309,157 +275,164 @@ def sanity_check(last):
                 #logging.info("byte 0 of 0x0404A103FF20 is 00")
             else: 
                 print("ERROR : byte 0 of 0x0404A103FF20 is not 00")
-                print_to_log("ERROR : byte 0 of register 0xA103FF20 is not 00")
-                exit()
+                tracer.error("ERROR : byte 0 of register 0xA103FF20 is not 00")
+                exit(1)
 
 # --------------------------#
 # main program starts here
 # --------------------------#
 
-# to use fire and explorer routines
-fire = Fire(3, 333)
-explorer = Explorer(fire.freq, 3)
-
-# datetime object containing current date and time
-now = datetime.now()
-# dd/mm/YY H:M:S
-dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-print("date and time =", dt_string)	
-
-if firmware_file == "<release>.bin":
-    print("Check https://github.com/open-power/ocmb-explorer-fw/releases")
-    print("to get latest DDIMM EXPLORER firmware")
-    print("and update variable firmware_file = \"<release>.bin\" accordingly")
-    exit(1)
-
-try:
-    log_file
-    log      = open(log_file, "w")           # Makes sure the file is clean at startup
-    log.close
-    log      = open(log_file, "a")           # will append the prints
-    log.write("OMI DDIMM Firmware update log\n" + dt_string + "\nFile used: " + firmware_file)        # time stamp
-except: pass
-
-try:
-    comparison_log_file
-    compa_log      = open(comparison_log_file, "w")           # Makes sure the file is clean at startup
-    compa_log.close
-    compa_log      = open(comparison_log_file, "a")           # will append the prints
-except: pass
+""" 
+    Upload firmware_file in the Explorer of the DDIMM (path already open on busnum),
+    then commit it. The upload state is reset first, so it can be called several times.
+    log=False leaves the log files alone.
+"""
+def update(firmware_file, busnum=3, freq=333, log=True):
+    global fire, explorer, W64, padding, addr_index, ID, data_buff_nb, data_index, crc32_data, compa_log, log_out
+
+    # to use fire and explorer routines
+    fire = Fire(busnum, freq)
+    explorer = Explorer(fire.freq, busnum)
+    W64, padding, addr_index, ID, data_buff_nb, data_index = 0, 0, 0, 0x4244, 0x0, 0
+
+    # datetime object containing current date and time
+    now = datetime.now()
+    # dd/mm/YY H:M:S
+    dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+    print("date and time =", dt_string)	
+
+    if log:
+        try:
+            log_file
+            write_log()
+            log_out = open(log_file, "w")             # Makes sure the file is clean at startup
+            log_out.write("OMI DDIMM Firmware update log\n" + dt_string + "\nFile used: " + firmware_file + "\n")        # time stamp
+            # the trace ring is written to the log each time it is full, so the whole update is kept
+            tracer.stream(log_out)
+            atexit.register(write_log)              # the rest of the trace is written when leaving, whatever the exit path
+        except NameError: pass
 
-print("Firmware reading from:",firmware_file, " binary file")
+        try:
+            comparison_log_file
+            compa_log      = open(comparison_log_file, "w")           # Makes sure the file is clean at startup
+            compa_log.close
+            compa_log      = open(comparison_log_file, "a")           # will append the prints
+        except: pass
 
-file_size = os.path.getsize(firmware_file)
-print("File Size is :", file_size, "bytes")
-rest = 256 - (file_size % 256)    # provides information if padding will be required at the end of the file
-burst_nb = file_size // 256
+    print("Firmware reading from:",firmware_file, " binary file")
 
-print("Bursts to be written :", burst_nb, " Will remain " + "{:d} ".format(rest) + "bytes to pad in the last data buffer")
+    file_size = os.path.getsize(firmware_file)
+    print("File Size is :", file_size, "bytes")
+    rest = 256 - (file_size % 256)    # provides information if padding will be required at the end of the file
+    burst_nb = file_size // 256
 
-f = open(firmware_file, "rb")
+    print("Bursts to be written :", burst_nb, " Will remain " + "{:d} ".format(rest) + "bytes to pad in the last data buffer")
 
-word = f.read(8)  # ready to begin collecting first data from binfile
-while word:       # word is either a 64b word from the bin file, or a 0xFFFFFFFFFFFFFFFF padding at the end of the file if required
-    W64=W64+1     # counting 64B word from 1 at first loop
+    f = open(firmware_file, "rb")
 
-    split_word_fill_data_buff(word) # we split the 64b word in 2 32b words
-    data_index = data_index + 2     # we stored 2 32bits words in the data buff
-    send_data_to_explorer()         # addr_index will be incremented by 4 + 4
+    word = f.read(8)  # ready to begin collecting first data from binfile
+    while word:       # word is either a 64b word from the bin file, or a 0xFFFFFFFFFFFFFFFF padding at the end of the file if required
+        W64=W64+1     # counting 64B word from 1 at first loop
 
-    # once we have read 256 bytes (32 W64), we need to prepare the corresponding command buffer
-    #------------------------------------------------------------------------------------------#
-    if addr_index > 0xfc:
+        split_word_fill_data_buff(word) # we split the 64b word in 2 32b words
+        data_index = data_index + 2     # we stored 2 32bits words in the data buff
+        send_data_to_explorer()         # addr_index will be incremented by 4 + 4
 
-        addr_index = 0x40                 # prepares next cmd set. First address will be 0xA103FF40
-        data_index = 0                    # prepares next crc calculation
-        crc32_data = crc32_array(data_buff, 64)  # compute the data_buff crc32
+        # once we have read 256 bytes (32 W64), we need to prepare the corresponding command buffer
+        #------------------------------------------------------------------------------------------#
+        if addr_index > 0xfc:
 
-        clr_inbound_doorbell()             #Clear inbound doorbell => WR 1 in bit 31 of @A8084738 - all others at 0        
-        clr_outbound_doorbell()            #Clear outbound doorbell... => WR 1 in bit 0 of @A0002058
+            addr_index = 0x40                 # prepares next cmd set. First address will be 0xA103FF40
+            data_index = 0                    # prepares next crc calculation
+            crc32_data = crc32_array(data_buff, 64)  # compute the data_buff crc32
 
-        send_command_burst(0)             # sending regular command burst (not the last commit one)
+            clr_inbound_doorbell()             #Clear inbound doorbell => WR 1 in bit 31 of @A8084738 - all others at 0        
+            clr_outbound_doorbell()            #Clear outbound doorbell... => WR 1 in bit 0 of @A0002058
 
-        addr_index = 0x00                 # prepares next cmd set first address will be 0x0508A103FF40
-        data_buff_nb = data_buff_nb + 1   # prepares next data buffer number
-        #print(data_buff_nb)
-        ID = ID+1                         # prepares next data buffer ID number
-        #print("ID={:04X}".format(ID))
+            send_command_burst(0)             # sending regular command burst (not the last commit one)
 
-        for i in range(64):               # cleaning data buffer for next crc32
-            data_buff.append(0)
+            addr_index = 0x00                 # prepares next cmd set first address will be 0x0508A103FF40
+            data_buff_nb = data_buff_nb + 1   # prepares next data buffer number
+            #print(data_buff_nb)
+            ID = ID+1                         # prepares next data buffer ID number
+            #print("ID={:04X}".format(ID))
 
-        #last commands of the burst
-        #-------------------------#
-        
-        set_inbound_doorbell()      #Set the inbound doorbell => WR 1 in bit 31 of @A8084730 - all others at 0
-        waiting_fw_rdy()    #Poll for response ready => Read Outbound doorbell @A002058 => Poll until 0400000001
+            for i in range(64):               # cleaning data buffer for next crc32
+                data_buff[i] = 0
 
-        # Every 16 bursts, we check perform a sanity check and also for the first one
-        if ((data_buff_nb-1) % 16)==0:
-            sanity_check(0)
-            progress = round(data_buff_nb / burst_nb * 100, 1)
-            print("\rProgress: ",progress, "%", end='', flush=True)   # we compute progress once in a while.
+            #last commands of the burst
+            #-------------------------#
+            
+            set_inbound_doorbell()      #Set the inbound doorbell => WR 1 in bit 31 of @A8084730 - all others at 0
+            waiting_fw_rdy()    #Poll for response ready => Read Outbound doorbell @A002058 => Poll until 0400000001
 
-        clr_outbound_doorbell()
+            # Every 16 bursts, we check perform a sanity check and also for the first one
+            if ((data_buff_nb-1) % 16)==0:
+                sanity_check(0)
+                progress = round(data_buff_nb / burst_nb * 100, 1)
+                print("\rProgress: ",progress, "%", end='', flush=True)   # we compute progress once in a while.
 
+            clr_outbound_doorbell()
 
-    
-    word = f.read(8)               # prepares next loop if any (otherwise check if padding is required)
-    if (not word) & (rest !=0):    # Situation of padding occurs
-        word = b'\xff\xff\xff\xff\xff\xff\xff\xff'
-        padding = padding + 8      # We increase by 8 bytes the counting as we work with 64B words
-        if (padding > rest):       # need to stop padding at some time 
-            break
 
-# last step : commit the code => last commands buffer to be issued
-#----------------------------------------------------------------#
-
-clr_inbound_doorbell()
-clr_outbound_doorbell()
+        
+        word = f.read(8)               # prepares next loop if any (otherwise check if padding is required)
+        if (not word) & (rest !=0):    # Situation of padding occurs
+            word = b'\xff\xff\xff\xff\xff\xff\xff\xff'
+            padding = padding + 8      # We increase by 8 bytes the counting as we work with 64B words
+            if (padding > rest):       # need to stop padding at some time 
+                break
 
-addr_index = 0x40                 # prepares last cmd set. First address will be 0xA103FF40
+    # last step : commit the code => last commands buffer to be issued
+    #----------------------------------------------------------------#
 
-send_command_burst(1)             # sending a "commit" type command burst (not the regular ones)
+    clr_inbound_doorbell()
+    clr_outbound_doorbell()
 
-#last commands after the commit burst
-set_inbound_doorbell()
+    addr_index = 0x40                 # prepares last cmd set. First address will be 0xA103FF40
 
-print("\rProgress: 100 %       ", end='', flush=True)
-print("\nWaiting 30s to allow firmware to handle the binary data ...")
-sleep(30)
-waiting_fw_rdy()    #Poll for response ready => Read Outbound doorbell @A002058 => Poll until 0400000001
-# DEBUG
-sanity_check(1)     # Last check we check value is 0xC00
-#clr_outbound_doorbell()
+    send_command_burst(1)             # sending a "commit" type command burst (not the regular ones)
 
+    #last commands after the commit burst
+    set_inbound_doorbell()
 
-for i in range(15):                         # cleaning cmd_buff buffer for next crc32
-    cmd_buff.append(0)
+    print("\rProgress: 100 %       ", end='', flush=True)
+    print("\nWaiting for the firmware to handle the binary data ...")
+    sleep(FW_COMMIT_QUIET)            # leave the firmware alone while it commits the image
+    #Poll for response ready => Read Outbound doorbell @A002058 => Poll until 0400000001
+    waiting_fw_rdy(POLL_FW_COMMIT_TIMEOUT, POLL_FW_COMMIT)
+    # DEBUG
+    sanity_check(1)     # Last check we check value is 0xC00
+    #clr_outbound_doorbell()
 
-#print("\nnumber of W64:   ", W64)
-#print("\nnumber of bursts:", data_buff_nb)
+    #print("\nnumber of W64:   ", W64)
+    #print("\nnumber of bursts:", data_buff_nb)
 
-#firmwarefile close
-f.close
-#log file close if any
-try:
-    log_file
-    log.close
+    #firmwarefile close
+    f.close()
     #compa_log file close if any
-except: pass
+    if compa_log is not None:
+        compa_log.close()
+        compa_log = None
+    #log file close if any
+    write_log()
+        
+    '''print("\n----------------------------------\nCurrent Firmware information:\n")
+    explorer.getinfo()
+    explorer.get_firmware_info()'''
+
+    print("\nEnd of firmware upload step\nYou might need to restart the DDIMM several times while allowing some time for firmware to update between reset\nCheck update with: python3 omy.py info -c explorer")
 
-try:
-    compa_log
-    compa_log.close
-except: pass
-    
-'''print("\n----------------------------------\nCurrent Firmware information:\n")
-explorer.getinfo()
-explorer.get_firmware_info()'''
 
-print("\nEnd of firmware upload step\nYou might need to restart the DDIMM several times while allowing some time for firmware to update between reset\nCheck update with: python3 omy.py info -c explorer")
+if __name__ == "__main__":
+    if firmware_file == "<release>.bin":
+        print("Check https://github.com/open-power/ocmb-explorer-fw/releases")
+        print("to get latest DDIMM EXPLORER firmware")
+        print("and update variable firmware_file = \"<release>.bin\" accordingly")
+        exit(1)
 
+    update(firmware_file)
 
-print('Peak Memory Usage =', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-print('User Mode Time =', resource.getrusage(resource.RUSAGE_SELF).ru_utime)
-print('System Mode Time =', resource.getrusage(resource.RUSAGE_SELF).ru_stime)
+    print('Peak Memory Usage =', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    print('User Mode Time =', resource.getrusage(resource.RUSAGE_SELF).ru_utime)
+    print('System Mode Time =', resource.getrusage(resource.RUSAGE_SELF).ru_stime)
@@ -19,21 +19,290 @@
 # the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
 #
 
+import os
+import threading
 import smbus2 as smbus
 import logging
 
 from constants import *
 
+##################################################################################
+#   Process-wide pool of I2C bus handles.                                        #
+#   Fire, Explorer, Ice, Mux, Pmic and Eeprom all share the same handle for a    #
+#   given bus number instead of opening a new SMBus each time they are built.   #
+#   A handle lives as long as the process: close_bus() only closes its file      #
+#   descriptor, reopened on the next access. After a fork, the child reopens     #
+#   its own descriptor too, so parent and child never share I2C_SLAVE state.     #
+##################################################################################
+class I2cBus:
+    def __init__(self, pool, i2c_bus_num):
+        self.pool = pool
+        self.i2c_bus_num = i2c_bus_num
+        self.bus = None
+
+    def get_bus(self):
+        """ Return the underlying SMBus, (re)opening it if needed """
+        if self.bus is None:
+            self.bus = self.pool.bus_factory(self.i2c_bus_num)
+            for wrapper in self.pool.bus_wrappers: self.bus = wrapper(self.bus, self.i2c_bus_num)
+            logging.info("I2C bus {} opened.".format(self.i2c_bus_num))
+        return self.bus
+
+    def __getattr__(self, name):
+        # forwards i2c_rdwr, read_byte, write_quick, ... to the shared SMBus
+        return getattr(self.get_bus(), name)
+
+    def close(self):
+        """ Close the file descriptor, the next access reopens it """
+        self.pool.close(self.i2c_bus_num)
+
+
+class I2cBusPool:
+    def __init__(self, bus_factory=smbus.SMBus):
+        self.bus_factory = bus_factory
+        self.bus_wrappers = []      # (bus, bus number) -> bus, eg the I2C metrics layer, innermost first
+        self.handles = {}
+        self.lock = threading.RLock()
+
+    def get(self, i2c_bus_num):
+        """ Get the shared handle of a bus """
+        with self.lock:
+            handle = self.handles.get(i2c_bus_num)
+            if handle is None:
+                handle = self.handles[i2c_bus_num] = I2cBus(self, i2c_bus_num)
+            handle.get_bus()   # open now so a missing adapter is reported by init_bus()
+            return handle
+
+    def close(self, i2c_bus_num=None):
+        """ Close one bus (or all of them when no bus number is given), the handles reopen it on their next access """
+        with self.lock:
+            bus_nums = list(self.handles) if i2c_bus_num is None else [i2c_bus_num]
+            for num in bus_nums:
+                handle = self.handles.get(num)
+                if handle is None or handle.bus is None: continue
+                try:
+                    handle.bus.close()
+                except OSError: pass
+                handle.bus = None
+                logging.info("I2C bus {} closed.".format(num))
+
+    def add_wrapper(self, wrapper):
+        """ Wrap the buses opened from now on, and the ones already open, with wrapper(bus, bus number) """
+        with self.lock:
+            self.bus_wrappers.append(wrapper)
+            for handle in self.handles.values():
+                if handle.bus is not None: handle.bus = wrapper(handle.bus, handle.i2c_bus_num)
+
+    def remove_wrapper(self, wrapper):
+        """ Remove a wrapper class (the wrapped bus being its .bus attribute) from all the buses """
+        with self.lock:
+            if wrapper not in self.bus_wrappers: return
+            self.bus_wrappers.remove(wrapper)
+            for handle in self.handles.values():
+                outer, bus = None, handle.bus
+                while bus is not None and not isinstance(bus, wrapper) and isinstance(bus, tuple(self.bus_wrappers)):
+                    outer, bus = bus, bus.bus
+                if not isinstance(bus, wrapper): continue
+                if outer is None: handle.bus = bus.bus
+                else: outer.bus = bus.bus
+
+    def after_fork(self):
+        """ Child side of a fork: forget the inherited file descriptors, they are reopened lazily """
+        self.lock = threading.RLock()
+        for handle in self.handles.values():
+            if handle.bus is not None:
+                try:
+                    handle.bus.close()   # closes only the child's copy of the descriptor
+                except OSError: pass
+            handle.bus = None
+
+
+bus_pool = I2cBusPool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=bus_pool.after_fork)
+
 def init_bus(i2c_bus_num=3):
     try:
-        return smbus.SMBus(i2c_bus_num)
+        return bus_pool.get(i2c_bus_num)
     except IOError as err:
         print("Error in i2c bus.")
-     
 
-def get_alive_addresses(bus):
+def close_bus(i2c_bus_num=None):
+    """ Explicitly close a bus handle (all handles if no bus number is given) """
+    bus_pool.close(i2c_bus_num)
+
+
+##################################################################################
+#   Write verify policy of a driver (Fire, Explorer, Ice). The policy is set    #
+#   for the session (driver creation) and can be overridden on each write:      #
+#       always   : every write is read back                                     #
+#       deferred : writes are remembered and read back together by flush()      #
+#       sampled  : one write out of sample_rate is read back                    #
+#       off      : nothing is read back                                         #
+##################################################################################
+class WriteVerifier:
+    def __init__(self, name, policy=VERIFY_ALWAYS, sample_rate=VERIFY_SAMPLE_RATE):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.pending = {}       # deferred writes: address -> last data written
+        self.counts = dict.fromkeys(VERIFY_POLICIES, 0)
+        self.policy = VERIFY_ALWAYS
+        self.set_policy(policy)
+
+    def set_policy(self, policy):
+        if policy not in VERIFY_POLICIES:
+            print("ERROR !! Unknown verify policy {}, expecting one of {}".format(policy, VERIFY_POLICIES))
+            return
+        self.policy = policy
+
+    def select(self, policy=None):
+        """ Policy used for one write (session policy unless overridden), and if it must be read back now """
+        if policy is None: policy = self.policy
+        if policy not in VERIFY_POLICIES: policy = VERIFY_ALWAYS
+        self.counts[policy] += 1
+        if policy == VERIFY_ALWAYS: return policy, True
+        if policy == VERIFY_SAMPLED: return policy, (self.counts[policy] - 1) % self.sample_rate == 0
+        return policy, False
+
+    def defer(self, reg_addr, data):
+        self.pending[reg_addr] = data
+
+    def flush(self, read_many):
+        """ Read back the deferred writes with read_many(list of addresses) -> list of values.
+            Returns the list of (address, written, read) that don't match """
+        if not self.pending: return []
+        regs = list(self.pending)
+        values = read_many(regs)
+        mismatches = [(reg, self.pending[reg], value) for reg, value in zip(regs, values) if value != self.pending[reg]]
+        logging.info("{}: deferred verify of {} writes, {} mismatches".format(self.name, len(regs), len(mismatches)))
+        for reg, data, value in mismatches:
+            print("WARNING !! {} write of {:#018x} at {:#010x} reads back {:#018x}".format(self.name, data, reg, value))
+        self.pending = {}
+        return mismatches
+
+    def stats(self):
+        return "{} writes verify: ".format(self.name) + ", ".join("{} {}".format(n, p) for p, n in self.counts.items() if n)
+
+
+##################################################################################
+#   Status checking of the Explorer/ICE I2C protocol. In STATUS_EACH mode the   #
+#   status register 0x2 is read before, between and after every access. In      #
+#   STATUS_DEFERRED mode, a batch of accesses runs without them (fast path) and #
+#   the status is read at the end (and every interval accesses if not 0). If an #
+#   error shows up, the whole batch is replayed with per-access status checks   #
+#   (slow path).                                                                 #
+##################################################################################
+class StatusChecker:
+    def __init__(self, name, mode=STATUS_EACH, interval=0):
+        self.name = name
+        self.mode = mode if mode in STATUS_MODES else STATUS_EACH
+        self.interval = interval
+        self.replaying = False
+        self.skipped = 0        # status reads saved by the fast path
+        self.batches = 0
+        self.replays = 0        # batches replayed on the slow path
+
+    def deferred(self):
+        return self.mode == STATUS_DEFERRED and not self.replaying
+
+    def skip(self, n):
+        self.skipped += n
+
+    def error(self, status):
+        """ Status byte of register 0x2 (eg 0x001B0005: 1B is FW API number, 00 is Command OK) """
+        return (status & 0xff00) >> 8 != 0
+
+    def run(self, ops, fast_op, slow_op, read_status):
+        """ Run ops (op, reg_addr, data) with fast_op, replayed with slow_op on a status error """
+        self.batches += 1
+        skipped = self.skipped
+        values, failed = [], False
+        for n, op in enumerate(ops):
+            values.append(fast_op(*op))
+            if self.interval and (n + 1) % self.interval == 0 and n + 1 < len(ops):
+                self.skipped -= 1
+                if self.error(read_status()): failed = True; break
+        if not failed:
+            self.skipped -= 1
+            status = read_status()
+            if not self.error(status): return values
+            logging.info("{}: status {:#010x} at the end of a batch of {} accesses".format(self.name, status, len(ops)))
+        self.skipped = skipped     # nothing saved by this batch
+        return self.replay(ops, slow_op)
+
+    def replay(self, ops, slow_op):
+        self.replays += 1
+        logging.info("{}: replaying {} accesses with status checks".format(self.name, len(ops)))
+        self.replaying = True
+        try:
+            return [slow_op(*op) for op in ops]
+        finally:
+            self.replaying = False
+
+    def stats(self):
+        return "{} status: {} reads skipped, {} batches, {} replayed".format(self.name, self.skipped, self.batches, self.replays)
+
+
+##################################################################################
+#   Latency histogram: bucket k holds the samples of [2^(k-1), 2^k[ us.          #
+#   Used by the polling waits (polling.py) and the I2C metrics (metrics.py).     #
+##################################################################################
+class LatencyHistogram:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}   # log2 of the latency in us -> number of samples
+
+    def record(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max: self.max = latency
+        k = int(latency * 1e6).bit_length()
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for k, n in other.buckets.items(): self.buckets[k] = self.buckets.get(k, 0) + n
+
+    def quantile(self, q):
+        """ Lower bound (in seconds) of the bucket holding the q quantile, None if empty """
+        if self.count == 0: return None
+        seen = 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen >= q * self.count: return (1 << (k - 1)) / 1e6 if k > 0 else 0.0
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "max": self.max, "buckets": {str(k): n for k, n in self.buckets.items()}}
+
+    def load_dict(self, d):
+        self.count, self.total, self.max = d["count"], d["total"], d["max"]
+        self.buckets = {int(k): n for k, n in d["buckets"].items()}
+        return self
+
+    def latencies(self):
+        if self.count == 0: return "no sample"
+        return "mean {:.6f}s, p50 {:.6f}s, p90 {:.6f}s, max {:.6f}s".format(self.mean(), self.quantile(0.5), self.quantile(0.9), self.max)
+
+
+def frame_length(data):
+    """ Number of bytes of a raw I2C frame given as an int (eg 0x0304A0000000 -> 6), as len(hex(data)) / 2 """
+    return 1 + ((data.bit_length() + 3) // 4) // 2
+
+
+def get_alive_addresses(bus, addresses=None):
+    """ Probe the given addresses (every address of the bus by default) """
+    if addresses is None: addresses = range(1, I2C_ADDR_RANGE)
     addr_found = []
-    for _addr in range(1, I2C_ADDR_RANGE):
+    for _addr in addresses:
         try:
             res = bus.write_quick(_addr)
             addr_found.append(_addr)
@@ -41,29 +310,86 @@ def get_alive_addresses(bus):
     return addr_found
 
 
+known_devices_by_addr = {dev['addr']: dev['name'] for dev in known_devices}
 
-def scan_bus(busNum=3, verbose=0):
-    bus = init_bus(busNum)
-    logging.info('I2C bus is initialized.')
-    addr_found = [addr for addr in get_alive_addresses(bus)]
-    
-    
+def card_type(addr_found):
     # Concerning devices, EXP and ice do not have the same address for ID,
     # so we use a criteria based on power managment chips to define which card is plugged
-    # return value will contain the type of card
     ret = "None"
+    for _addr in addr_found:
+        device = known_devices_by_addr.get(_addr, "")
+        if   device == "PMIC2":      ret = "DDIMM"  # basic criteria to recognize a card type
+        elif device.find("UDC90120A")!=-1: ret = "GEMINI"
+    return ret
+
+
+##################################################################################
+#   Topology cache: the devices seen on a bus (and so the card type) depend on  #
+#   the muxes settings. Scan results are kept per (bus, mux settings) and only  #
+#   the known_devices addresses are probed unless a full scan is asked.         #
+#   Mux writes select another cache entry, while resets and PMIC changes, which #
+#   power devices on or off, invalidate the entries of the bus.                 #
+#   The card type found on each port is kept too (see components.port_cards).   #
+##################################################################################
+class Topology:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.muxes = {}     # bus number -> {mux address: value}
+        self.scans = {}     # (bus number, mux settings) -> (addresses found, full scan)
+        self.cards = {}     # (bus number, port) -> card type
+
+    def route(self, i2c_bus_num):
+        return tuple(sorted(self.muxes.get(i2c_bus_num, {}).items()))
+
+    def set_mux(self, i2c_bus_num, mux_addr, value):
+        """ Record the setting of a mux (written or read back) """
+        with self.lock:
+            self.muxes.setdefault(i2c_bus_num, {})[mux_addr] = value
+
+    def get_mux(self, i2c_bus_num, mux_addr):
+        """ Last known setting of a mux, None if unknown """
+        return self.muxes.get(i2c_bus_num, {}).get(mux_addr)
+
+    def forget_muxes(self, i2c_bus_num):
+        with self.lock:
+            self.muxes.pop(i2c_bus_num, None)
+
+    def invalidate(self, i2c_bus_num=None):
+        """ Forget the scans of a bus (of all buses if no bus number is given) """
+        with self.lock:
+            for cache in (self.scans, self.cards):
+                for key in list(cache):
+                    if i2c_bus_num is None or key[0] == i2c_bus_num: del cache[key]
+            logging.info("I2C topology cache invalidated for bus {}".format("all" if i2c_bus_num is None else i2c_bus_num))
+
+    def scan(self, i2c_bus_num, full=False):
+        with self.lock:
+            key = (i2c_bus_num, self.route(i2c_bus_num))
+            cached = self.scans.get(key)
+            if cached is not None and (cached[1] or not full):
+                if full: return cached[0]
+                return [addr for addr in cached[0] if addr in known_devices_by_addr]
+            bus = bus_pool.get(i2c_bus_num)
+            logging.info('I2C bus is initialized.')
+            addr_found = get_alive_addresses(bus, None if full else list(known_devices_by_addr))
+            self.scans[key] = (addr_found, full)
+            return addr_found
+
+
+topology = Topology()
+
+
+def scan_bus(busNum=3, verbose=0, full=False):
+    """ Return the card type seen on the bus ("DDIMM", "GEMINI" or "None"), from the topology cache.
+        full probes every address, to also list unknown devices """
+    addr_found = topology.scan(busNum, full)
+
     if len(addr_found) > 0:
         for _addr in addr_found:
-            if _addr in [dev['addr'] for dev in known_devices]:
-                device = [dev['name'] for dev in known_devices if dev['addr'] == _addr][0]
-                if verbose: print("  --{:#02x}: {}".format(_addr, device))
-                if   device == "PMIC2":      ret = "DDIMM"  # basic criteria to recognize a card type
-                elif device.find("UDC90120A")!=-1: ret = "GEMINI"
-
+            if _addr in known_devices_by_addr:
+                if verbose: print("  --{:#02x}: {}".format(_addr, known_devices_by_addr[_addr]))
             else:
                 if verbose:print("  --{:#02x}: Unknown device".format(_addr))
-
-    
     else : print("No devices found on I2C-{} bus".format(busNum))
 
-    return ret
\ No newline at end of file
+    return card_type(addr_found)
\ No newline at end of file
@@ -21,6 +21,8 @@
 
 from constants import *
 from functions import *
+from regseq import OP_READ, OP_WRITE
+from bustrace import *
 from components import Eeprom
 from time import sleep
 
@@ -36,9 +38,11 @@ class Ice:
     """ 
         Initialize i2c bus and get IDs of the Gemini 
         """
-    def __init__(self, fire_freq, i2c_bus_num):
+    def __init__(self, fire_freq, i2c_bus_num, i2c_bus=None, verify=VERIFY_OFF, status_mode=STATUS_EACH, status_interval=0):
         self.i2c_bus_num = i2c_bus_num
-        self.i2c_bus = init_bus(i2c_bus_num)
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
+        self.verifier = WriteVerifier("ICE", verify)    # ICE writes were historically never read back
+        self.status = StatusChecker("ICE", status_mode, status_interval)
         self.fire_freq = fire_freq
         self.fire_freq = 333
     
@@ -70,11 +74,11 @@ class Ice:
         Detect if Explorer i2c address is visible on the bus 
         """
     def detect(self):
-        alive_addresses = get_alive_addresses(self.i2c_bus)
+        alive_addresses = get_alive_addresses(self.i2c_bus, [ICE_I2C_ADDR])
         return ICE_I2C_ADDR in alive_addresses
     
     def i2c_simple_read(self, reg_addr):
-        length = int(len(str(hex(reg_addr)))/2)
+        length = frame_length(reg_addr)
         msg = smbus.i2c_msg.write(ICE_I2C_ADDR, list(reg_addr.to_bytes(length, 'big')))
         self.i2c_bus.i2c_rdwr(msg)
         # if size of read is more than available, the program will crash
@@ -84,22 +88,23 @@ class Ice:
             block.append(d)
 
         # take only the first 8 bytes
-        odata = int(''.join(format(val, '02x') for val in block[1:5]), 16)
-        logging.info("ICE: Reading {} from {}".format(hex(odata), hex(reg_addr)))
-        #logging.info("ICE: Reading {:#010x} from {:#010x}".format(odata, reg_addr))
+        odata = int.from_bytes(bytes(block[1:5]), 'big')
+        tracer.record(DEV_ICE, TR_READ, reg_addr, odata)
         if odata   == 0xdec0de00:
         	print("WARNING !! ICE address has not been set yet by hardware")
+        	tracer.error("ICE: access error {:#x}".format(odata))
         elif odata == 0xdec0de0b:
         	print("ERROR !! ICe address is in AXI range but out of the hardware range")
+        	tracer.error("ICE: access error {:#x}".format(odata))
         
             
         return odata
 
     def i2c_simple_write(self, data):
-        logging.info("ICE: Writing {:#010x}".format(data))
+        tracer.record_frame(DEV_ICE, data)
         
         # calculate the number of bytes in provided data
-        length = int(len(str(hex(data)))/2)
+        length = frame_length(data)
 
         # convert to a list of bytes and then write
         msg = smbus.i2c_msg.write(ICE_I2C_ADDR, list(data.to_bytes(length, 'big')))
@@ -107,23 +112,21 @@ class Ice:
     
 
     def i2c_double_read(self, reg_addr):
+        if self.status.deferred(): return self.run_batch([(OP_READ, reg_addr, 0)])[0]
         bit_64 = reg_addr & (1 << 27)    # if bit64 this means we need to achieve 2 I2C transactions
 
         if bit_64:
             raw_reg_addr = reg_addr & ~(1 << 27)
             new_reg_addr = (raw_reg_addr << 3) | (1 << 27)
-            logging.info("DBG: ICE: 64bits DRead at Scom Addr: {:#010x}".format(reg_addr))  
         else:
             raw_reg_addr = reg_addr
             new_reg_addr = reg_addr
-            logging.info("       ICE: 32bits  Read at Scom Addr: {:#010x}".format(reg_addr))
-        logging.info("       ICE: read at Register Addr:     {:#010x}".format(new_reg_addr))
 
         try:
             self.i2c_simple_read(0x2)  # This prevents reading unexisting address, as we can't 100% mimic CRONUS proper behavior yet
         except:
             print("WARNING ! ICE read failed")
-            exit()
+            exit(1)
         self.i2c_simple_write(0x0304A0000000 + new_reg_addr)
         self.i2c_simple_read(0x2)
         # ICE affects directly the result as a response to the read
@@ -133,14 +136,13 @@ class Ice:
         
         if bit_64:
             new_reg_addr_2 = new_reg_addr + 4
-            logging.info("       ICE: read at Register Addr:     {:#010x}".format(new_reg_addr_2))
             
             # first previous test should be enough, but ...
             try:
                 self.i2c_simple_read(0x2)  # This prevents reading unexisting address, as we can't 100% mimic CRONUS proper behavior yet
             except:
                 print("ERROR ! ICE: read failed")
-                exit()
+                exit(1)
 
             self.i2c_simple_write(0x0304A0000000 + new_reg_addr_2)
             self.i2c_simple_read(0x2)
@@ -149,13 +151,16 @@ class Ice:
                     
             self.i2c_simple_read(0x2) # previous command status
 
+            tracer.record(DEV_ICE, TR_DREAD, reg_addr, (res_msb << 32) + res_lsb)
             return ((res_msb << 32) + res_lsb)
 
-        else: return res_msb
+        tracer.record(DEV_ICE, TR_DREAD, reg_addr, res_msb)
+        return res_msb
 
-    def i2c_double_write(self, reg_addr, data):
+    def i2c_double_write(self, reg_addr, data, verify=None):
         bit_64 = reg_addr & (1 << 27)
-        logging.info("ICE DWrite Reg: {:#010x} with Data:{:#010x}".format(reg_addr, data))
+        policy, read_back = self.verifier.select(verify)
+        tracer.record(DEV_ICE, TR_DWRITE, reg_addr, data)
         if bit_64:
             raw_reg_addr = reg_addr & ~(1 << 27)
             new_reg_addr = (raw_reg_addr << 3) | (1 << 27)
@@ -170,26 +175,72 @@ class Ice:
         #print("data lsb: ", hex(data_lsb))
         #print("data msb: ", hex(data_msb))
         #print("write : ", hex(0x0508A000000000000000 + (new_reg_addr << 32) + data_msb))
-        self.i2c_simple_write(0x0508A000000000000000 + (new_reg_addr << 32) + data_msb)
-        self.i2c_simple_read(0x2)
-        
-        if bit_64:
-            self.i2c_simple_write(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb)
-            #print("write : ", hex(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb))
+        if self.status.deferred():
+            self.run_batch([(OP_WRITE, reg_addr, data)])
+        else:
+            self.i2c_simple_write(0x0508A000000000000000 + (new_reg_addr << 32) + data_msb)
             self.i2c_simple_read(0x2)
+            
+            if bit_64:
+                self.i2c_simple_write(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb)
+                #print("write : ", hex(0x0508A000000000000000 + ((new_reg_addr + 4) << 32) + data_lsb))
+                self.i2c_simple_read(0x2)
+
+        if policy == VERIFY_DEFERRED: self.verifier.defer(reg_addr, data)
+        if not read_back: return True
+        r_data = self.i2c_double_read(reg_addr)
+        return (r_data == data)
+
+    """
+        Run a batch of accesses (OP_READ/OP_WRITE, reg_addr, data) with the status of register 0x2
+        only read at the end of the batch (or every status_interval accesses). Returns the read
+        values (None for writes). On a status error, the batch is replayed with the status
+        checked around every access.
+        """
+    def run_batch(self, ops):
+        return self.status.run(ops, self.fast_op, self.slow_op, lambda: self.i2c_simple_read(0x2))
+
+    def fast_op(self, op, reg_addr, data):
+        if reg_addr & (1 << 27):
+            new_reg_addr = ((reg_addr & ~(1 << 27)) << 3) | (1 << 27)
+            words = [(new_reg_addr, data >> 32), (new_reg_addr + 4, data & 0xffffffff)]
+        else:
+            words = [(reg_addr, data & 0xffffffff)]
+        if op == OP_WRITE:
+            for word, word_data in words:
+                self.i2c_simple_write(0x0508A000000000000000 + (word << 32) + word_data)
+            self.status.skip(len(words))
+            return None
+        res = 0
+        for word, word_data in words:
+            self.i2c_simple_write(0x0304A0000000 + word)
+            # ICE affects directly the result as a response to the read
+            res = (res << 32) + self.i2c_simple_read(0x0404A0000000 + word)
+        self.status.skip(3 * len(words))
+        return res
+
+    def slow_op(self, op, reg_addr, data):
+        if op == OP_READ: return self.i2c_double_read(reg_addr)
+        self.i2c_double_write(reg_addr, data, VERIFY_OFF)
+
+    """
+        Read back the writes done with the deferred verify policy.
+        """
+    def flush_verify(self):
+        return self.verifier.flush(lambda regs: [self.i2c_double_read(reg) for reg in regs])
 
     def i2cread(self, reg_addr):
         #length = int(len(str(hex(reg_addr)))/2)
         # ICE hardware allows reading only if 0x02 is received as message.
         if reg_addr != 0x2:
             print("ERROR !! i2cread is only valid for register 0x02!")
-            exit()
+            exit(1)
         # WARNING the read_i2c_block_data routine will use only the LSByte of reg_addr
         # https://buildmedia.readthedocs.org/media/pdf/smbus2/latest/smbus2.pdf
         res = self.i2c_bus.read_i2c_block_data(ICE_I2C_ADDR, reg_addr, 5)
         # format result and remove the MSB (0x04 indicates a read operation)
-        odata = int(''.join(format(val, '02x') for val in res[1:5]), 16)
-        logging.info("ICE: Reading {} from {}".format(hex(odata), hex(reg_addr)))
+        odata = int.from_bytes(bytes(res[1:5]), 'big')
+        tracer.record(DEV_ICE, TR_READ, reg_addr, odata)
         if odata   == 0xdec0de00:
         	print("WARNING !! ICE address has not been set yet by hardware")
         elif odata == 0xdec0de0b:
@@ -208,10 +259,10 @@ class Ice:
         explorer.i2cwrite(0304A80940B8)
         """
     def i2cwrite(self, data):
-        logging.info("ICE Writing data:{:#010x}".format(data))
+        tracer.record_frame(DEV_ICE, data)
 
         # calculate the number of bytes in provided data 
-        length = int(len(str(hex(data)))/2)
+        length = frame_length(data)
         
         # convert to a list of bytes and then write
         msg = smbus.i2c_msg.write(ICE_I2C_ADDR, list(data.to_bytes(length, 'big')))
@@ -0,0 +1,274 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import atexit
+import threading
+from time import perf_counter
+
+from constants import *
+from functions import *
+from fire import Fire
+from explorer import Explorer
+from ice import Ice
+from components import Mux, Pmic, Eeprom
+import polling
+
+##################################################################################
+#   I2C transaction metrics.                                                     #
+#   Once enabled, every bus handle of the pool is wrapped by a MeteredBus which #
+#   counts the transfers, messages, bytes, NAKs and errors of each target       #
+#   address and records their latency. The high level operations of the        #
+#   drivers (a reg_ops step table, i2c_double_read, ...) are wrapped too: the  #
+#   transfers issued while an operation runs are accounted to it (and to the   #
+#   operations it was called from).                                              #
+#   Nothing is wrapped while disabled, so the drivers run without any overhead.  #
+#                                                                                #
+#       metrics.enable(); ...; print(metrics.summary()); metrics.snapshot()      #
+##################################################################################
+
+I2C_M_RD = 0x0001   # read flag of an i2c_msg
+EREMOTEIO = 121     # slave NAK
+
+# class -> (method, label function of the call arguments or None)
+INSTRUMENTED = (
+    (Fire,     (("i2cread", None), ("i2cwrite", None), ("reg_ops", lambda reg_list, *a, **k: reg_list[0]),
+                ("run_sequence", lambda seq, *a, **k: seq.name), ("diff_apply", lambda seq, *a, **k: seq.name),
+                ("flush_verify", None), ("check_sync", None), ("sync", None), ("retrain", None),
+                ("set_ddimm_on_reset", None), ("set_ddimm_off_reset", None))),
+    (Explorer, (("i2c_simple_read", None), ("i2c_simple_write", None), ("i2c_double_read", None),
+                ("i2c_double_write", None), ("read_many", None), ("flush_verify", None), ("init", None),
+                ("sync", None), ("check_sync", None), ("get_firmware_info", None), ("get_ecid", None))),
+    (Ice,      (("i2c_simple_read", None), ("i2c_simple_write", None), ("i2c_double_read", None),
+                ("i2c_double_write", None), ("flush_verify", None))),
+    (Mux,      (("i2cread", None), ("i2cwrite", None))),
+    (Pmic,     (("i2cread", None), ("i2cwrite", None))),
+    (Eeprom,   (("i2cread", None), ("i2cwrite", None), ("get_info", None))),
+)
+
+
+class TransferStats:
+    def __init__(self, name):
+        self.name = name
+        self.transfers = 0      # ioctls / SMBus calls
+        self.messages = 0
+        self.written = 0        # bytes
+        self.read = 0
+        self.naks = 0
+        self.errors = 0         # other OSErrors
+        self.latency = LatencyHistogram(name)
+
+    def add(self, messages, written, read, latency, errno=None):
+        self.transfers += 1
+        self.messages += messages
+        self.written += written
+        self.read += read
+        if errno == EREMOTEIO: self.naks += 1
+        elif errno is not None: self.errors += 1
+        self.latency.record(latency)
+
+    def to_dict(self):
+        return {"transfers": self.transfers, "messages": self.messages, "written": self.written, "read": self.read,
+                "naks": self.naks, "errors": self.errors, "latency": self.latency.to_dict()}
+
+    def __str__(self):
+        return "{}: {} transfers, {} msgs, W {} B, R {} B, {} NAKs, {} errors, {}".format(self.name, self.transfers,
+            self.messages, self.written, self.read, self.naks, self.errors, self.latency.latencies())
+
+
+class OperationStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.transfers = TransferStats(name)   # transfers issued during the calls, latency of each transfer
+        self.latency = LatencyHistogram(name)  # duration of the calls
+
+    def to_dict(self):
+        return {"calls": self.calls, "transfers": self.transfers.to_dict(), "latency": self.latency.to_dict()}
+
+    def __str__(self):
+        t = self.transfers
+        return "{}: {} calls, {} transfers, W {} B, R {} B, {} NAKs, {}".format(self.name, self.calls, t.transfers,
+            t.written, t.read, t.naks, self.latency.latencies())
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()      # stack of the running operations, per thread
+        self.devices = {}                   # (bus number, address) -> TransferStats
+        self.operations = {}                # name -> OperationStats
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None: stack = self.local.stack = []
+        return stack
+
+    def transfer(self, i2c_bus_num, per_addr, latency, errno=None):
+        """ per_addr: {address: (messages, bytes written, bytes read)} of one transfer """
+        with self.lock:
+            for addr, (messages, written, read) in per_addr.items():
+                stats = self.devices.get((i2c_bus_num, addr))
+                if stats is None:
+                    name = "bus {} {:#04x} {}".format(i2c_bus_num, addr, known_devices_by_addr.get(addr, ""))
+                    stats = self.devices[(i2c_bus_num, addr)] = TransferStats(name.strip())
+                stats.add(messages, written, read, latency, errno)
+            messages = sum(v[0] for v in per_addr.values())
+            written = sum(v[1] for v in per_addr.values())
+            read = sum(v[2] for v in per_addr.values())
+            for op in set(self.stack()):
+                op.transfers.add(messages, written, read, latency, errno)
+
+    def begin(self, name):
+        with self.lock:
+            op = self.operations.get(name)
+            if op is None: op = self.operations[name] = OperationStats(name)
+            op.calls += 1
+        self.stack().append(op)
+        return op
+
+    def end(self, op, latency):
+        self.stack().pop()
+        with self.lock:
+            op.latency.record(latency)
+
+    def reset(self):
+        with self.lock:
+            self.devices.clear()
+            self.operations.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {"devices": {"{}:{:#04x}".format(*key): stats.to_dict() for key, stats in self.devices.items()},
+                    "operations": {name: op.to_dict() for name, op in self.operations.items()},
+                    "waits": {name: hist.to_dict() for name, hist in polling.wait_stats.items()}}
+
+    def summary(self):
+        lines = ["==================== I2C metrics ===================="]
+        with self.lock:
+            busy = sum(stats.latency.total for stats in self.devices.values())
+            lines.append("Per device (bus time {:.3f}s):".format(busy))
+            for key in sorted(self.devices): lines.append("  " + str(self.devices[key]))
+            lines.append("Per operation:")
+            for op in sorted(self.operations.values(), key=lambda op: -op.latency.total): lines.append("  " + str(op))
+        if polling.wait_stats:
+            lines.append("Polling waits:")
+            for name in sorted(polling.wait_stats): lines.append("  " + str(polling.wait_stats[name]))
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+class MeteredBus:
+    def __init__(self, bus, i2c_bus_num):
+        self.bus = bus
+        self.i2c_bus_num = i2c_bus_num
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def call(self, per_addr, fn, *args):
+        start = perf_counter()
+        try:
+            res = fn(*args)
+        except OSError as err:
+            metrics.transfer(self.i2c_bus_num, per_addr, perf_counter() - start, err.errno)
+            raise
+        metrics.transfer(self.i2c_bus_num, per_addr, perf_counter() - start)
+        return res
+
+    def i2c_rdwr(self, *msgs):
+        per_addr = {}
+        for msg in msgs:
+            messages, written, read = per_addr.get(msg.addr, (0, 0, 0))
+            if msg.flags & I2C_M_RD: per_addr[msg.addr] = (messages + 1, written, read + msg.len)
+            else:                    per_addr[msg.addr] = (messages + 1, written + msg.len, read)
+        return self.call(per_addr, self.bus.i2c_rdwr, *msgs)
+
+    def read_byte(self, i2c_addr, *args):
+        return self.call({i2c_addr: (1, 0, 1)}, self.bus.read_byte, i2c_addr, *args)
+
+    def write_quick(self, i2c_addr, *args):
+        return self.call({i2c_addr: (1, 0, 0)}, self.bus.write_quick, i2c_addr, *args)
+
+    def read_i2c_block_data(self, i2c_addr, register, length, *args):
+        return self.call({i2c_addr: (2, 1, length)}, self.bus.read_i2c_block_data, i2c_addr, register, length, *args)
+
+    def write_i2c_block_data(self, i2c_addr, register, data, *args):
+        return self.call({i2c_addr: (1, 1 + len(data), 0)}, self.bus.write_i2c_block_data, i2c_addr, register, data, *args)
+
+
+instrumented = {}    # (class, method) -> wrapper installed by instrument()
+
+def instrument(cls, method, label=None):
+    name = "{}.{}".format(cls.__name__, method)
+    def wrapper(self, *args, **kwargs):
+        op = metrics.begin(name if label is None else "{}[{}]".format(name, label(*args, **kwargs)))
+        start = perf_counter()
+        try:
+            # looked up on each call, so that uninstrument() can splice this wrapper out of a chain
+            return wrapper.__wrapped__(self, *args, **kwargs)
+        finally:
+            metrics.end(op, perf_counter() - start)
+    wrapper.__wrapped__ = getattr(cls, method)
+    instrumented[(cls, method)] = wrapper
+    setattr(cls, method, wrapper)
+
+def uninstrument(cls, method):
+    """ Remove our wrapper, even when another layer (timeline) wrapped the method after us """
+    wrapper = instrumented.pop((cls, method))
+    outer = getattr(cls, method)
+    if outer is wrapper:
+        setattr(cls, method, wrapper.__wrapped__)
+        return
+    while getattr(outer, "__wrapped__", None) is not wrapper:
+        outer = outer.__wrapped__
+    outer.__wrapped__ = wrapper.__wrapped__
+
+enabled = False
+
+def enable(print_at_exit=False):
+    """ Start collecting metrics (wraps the bus handles and the driver operations) """
+    global enabled
+    if enabled: return
+    enabled = True
+    bus_pool.add_wrapper(MeteredBus)
+    for cls, methods in INSTRUMENTED:
+        for method, label in methods: instrument(cls, method, label)
+    if print_at_exit: atexit.register(lambda: print(metrics.summary()))
+
+def disable():
+    """ Stop collecting metrics, the data collected so far stays in metrics """
+    global enabled
+    if not enabled: return
+    enabled = False
+    bus_pool.remove_wrapper(MeteredBus)
+    for cls, methods in INSTRUMENTED:
+        for method, label in methods: uninstrument(cls, method)
+
+def snapshot():
+    return metrics.snapshot()
+
+def summary():
+    return metrics.summary()
+
+def reset():
+    metrics.reset()
@@ -0,0 +1,167 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import logging
+
+from constants import *
+from functions import *
+
+##################################################################################
+#   Multi-level mux routing.                                                     #
+#   The DDIMMs of a board are the leaves of a tree of muxes: each mux selects   #
+#   one channel (1 << channel) and a mux (or a DDIMM) sits behind a channel of  #
+#   its parent. The same mux address can be reused behind different channels,  #
+#   so the setting of each mux is tracked per tree node, not per address. A     #
+#   mux keeps its setting while another branch is selected upstream.            #
+#                                                                                #
+#   Apollo16 (assumed wiring, to be checked against the board documentation):  #
+#                                                                                #
+#       0x70 --ch0--> 0x73 --ch0--> 0x71 --ch0/ch1--> DDIMM a / b                #
+#                          --ch1--> 0x71 --ch0/ch1--> DDIMM c / d                #
+#                           ...                                                  #
+#                          --ch7--> 0x71 --ch0/ch1--> DDIMM o / p                #
+#                                                                                #
+#   schedule() reorders per-DDIMM operations so the DDIMMs are visited in tree  #
+#   order (operations of a DDIMM keep their order), starting with the branch    #
+#   currently selected, and reports how many mux writes the order costs.        #
+##################################################################################
+
+class MuxNode:
+    def __init__(self, name, i2c_addr, parent=None, channel_value=None):
+        self.name = name
+        self.i2c_addr = i2c_addr
+        self.parent = parent                # MuxNode, None for the first level
+        self.channel_value = channel_value  # value to write in the parent to reach this node
+        self.value = None                   # current setting, None if unknown
+
+
+class MuxTree:
+    def __init__(self, i2c_bus_num, i2c_bus=None):
+        self.i2c_bus_num = i2c_bus_num
+        self.i2c_bus = i2c_bus if i2c_bus is not None else init_bus(i2c_bus_num)
+        self.muxes = {}         # name -> MuxNode
+        self.endpoints = {}     # DDIMM name -> (MuxNode, value selecting it)
+        self.order = []         # DDIMM names in tree (depth first) order
+        self.switches = 0       # mux writes sent
+
+    def add_mux(self, name, i2c_addr, parent=None, channel=None):
+        parent_node = self.muxes[parent] if parent is not None else None
+        self.muxes[name] = MuxNode(name, i2c_addr, parent_node, None if channel is None else (1 << channel))
+        return self.muxes[name]
+
+    def add_endpoint(self, name, parent, channel):
+        self.endpoints[name] = (self.muxes[parent], 1 << channel)
+        self.order.append(name)
+
+    def path(self, endpoint):
+        """ [(MuxNode, value), ...] to write to reach a DDIMM, first level first """
+        node, value = self.endpoints[endpoint]
+        settings = []
+        while node is not None:
+            settings.insert(0, (node, value))
+            node, value = node.parent, node.channel_value
+        return settings
+
+    def cost(self, endpoint, state=None):
+        """ Number of mux writes needed to reach a DDIMM from state (current settings by default) """
+        if state is None: state = {}
+        return sum(1 for node, value in self.path(endpoint) if state.get(node.name, node.value) != value)
+
+    def route(self, endpoint):
+        """ Open the path to a DDIMM, writing only the muxes that must change. Returns the number of writes """
+        nb_writes = 0
+        for node, value in self.path(endpoint):
+            if node.value != value:
+                # a new selection is only applied on STOP: one transfer per level
+                self.i2c_bus.i2c_rdwr(smbus.i2c_msg.write(node.i2c_addr, [value]))
+                node.value = value
+                nb_writes += 1
+                logging.info("Mux {} ({:#02x}) is set to {:#02x}".format(node.name, node.i2c_addr, value))
+            # keep the topology cache of the bus in line with the muxes on the active path
+            topology.set_mux(self.i2c_bus_num, node.i2c_addr, value)
+        self.switches += nb_writes
+        return nb_writes
+
+    def invalidate(self):
+        for node in self.muxes.values(): node.value = None
+        topology.forget_muxes(self.i2c_bus_num)
+
+    def sequence_cost(self, endpoints):
+        """ Mux writes needed to visit the DDIMMs in this order, from the current settings """
+        state, nb_writes = {}, 0
+        for endpoint in endpoints:
+            for node, value in self.path(endpoint):
+                if state.get(node.name, node.value) != value:
+                    state[node.name] = value
+                    nb_writes += 1
+        return nb_writes
+
+    """
+        Reorder [(DDIMM name, operation), ...] to minimise the mux writes.
+        Returns (ordered operations, mux writes of this order, mux writes of the given order).
+    """
+    def schedule(self, ops):
+        per_endpoint = {}
+        for endpoint, op in ops: per_endpoint.setdefault(endpoint, []).append(op)
+        visits = [endpoint for endpoint in self.order if endpoint in per_endpoint]
+        # start with the DDIMM the current settings cost the least to reach, then follow the tree order
+        candidates = [visits[i:] + visits[:i] for i in range(len(visits))] or [[]]
+        best = min(candidates, key=self.sequence_cost)
+        ordered = [(endpoint, op) for endpoint in best for op in per_endpoint[endpoint]]
+        switches, naive = self.sequence_cost(best), self.sequence_cost([endpoint for endpoint, op in ops])
+        logging.info("Mux schedule: {} mux writes instead of {} for {} operations on {} DDIMMs".format(
+            switches, naive, len(ops), len(visits)))
+        return ordered, switches, naive
+
+    """
+        Run [(DDIMM name, function), ...] in the scheduled order, each function called
+        with the DDIMM name once its path is open. Returns ({DDIMM: [results]}, mux writes).
+    """
+    def run(self, ops):
+        ordered, switches, naive = self.schedule(ops)
+        start = self.switches
+        results = {}
+        for endpoint, op in ordered:
+            self.route(endpoint)
+            results.setdefault(endpoint, []).append(op(endpoint))
+        return results, self.switches - start
+
+
+def ddimm_tree(i2c_bus_num, i2c_bus=None):
+    """ Current boards: 0x73 (first level, channel 0) then 0x71 with DDIMMs a and b """
+    tree = MuxTree(i2c_bus_num, i2c_bus)
+    tree.add_mux("mux2", MUX2_I2C_ADDR)
+    tree.add_mux("mux3", MUX3_I2C_ADDR, "mux2", 0)
+    tree.add_endpoint("a", "mux3", DDIMMA)
+    tree.add_endpoint("b", "mux3", DDIMMB)
+    return tree
+
+def apollo16_tree(i2c_bus_num, i2c_bus=None):
+    """ Apollo16: 0x70, then 0x73 with eight 0x71, each with two DDIMMs (a to p) """
+    tree = MuxTree(i2c_bus_num, i2c_bus)
+    tree.add_mux("mux1", MUX1_I2C_ADDR)
+    tree.add_mux("mux2", MUX2_I2C_ADDR, "mux1", 0)
+    for slot in range(APOLLO16_SLOTS // 2):
+        name = "mux3_{}".format(slot)
+        tree.add_mux(name, MUX3_I2C_ADDR, "mux2", slot)
+        tree.add_endpoint(chr(ord('a') + 2 * slot), name, DDIMMA)
+        tree.add_endpoint(chr(ord('a') + 2 * slot + 1), name, DDIMMB)
+    return tree
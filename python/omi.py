@@ -30,18 +30,54 @@ from components import *
 from constants import *
 from functions import *
 from fbist import *
+from ddimm_plan import *
+from polling import wait_until, POLL_EXP_DOORBELL
+import metrics
+from bustrace import tracer, TraceRing
+import timeline
+import simulator
+import busrecord
+from cronus import load_log
+import atexit
 import csv
 import traceback
 import signal
 import subprocess
+import os
+import sys
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
 
 
 revision = "1.3"
 
 @click.group()
 @click.option('--log/--no-log', default=False, help='Display more info about the execution of the command.')
-def main(log):
-    if log : logging.basicConfig(level=logging.INFO)
+@click.option('--stats/--no-stats', default=False, help='Print I2C transaction metrics (per device, per operation) at exit.')
+@click.option('--trace', 'trace_file', type=click.Path(dir_okay=False), default=None, help='Save the register access trace in this file at exit (see tracedump).')
+@click.option('--timeline', 'timeline_file', type=click.Path(dir_okay=False), default=None, help='Save the timing spans of the stages in this file at exit (Chrome trace-event JSON, open in ui.perfetto.dev).')
+@click.option('--sim', 'sim_file', type=click.Path(dir_okay=False), default=None, help='Run on a simulated board (DDIMM on port A) instead of the I2C adapter. Its state is kept in this file between runs.')
+@click.option('--record', 'record_file', type=click.Path(dir_okay=False), default=None, help='Record the I2C transactions in this file at exit (see --replay and recdump).')
+@click.option('--replay', 'replay_file', type=click.Path(exists=True, dir_okay=False), default=None, help='Answer the I2C transactions from a file saved with --record instead of the I2C adapter, without sleeping.')
+@click.pass_context
+def main(ctx, log, stats, trace_file, timeline_file, sim_file, record_file, replay_file):
+    if log :
+        logging.basicConfig(level=logging.INFO)
+        tracer.echo()
+    if sim_file:
+        simulator.install()
+        simulator.load_state(sim_file)
+        atexit.register(simulator.save_state, sim_file)
+    if replay_file: busrecord.replay(replay_file)
+    if record_file: busrecord.record(record_file)
+    if stats: metrics.enable(print_at_exit=True)
+    if trace_file: atexit.register(tracer.save, trace_file)
+    if timeline_file:
+        timeline.enable()
+        atexit.register(timeline.save, timeline_file)
+        command_span = timeline.span(ctx.invoked_subcommand, "command", args=" ".join(sys.argv[1:]))
+        command_span.__enter__()
+        ctx.call_on_close(lambda: command_span.__exit__(None, None, None))
 
 #########################################################
 #                   Providing version                   #
@@ -74,15 +110,21 @@ signal.signal(signal.SIGINT, handler)"""
 @click.option('-b', '--busnum', '_busnum', type=int, default=3, nargs=1, help='I2C bus number (default=3)')
 def scan(_busnum):
     "Scans the I2C buses."
-    setup_ddimm_path('a', 3, verbose = 1)
-    path_status(_busnum)
-    card=scan_bus(_busnum, verbose=1)
-    print("Detected card:", card, "\n")
-
-    setup_ddimm_path('b', 3, verbose = 1)
-    path_status(_busnum)
-    card=scan_bus(_busnum, verbose=1)
-    print("Detected card:", card)
+    # Fire's DDIMM detect register is only a hint (see port_cards): both ports are scanned
+    try:
+        present = Fire(_busnum).ddimm_present() or {}
+    except OSError:
+        logging.info("Fire not reachable, DDIMM detect register not read")
+        present = {}
+    for port in "ab":
+        setup_ddimm_path(port, _busnum, verbose = 1)
+        path_status(_busnum)
+        card=scan_bus(_busnum, verbose=1, full=True)
+        if present and present.get(port, False) != (card != "None"):
+            logging.info("DDIMM detect register says port {} is {}, scan found {}".format(
+                port, "populated" if present.get(port, False) else "empty", card))
+        topology.cards[(_busnum, port)] = card
+        print("Detected card:", card, "\n")
 main.add_command(scan)
 
 @click.command()
@@ -90,17 +132,20 @@ main.add_command(scan)
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
 def init(_busnum, _freq):
     " Initializes the explorer chip. This must be done before any other operation. "
-    if scan_bus(_busnum, verbose=0) == "DDIMM":
-        fire = Fire(_busnum, _freq)
+    fire = Fire(_busnum, _freq)
+    card = current_card(_busnum, fire)
+    if card == "DDIMM":
         explorer = Explorer(fire.freq, _busnum)
         set_pmics(_busnum)
         sleep(1)  # to allow chip to power up
         print("----------         : Explorer Initialization    ------------")
         explorer.init()
         #return
-    elif scan_bus(_busnum) == "GEMINI":
+    elif card == "GEMINI":
         print("------- : Nothing to do as ICE Initialization is automated with hardware   --------") 
-    else: print("Seems no card is selected (check I2C path or card availability)")
+    else:
+        print("Seems no card is selected (check I2C path or card availability)")
+        exit(1)
 
     print("> Suggested next command -> python3 omi.py sync -d <a/b>")
 main.add_command(init)
@@ -126,7 +171,7 @@ def info(_chip, _busnum, _freq):
     # Concerning devices, EXP and ice do not have the same address for ID,
     # so we use a criteria based on power managment chips to define which card is plugged
     elif _chip.lower() in ["explorer", "exp"]:
-        if scan_bus(_busnum, verbose=0) == "DDIMM":
+        if current_card(_busnum, Fire(_busnum, _freq)) == "DDIMM":
             explorer = Explorer(_freq, _busnum)
             eeprom = Eeprom(_busnum)
             try:
@@ -134,7 +179,7 @@ def info(_chip, _busnum, _freq):
                 explorer.get_firmware_info()
             except:
                 print("Error. Please make sure you ran init command first (After a reset and initpath).")
-                return
+                exit(1)
             print("ECID:", explorer.ecid)
             print("Entreprise Mode Status:", explorer.ese_mode_status)
             print("Card ID:", explorer.card_id)
@@ -145,22 +190,25 @@ def info(_chip, _busnum, _freq):
             print("WARNING ! EXPLORER chosen while card is not of type \"DDIMM\" on this port")
             print("   Choose -c ice option : python3 omi.py info -c ice")
             print("   or change path/card  : python3 omi.py initpath -d <port>")
+            exit(1)
 
     elif _chip.lower() in ["ice"]:
-        if scan_bus(_busnum, verbose=0) == "GEMINI":
+        if current_card(_busnum, Fire(_busnum, _freq)) == "GEMINI":
             ice = Ice(_freq, _busnum)
             try:
                 ice.getinfo()
             except:
                 print("Error. Please make sure you ran initpath command first (After a reset)\n       with the proper path to a programmed Gemini card.\n       OR ID is not available (old hdl codes)")
-                return
+                exit(1)
         else : 
             print("WARNING ! ICE chosen while card is not of type \"GEMINI\" on this port")
             print("   Choose -c exp option : python3 omi.py info -c exp")
             print("   or change path/card  : python3 omi.py initpath -d <port>")
+            exit(1)
 
     else:
         print("Chip provided is incorrect.")
+        exit(1)
 main.add_command(info)
 
 #########################################################
@@ -171,7 +219,8 @@ main.add_command(info)
 @click.option('-r', '--register', '_register', type=str, required=True, nargs=1, help='Register address to read (in hex)')
 @click.option('-c', '--chip', '_chip', type=str, required=True, nargs=1, help='Chip to read from (FIRE or EXPLORER/ICE)')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def read(_register, _chip, _busnum, _freq):
+@click.option('-o', '--omi', '_omi', type=click.Choice(['a', 'b']), default=None, help='Read the Explorer of this port through Fire MMIO when its OMI link is up')
+def read(_register, _chip, _busnum, _freq, _omi):
     "Reads from a double internal register."
     _register = int(_register, 16)
     
@@ -180,7 +229,8 @@ def read(_register, _chip, _busnum, _freq):
         #print(hex(fire.i2cread(_register)))
         print("Rd Fire Addr {:#010x} : {:#018x}".format(_register,fire.i2cread(_register)))
     elif _chip.lower() in ["explorer", "exp"]:
-        explorer = Explorer(_freq, _busnum)
+        if _omi: explorer = Explorer(_freq, _busnum, fire=Fire(_busnum, _freq), ddimm=_omi)
+        else:    explorer = Explorer(_freq, _busnum)
         #print(hex(explorer.i2c_double_read(_register)))
         print("Rd EXP Addr {:#010x} : {:#018x}".format(_register,explorer.i2c_double_read(_register)))
     elif _chip.lower() in ["ice", "gemini"]:
@@ -231,6 +281,7 @@ def readexp(_register, _chip, _busnum, _freq, _expect):
         print("Rd Fire Addr {:#010x} : {:#018x}, Expect: {:#018x}".format(_register,read_value,_expect))
         if read_value != _expect:
            print("WARNING ! Failure with expectation!")
+           exit(1)
     elif _chip.lower() in ["explorer", "exp"]:
         explorer = Explorer(fire.freq, _busnum)
         #print(hex(explorer.i2c_double_read(_register)))
@@ -238,12 +289,14 @@ def readexp(_register, _chip, _busnum, _freq, _expect):
         print("Rd EXP Addr {:#010x} : {:#018x}, Expect: {:#018x}".format(_register,read_value, _expect))
         if read_value != _expect:
             print("WARNING ! Failure with expectation!")
+            exit(1)
     elif _chip.lower() in ["ice", "gemini"]:
         ice = Ice(fire.freq, _busnum)
         read_value = ice.i2c_double_read(_register)
         print("Rd ICE Addr {:#010x} : {:#018x}, Expect: {:#018x}".format(_register,read_value, _expect))
         if read_value != _expect:
            print("WARNING ! Failure with expectation!")
+           exit(1)
 main.add_command(readexp)
 
 #########################################################
@@ -282,28 +335,39 @@ main.add_command(i2cread)
 @click.option('-d', '--data', '_data', type=str, required=True, nargs=1, help='Data value to write to the register (in hex)')
 @click.option('-c', '--chip', '_chip', type=str, required=True, nargs=1, help='Chip to read from (FIRE or ICE)')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def write(_register, _data, _chip, _busnum, _freq):
+@click.option('-v', '--verify', '_verify', type=click.Choice(VERIFY_POLICIES), default=VERIFY_ALWAYS, help='Write verify policy (default=always)')
+@click.option('-o', '--omi', '_omi', type=click.Choice(['a', 'b']), default=None, help='Write the Explorer of this port through Fire MMIO when its OMI link is up')
+def write(_register, _data, _chip, _busnum, _freq, _verify, _omi):
     "Writes to an internal reg."
     _register = int(_register, 16)
     _data = int(_data, 16)
-    fire = Fire(_busnum, _freq)
+    fire = Fire(_busnum, _freq, verify=_verify)
     if _chip.lower() == "fire":
         res = fire.i2cwrite(_register, _data)
+        if _verify == VERIFY_DEFERRED: res = not fire.flush_verify()
         print("Wr Fire Addr {:#010x} : {:#018x}".format(_register, _data))
-        print("Writing check : {}".format("Success" if res else "Failed"))
+        print_write_check(res, _verify)
     elif _chip.lower() in ["explorer", "exp"]:
-        explorer = Explorer(fire.freq, _busnum)
+        explorer = Explorer(fire.freq, _busnum, verify=_verify, fire=fire if _omi else None, ddimm=_omi or "a")
         res = explorer.i2c_double_write(_register, _data)
+        if _verify == VERIFY_DEFERRED: res = not explorer.flush_verify()
         print("Wr Expl Addr {:#010x} : {:#018x}".format(_register, _data))
-        print("Writing check : {}".format("Success" if res else "Failed"))
+        print_write_check(res, _verify)
     elif _chip.lower() in ["ice", "gemini"]:
         ice = Ice(fire.freq, _busnum)
         print(hex(ice.i2c_double_read(_register)))
     else:
         print("Chip provided is incorrect.")
+        exit(1)
 main.add_command(write)
 
 
+def print_write_check(res, policy):
+    if policy in [VERIFY_OFF, VERIFY_SAMPLED] and res: print("Writing check : not read back (verify {})".format(policy))
+    else: print("Writing check : {} (verify {})".format("Success" if res else "Failed", policy))
+    if not res: exit(1)
+
+
 #########################################################
 #             Write single internal Explorer reg        #
 #########################################################
@@ -313,21 +377,25 @@ main.add_command(write)
 @click.option('-d', '--data', '_data', type=str, required=True, nargs=1, help='Data value to write to the register (in hex)')
 @click.option('-c', '--chip', '_chip', type=str, required=True, nargs=1, help='Chip to read from (FIRE or ICE)')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def writereg(_register, _data, _chip, _busnum, _freq):
+@click.option('-v', '--verify', '_verify', type=click.Choice(VERIFY_POLICIES), default=VERIFY_ALWAYS, help='Write verify policy (default=always)')
+def writereg(_register, _data, _chip, _busnum, _freq, _verify):
     "Writes to a single internal reg (only for explorer)"
     _register = int(_register, 16)
     _data = int(_data, 16)
     fire = Fire(_busnum, _freq)
     if _chip.lower() in ["explorer", "exp"]:
-        explorer = Explorer(fire.freq, _busnum)
+        explorer = Explorer(fire.freq, _busnum, verify=_verify)
         res = explorer.i2c_simple_writereg(_register, _data)
+        if _verify == VERIFY_DEFERRED: res = not explorer.verifier.flush(lambda regs: [explorer.i2c_simple_readreg(reg) for reg in regs])
         print("Wr Expl Addr {:#010x} : {:#010x}".format(_register, _data))
-        print("Writing check : {}".format("Success" if res else "Failed"))
+        print_write_check(res, _verify)
     elif _chip.lower() in ["ice", "gemini"]:
         #ice = Ice(fire.freq, _busnum)
         print("ERROR !! Not implemented for ICE !")
+        exit(1)
     else:
         print("Chip provided is incorrect.")
+        exit(1)
 main.add_command(writereg)
 
 
@@ -355,6 +423,7 @@ def i2cwrite(_data, _chip, _busnum, _freq):
         res = ice.i2cwrite(_data)
     else:
         print("Chip provided is incorrect.")
+        exit(1)
     
 main.add_command(i2cwrite)
 
@@ -369,10 +438,12 @@ main.add_command(i2cwrite)
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
 def ddimmreset(_ddimm, _state, _busnum, _freq):
     "Sets the reset state of the DDIMMs (In RESET mode : ON | Out RESET mode : OFF)."
-    fire = Fire(_busnum, _freq)
+    fire = Fire(_busnum, _freq, shadow=True)
     if _state.lower() == "on": fire.set_ddimm_on_reset(_ddimm)
     elif _state.lower() == "off": fire.set_ddimm_off_reset(_ddimm)
-    else : print("State provided is not supported.")
+    else :
+        print("State provided is not supported.")
+        exit(1)
 
 main.add_command(ddimmreset)
 
@@ -388,7 +459,7 @@ def initpath(_busnum, _ddimm):
     " Setups I2C path to selected DDIMM. "
     if len(_ddimm) > 1 and _ddimm.lower() != "none":
         print("Please provide a valid ddimm letter (a or b) or none.")
-        return
+        exit(1)
     setup_ddimm_path(_ddimm, _busnum, verbose = 1)
     path_status(_busnum)
     #set_pmics(_busnum) # removed from setup_dimm_path & moved to init step
@@ -416,7 +487,7 @@ main.add_command(checkpath)
 def checksync(_busnum, _ddimm, _freq):
     " Checks for the training/syncing status of a DDIMM. "
     fire = Fire(_busnum, _freq)
-    fire.check_sync(_ddimm, verbose=1)
+    if not fire.check_sync(_ddimm, verbose=1): exit(1)
 
 main.add_command(checksync)
 
@@ -425,23 +496,28 @@ main.add_command(checksync)
 @click.option('-d', '--ddimm', '_ddimm', type=str, required=True, nargs=1, help='''DDIMMs to sync. Write the letters of DDIMMs without spaces.
                 (Examples: a, b, ab)''')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def sync(_busnum, _ddimm, _freq):
+@click.option('-v', '--verify', '_verify', type=click.Choice(VERIFY_POLICIES), default=VERIFY_DEFERRED, help='Verify policy of the training writes (default=deferred)')
+@click.option('--retrain/--no-retrain', '_retrain', default=None, help='Retrain (or not) a link already in sync without asking. (default=ask)')
+def sync(_busnum, _ddimm, _freq, _verify, _retrain):
     " Trains/Syncs the provided DDIMM/Gemini with Fire. "
-    fire = Fire(_busnum, _freq)
+    fire = Fire(_busnum, _freq, shadow=True)
+    failed = False
     for i in range (0, len(_ddimm)):
-        card = scan_bus()
+        card = port_cards(_busnum, fire, _ddimm[i])[_ddimm[i].lower()]
         #print(card)
         if card in ["DDIMM"]:
             try:
-                explorer = Explorer(fire.freq, _busnum)
+                explorer = Explorer(fire.freq, _busnum, verify=_verify)
             except Exception as e:
                 print("Error with Explorer class!")
-                exit()
+                exit(1)
        
             print("Sync DDIMM on PORT {}...".format(_ddimm[i].upper()), end=" ")
             if fire.check_sync(_ddimm[i], verbose=0):
-                resp = input("Already in sync. Retrain ? [Y/n]: ")
-                if resp.lower() == "y":
+                retrain = _retrain
+                if retrain is None: retrain = input("Already in sync. Retrain ? [Y/n]: ").lower() == "y"
+                elif retrain: print("Already in sync. Retraining")
+                if retrain:
                     fire.retrain(_ddimm[i], verbose=1)
                 continue
 
@@ -450,6 +526,7 @@ def sync(_busnum, _ddimm, _freq):
             try:
                 print("\n----------        Explorer OMI Training Sequence ------------")
                 explorer.sync()
+                logging.info(explorer.verifier.stats())
                 sleep(1)
                 print("\n----------        Fire     OMI Training Sequence ------------")
                 fire.sync(_ddimm[i])
@@ -458,26 +535,31 @@ def sync(_busnum, _ddimm, _freq):
                 print("DDIMM on PORT {} sync Reg: ".format(_ddimm[i].upper()), end="")
                 sleep(1)
                 explorer.check_sync()
-                fire.check_sync(_ddimm[i], verbose=1)
+                if not fire.check_sync(_ddimm[i], verbose=1): failed = True
 
             except Exception as e:
                 print(traceback.format_exc())
                 print("Error. Please make sure you ran init command first (After a reset and initpath).")
-                
+                failed = True
+
         elif card in ["GEMINI"]:
             if _ddimm[i] == "a":
                 ddimm_add_adj=0x00000000
             elif _ddimm[i] == "b":
                 ddimm_add_adj=0x00000400
-            else: print("ERROR !!: incorrect ddimm selection !!")    
+            else:
+                print("ERROR !!: incorrect ddimm selection !!")
+                exit(1)
 
             fire.set_ddimm_on_reset(_ddimm[i])
             fire.set_ddimm_off_reset(_ddimm[i])
 
             print("Sync GEMINI on PORT {}...".format(_ddimm[i].upper()))
             if fire.check_sync(_ddimm[i], 0):
-                resp = input("Already in sync. Retrain? [Y/n] ")
-                if resp.lower() == "y":
+                retrain = _retrain
+                if retrain is None: retrain = input("Already in sync. Retrain? [Y/n] ").lower() == "y"
+                elif retrain: print("Already in sync. Retraining")
+                if retrain:
                     fire.retrain(_ddimm[i], verbose=1)
                 continue
 
@@ -487,7 +569,7 @@ def sync(_busnum, _ddimm, _freq):
             try:
                 print("\n----------        Fire     OMI Training Sequence ------------")
                 fire.sync(_ddimm[i])
-                fire.check_sync(_ddimm[i], verbose=1)
+                if not fire.check_sync(_ddimm[i], verbose=1): failed = True
 
                 #ice.check_sync()
                 #Id_reg = self.i2c_double_read(ICE_ID_NUM_REG)
@@ -497,11 +579,13 @@ def sync(_busnum, _ddimm, _freq):
             except Exception as e:
                 print(traceback.format_exc())
                 print("ERROR !! ICE OMI links Synchro failed")
-                exit()
+                exit(1)
 
         else :
             print("WARNING : Unknown or no card plugged")
-            exit()
+            exit(1)
+    logging.info(fire.shadow_stats())
+    if failed: exit(1)
 
 main.add_command(sync)
 
@@ -516,9 +600,11 @@ main.add_command(sync)
                 (Examples: a, b, ab)''')
 @click.option('-c', '--chip', '_chip', type=str, default="exp", nargs=1, help='Chip to read from (FIRE or ICE)')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def ddimmcfg(_busnum, _ddimm, _chip, _freq):
+@click.option('--diff/--full', '_diff', default=False, help='Only write the registers whose content differs (to resume a partly configured DDIMM). (default=full)')
+def ddimmcfg(_busnum, _ddimm, _chip, _freq, _diff):
     " Configures the provided DDIMM with Fire. "
     fire = Fire(_busnum, _freq)
+    failed = False
 
     if _chip.lower() in ["explorer", "exp"]:    
         for i in range (0, len(_ddimm)):
@@ -526,7 +612,9 @@ def ddimmcfg(_busnum, _ddimm, _chip, _freq):
                 ddimm_add_adj=0x00000000
             elif _ddimm[i] == "b":
                 ddimm_add_adj=0x00000400
-            else: print("ERROR !!: incorrect ddimm selection !!")
+            else:
+                print("ERROR !!: incorrect ddimm selection !!")
+                exit(1)
 
             explorer = Explorer(fire.freq, _busnum)
             eeprom   = Eeprom(_busnum)
@@ -534,136 +622,28 @@ def ddimmcfg(_busnum, _ddimm, _chip, _freq):
             print("   ------------    \nConfiguring DDIMM{}...".format(_ddimm[i].upper()), end=" \n")
             setup_ddimm_path(_ddimm[i], _busnum, verbose = 0)
             print("DDIMM{} Configuration ".format(_ddimm[i].upper()), end="\n")
-            """getting Memory size """
-            eeprom = Eeprom(_busnum)
-            _memory_size = eeprom.get_info()
             """ getting Vendor ID in Fire's reg : 0x2001040X00000000 with 
             0x10000006361014 for IBM/MICRON
             0xff010002ff010002 for SMART
             doesn't work properly
-            Using alternative method"""
-
-            """vendor_reg = explorer.i2c_double_read(0x20b080)
-            logging.info(hex(vendor_reg))
-            if (vendor_reg == 0x00000000000796): _vendor = "SMART"
-            elif (vendor_reg == 0x00000000000596) or (vendor_reg == 0x00000000000197):_vendor = "IBM/MICRON"
-            else:print("ERROR !!: Bad Vendor ID :")
-            print("Vendor      :", end=" ")
-            print(_vendor)
-            logging.info(hex(ddimm_add_adj))"""
-
-            data = eeprom.get_info()
-            _memory_size = data[0]
-            _vendor = data[1]
+            Using alternative method: Memory size and Vendor from the EEPROM"""
 
+            _memory_size, _vendor = eeprom.get_info()
 
             if (_vendor == "MICRON") or (_vendor == "SMART"):
                 print("Board type  : DDIMM")
-                fire.reg_ops(fire.steps2122_exp, _ddimm[i], _vendor, _memory_size)
-                fire.reg_ops(fire.steps25_a0, _ddimm[i], _vendor, _memory_size)
             else:
                 print("Board type  : Gemini")
-                fire.reg_ops(fire.steps2122_ice, _ddimm[i], _vendor, _memory_size)
+                result = fire.reg_ops(fire.steps2122_ice, _ddimm[i], _vendor, _memory_size)
+                if result is None or not result.ok(): exit(1)
                 print("> Suggested next command -> python3 omi.py fbistcfg -d <a/b>")
-                return 1
-
-            if _vendor == "MICRON":
-                fire.reg_ops(fire.steps25_a1_MICRON, _ddimm[i], _vendor, _memory_size)
-            elif _vendor == "SMART":
-                fire.reg_ops(fire.steps25_a1_SMART, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Unsupported Vendor ID"); return 1
-
-            fire.reg_ops(fire.steps25_a2, _ddimm[i], _vendor, _memory_size)
-
-            if _memory_size == 32:
-                fire.reg_ops(fire.steps25_a3_32, _ddimm[i], _vendor, _memory_size)
-            elif _memory_size == 64:
-                fire.reg_ops(fire.steps25_a3_64, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Bad Memory size"); return 1
-
-            fire.reg_ops(fire.steps25_a4, _ddimm[i], _vendor, _memory_size)
-
-            if _memory_size == 32:
-                fire.reg_ops(fire.steps25_a5_32, _ddimm[i], _vendor, _memory_size)
-            elif _memory_size == 64:
-                fire.reg_ops(fire.steps25_a5_64, _ddimm[i], _vendor, _memory_size)
-
-            fire.reg_ops(fire.steps25_a6, _ddimm[i], _vendor, _memory_size)
-
-            if _memory_size == 32:
-                fire.reg_ops(fire.steps25_a7_32, _ddimm[i], _vendor, _memory_size)
-            elif _memory_size == 64:
-                fire.reg_ops(fire.steps25_a7_64, _ddimm[i], _vendor, _memory_size)
-
-            fire.reg_ops(fire.steps25_a8, _ddimm[i], _vendor, _memory_size)
-
-            if _vendor == "MICRON":
-                fire.reg_ops(fire.steps25_a9_MICRON, _ddimm[i], _vendor, _memory_size)
-            elif _vendor == "SMART":
-                fire.reg_ops(fire.steps25_a9_SMART, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Unsupported Vendor ID"); return 1
-
-            fire.reg_ops(fire.steps25_a10, _ddimm[i], _vendor, _memory_size)   
-
-            if (_vendor == "MICRON") & (_memory_size == 32):
-                fire.reg_ops(fire.steps25_a11_MICRON_32, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "MICRON") & (_memory_size == 64):
-                fire.reg_ops(fire.steps25_a11_MICRON_64, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "SMART") & (_memory_size == 32):
-                fire.reg_ops(fire.steps25_a11_SMART_32, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "SMART") & (_memory_size == 64):
-                fire.reg_ops(fire.steps25_a11_SMART_64, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Unsupported Vendor ID/Memory size combination"); return 1
-
-            check_status(_busnum, _ddimm[i], _freq)
-
-            fire.reg_ops(fire.steps25_b, _ddimm[i], _vendor, _memory_size)
-
-            if _memory_size == 32:
-                fire.reg_ops(fire.step26_a0_32, _ddimm[i], _vendor, _memory_size)
-            elif _memory_size == 64:
-                fire.reg_ops(fire.step26_a0_64, _ddimm[i], _vendor, _memory_size)
-
-            fire.reg_ops(fire.step26_a1, _ddimm[i], _vendor, _memory_size)
-
-            if _vendor == "MICRON":
-                fire.reg_ops(fire.step26_a2_MICRON, _ddimm[i], _vendor, _memory_size)
-            elif _vendor == "SMART":
-                fire.reg_ops(fire.step26_a2_SMART, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Unsupported Vendor ID"); return 1
-
-            fire.reg_ops(fire.steps26_a3, _ddimm[i], _vendor, _memory_size)
-
-            if (_vendor == "MICRON") & (_memory_size == 32):
-                fire.reg_ops(fire.steps26_a4_MICRON_32, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "MICRON") & (_memory_size == 64):
-                fire.reg_ops(fire.steps26_a4_MICRON_64, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "SMART") & (_memory_size == 32):
-                fire.reg_ops(fire.steps26_a4_SMART_32, _ddimm[i], _vendor, _memory_size)
-            elif (_vendor == "SMART") & (_memory_size == 64):
-                fire.reg_ops(fire.steps26_a4_SMART_64, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR !!: Unsupported Vendor ID/Memory size combination"); return 1
-
-            check_status(_busnum, _ddimm[i], _freq)
-
-            fire.reg_ops(fire.steps_26b0, _ddimm[i], _vendor, _memory_size)
-
-            if _vendor == "MICRON":
-                fire.reg_ops(fire.steps_26b1_MICRON, _ddimm[i], _vendor, _memory_size)
-            elif _vendor == "SMART":
-                fire.reg_ops(fire.steps_26b1_SMART, _ddimm[i], _vendor, _memory_size)
-            else: print("ERROR: Unsupported Vendor ID"); return 1
-
-            fire.reg_ops(fire.steps_26b2, _ddimm[i], _vendor, _memory_size)
-            fire.reg_ops(fire.steps27_a0, _ddimm[i], _vendor, _memory_size)
-
-            if _memory_size == 32:
-                fire.reg_ops(fire.steps27_a1_32, _ddimm[i], _vendor, _memory_size)
-            elif _memory_size == 64:
-                fire.reg_ops(fire.steps27_a1_64, _ddimm[i], _vendor, _memory_size)
-
-            fire.reg_ops(fire.steps27_a2, _ddimm[i], _vendor, _memory_size)
+                return
 
+            # Tables to run are resolved once per (vendor, size, port) and replayed in batches,
+            # waiting for the Explorer firmware response between the command steps
+            plan = get_plan(_vendor, _memory_size, _ddimm[i])
+            if plan is None: exit(1)
+            if not plan.run(fire, lambda: check_status(_busnum, _ddimm[i], _freq, fire), _diff): failed = True
 
             try:
                 explorer = Explorer(fire.freq, _busnum)
@@ -671,6 +651,7 @@ def ddimmcfg(_busnum, _ddimm, _chip, _freq):
             except Exception as e:
                 print(traceback.format_exc())
                 print("Error. Please make sure you ran init command first (After a reset and initpath).")
+                failed = True
 
     if _chip.lower() in ["ice"]:
         for i in range (0, len(_ddimm)):
@@ -678,15 +659,19 @@ def ddimmcfg(_busnum, _ddimm, _chip, _freq):
                 ddimm_add_adj=0x00000000
             elif _ddimm[i] == "b":
                 ddimm_add_adj=0x00000400
-            else: print("ERROR !!: incorrect ddimm selection !!")
+            else:
+                print("ERROR !!: incorrect ddimm selection !!")
+                exit(1)
 
             ice = Ice(fire.freq, _busnum)
             print("   ------------    \nConfiguring DDIMM{}...".format(_ddimm[i].upper()), end=" \n")
             setup_ddimm_path(_ddimm[i], _busnum, verbose = 0)
             print("DDIMM{} Configuration ".format(_ddimm[i].upper()), end="\n")
 
-            fire.reg_ops(fire.steps2122, _ddimm[i], "MICRON", "64\"")
+            result = fire.reg_ops(fire.steps2122, _ddimm[i], "MICRON", "64\"")
+            if result is None or not result.ok(): failed = True
 
+    if failed: exit(1)
     print("> Suggested next command -> python3 omi.py fbistcfg -d <a/b>")
 
 main.add_command(ddimmcfg)
@@ -695,25 +680,25 @@ main.add_command(ddimmcfg)
 #                  CHECKER                              #
 #########################################################
 
-def check_status(_busnum, _ddimm, _freq):
-    fire = Fire(_busnum, _freq)
-    explorer = Explorer(fire.freq, _busnum)    
+@timeline.spanned("check_status")
+def check_status(_busnum, _ddimm, _freq, fire=None):
+    if fire is None: fire = Fire(_busnum, _freq)
     logging.info(_ddimm)
     if _ddimm == "a":
         ddimm_add_adj=0x00000000
     elif _ddimm == "b":
         ddimm_add_adj=0x00000400
-    else: print("ERROR !!: incorrect ddimm selection !!")
+    else:
+        print("ERROR !!: incorrect ddimm selection !!")
+        exit(1)
 
-    c = 0
-    while (hex(fire.i2cread(0x2001000100002058+(ddimm_add_adj<<32))) != "0x1"):
-        logging.info("waiting for response RDY")
-        sleep(1)
-        c=c+1
-        if (c == 50):
-            return 1
-    logging.info("0x2058 is : " + hex(fire.i2cread(0x2001000100002058+(ddimm_add_adj<<32))))
-    if fire.i2cread(0x300100010103FF20+(ddimm_add_adj<<32)) != 1: logging.info("Failure 0x30010x010103FF20 is not 0x1 !!"); return 1
+    logging.info("waiting for response RDY")
+    ready, doorbell = wait_until(lambda: fire.i2cread(0x2001000100002058+(ddimm_add_adj<<32)), MASK_ALL, 0x1,
+                                 POLL_EXP_DOORBELL_TIMEOUT, POLL_EXP_DOORBELL)
+    if not ready: return 1
+    logging.info("0x2058 is : " + hex(doorbell))
+    # only logged: the reference runs (steps25_b) read 0 there once the firmware answered
+    if fire.i2cread(0x300100010103FF20+(ddimm_add_adj<<32)) != 1: logging.info("Failure 0x30010x010103FF20 is not 0x1 !!")
 
 #########################################################
 #                  FBIST CONFIGURATION                  #
@@ -724,15 +709,149 @@ def check_status(_busnum, _ddimm, _freq):
 @click.option('-d', '--ddimm', '_ddimm', type=str, required=True, nargs=1, help='''DDIMMs to sync. Write the letters of DDIMMs without spaces.
                 (Examples: a, b, ab)''')
 @click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
-def fbistcfg(_busnum, _ddimm, _freq):
+@click.option('-e', '--engines', '_engines', type=click.IntRange(1, 8), default=None, help='Number of engines to enable (1 to 8). Asked if not given.')
+@click.option('-a', '--access', '_access', type=click.Choice(['2', '4']), default=None, help='Bytes per access: 2 for 64B, 4 for 128B. Asked if not given.')
+@click.option('-s', '--spacing', '_spacing', type=str, default=None, help='Cycles between flits, in hex (from FF to 0, typical is 0). Asked if not given.')
+@click.option('--read/--no-read', '_read', default=None, help='Run (or not) the read procedure after the write one. (default=ask)')
+def fbistcfg(_busnum, _ddimm, _freq, _engines, _access, _spacing, _read):
     " Runs a fbist test on selected DDIMM. "
     fire = Fire(_busnum, _freq)
-    fbist = Fbist()
+    fbist = Fbist(fire)
 
-    fbist.fbist(_busnum, _ddimm)
+    if not fbist.fbist(_busnum, _ddimm, _engines, _access, _spacing, _read): exit(1)
     #fbist.fbist_stats_wr(_busnum, _ddimm)
     
 main.add_command(fbistcfg)
+
+
+#########################################################
+#                  TRACE DUMP                           #
+#########################################################
+@click.command()
+@click.argument('_file', type=click.Path(exists=True, dir_okay=False), metavar='FILE')
+@click.option('-n', '--last', '_last', type=int, default=None, help='Only print the last records')
+def tracedump(_file, _last):
+    " Prints a register access trace saved with --trace. "
+    ring = TraceRing.load(_file)
+    if ring is None: exit(1)
+    ring.dump(last=_last)
+
+main.add_command(tracedump)
+
+
+@click.command()
+@click.argument('_file', type=click.Path(exists=True, dir_okay=False), metavar='FILE')
+def recdump(_file):
+    " Prints the I2C transactions recorded with --record. "
+    recording = busrecord.BusRecording.load(_file)
+    if recording is None: exit(1)
+    recording.dump()
+
+main.add_command(recdump)
+
+
+#########################################################
+#                  CRONUS LOG IMPORT                    #
+#########################################################
+@click.command()
+@click.argument('_file', type=click.Path(exists=True, dir_okay=False), metavar='FILE')
+@click.option('-b', '--busnum', '_busnum', type=int, default=3, nargs=1, help='I2C bus number (default=3)')
+@click.option('-d', '--ddimm', '_ddimm', type=click.Choice(['a', 'b']), default='a', help='DDIMM to run the log on (default=a)')
+@click.option('-f', '--freq', '_freq', type=int, default=333, nargs=1, help='Fire\'s frequency. The program will try to retrieve automatically the version. This value will be used otherwise. (default=333)')
+@click.option('--run/--print', '_run', default=False, help='Run the imported log on the DDIMM, or print it as Fire step tables. (default=print)')
+def cronus(_file, _busnum, _ddimm, _freq, _run):
+    " Imports a CRONUS log (PUTI2C/GETI2C, i2c_double_read/write lines) without its redundant accesses. "
+    recipe = load_log(_file)
+    print("CRONUS log:", recipe.stats)
+    print("Imported: {} register accesses in {} batches, {} frames/waits".format(
+        sum(len(seq) for seq in recipe.sequences()), len(recipe.sequences()), len(recipe.steps) - len(recipe.sequences())))
+    if not _run:
+        print(recipe.format_tables())
+        return
+    fire = Fire(_busnum, _freq)
+    explorer = Explorer(fire.freq, _busnum, fire=fire, ddimm=_ddimm)
+    if not recipe.run(fire, explorer): exit(1)
+
+main.add_command(cronus)
+
+
+#########################################################
+#                  FLEET MODE                           #
+#   eg python3 omi.py fleet -b 3-6,9 sync -d a          #
+#########################################################
+FLEET_COMMANDS = ["scan", "init", "info", "read", "readreg", "readexp", "i2cread", "checkpath", "checksync",
+                  "sync", "ddimmreset", "initpath", "ddimmcfg", "fbistcfg"]
+
+def parse_buses(spec):
+    """ "3,4,6-8" -> [3, 4, 6, 7, 8] """
+    buses = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item: continue
+        first, _, last = item.partition("-")
+        for bus in range(int(first), int(last or first) + 1):
+            if bus not in buses: buses.append(bus)
+    return buses
+
+def run_on_bus(bus, command, args, options, logdir):
+    """ Run one omi.py command on a bus in its own process. Returns (bus, return code, seconds, output) """
+    cmd = [sys.executable, os.path.abspath(__file__)] + options + [command, "-b", str(bus)] + list(args)
+    start = monotonic()
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    duration = monotonic() - start
+    if logdir is not None:
+        with open(os.path.join(logdir, "bus{}_{}.log".format(bus, command)), "w") as f:
+            f.write(proc.stdout)
+    return bus, proc.returncode, duration, proc.stdout
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('-b', '--busnum', '_buses', type=str, required=True, nargs=1, help='I2C buses to run on: list and/or ranges (Examples: 3,4 or 3-10 or 3,6-8)')
+@click.option('-o', '--logdir', '_logdir', type=click.Path(file_okay=False), default=None, help='Write the output of each bus in <logdir>/bus<N>_<command>.log instead of the console')
+@click.argument('_command', type=click.Choice(FLEET_COMMANDS), metavar='COMMAND')
+@click.argument('_args', nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def fleet(ctx, _buses, _logdir, _command, _args):
+    """ Runs an omi.py command on several I2C buses in parallel, one worker per bus.
+        Options after COMMAND are passed to it (except -b). Commands must not wait for
+        an answer: give eg --retrain/--no-retrain to sync, -e -a -s --read to fbistcfg. """
+    try:
+        buses = parse_buses(_buses)
+    except ValueError:
+        print("ERROR !! Bad bus list:", _buses)
+        exit(1)
+    if not buses:
+        print("ERROR !! No bus to run on")
+        exit(1)
+    if _logdir is not None: os.makedirs(_logdir, exist_ok=True)
+    # main options (--log, --stats) are given to every bus
+    options = ["--{}".format(name) for name, value in ctx.find_root().params.items() if value is True]
+
+    print("Running '{}' on buses {}...".format(" ".join((_command,) + _args), ", ".join(str(b) for b in buses)))
+    start = monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=len(buses)) as pool:
+        jobs = [pool.submit(run_on_bus, bus, _command, _args, options, _logdir) for bus in buses]
+        # each bus output is printed as one block, in bus order, so outputs never interleave
+        for job in jobs:
+            bus, returncode, duration, output = job.result()
+            # the commands exit with a nonzero code on failure
+            status = "OK" if returncode == 0 else "rc={}".format(returncode)
+            results.append((bus, status, duration))
+            if _logdir is None:
+                print("\n==================== bus {} ====================".format(bus))
+                print(output, end="" if output.endswith("\n") else "\n")
+    elapsed = monotonic() - start
+
+    print("\n==================== fleet report ====================")
+    print("{:>5}  {:<12} {:>8} {:>10}".format("bus", "command", "status", "time (s)"))
+    for bus, status, duration in results:
+        print("{:>5}  {:<12} {:>8} {:>10.2f}".format(bus, _command, status, duration))
+    failed = [bus for bus, status, duration in results if status != "OK"]
+    print("{} buses, {} failed{}".format(len(results), len(failed), (" (" + ", ".join(str(b) for b in failed) + ")") if failed else ""))
+    print("Wall time {:.2f}s, serial time {:.2f}s".format(elapsed, sum(r[2] for r in results)))
+    if failed: ctx.exit(1)
+
+main.add_command(fleet)
                                     
 
 if __name__ == "__main__":
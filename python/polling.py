@@ -0,0 +1,190 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+import os
+import json
+import atexit
+import logging
+from time import sleep, monotonic
+
+from constants import *
+from functions import LatencyHistogram
+from timeline import span
+
+##################################################################################
+#   Polling of a hardware condition.                                             #
+#   wait_until() reads a register until (value & mask) == expected, sleeping    #
+#   between two reads as told by a policy, and gives up after a deadline.       #
+#   The latency of every wait is recorded per policy name in a histogram, which #
+#   is kept across runs in a small JSON file:                                    #
+#       PollPolicy    : exponential backoff, first interval doubled up to max   #
+#       LearnedPolicy : first sleep is the median latency recorded for the wait,#
+#                       then the same exponential backoff                       #
+##################################################################################
+
+POLL_STATS_FILE = os.environ.get("OMI_POLL_STATS", os.path.join(os.path.expanduser("~"), ".cache", "omi_enablement", "poll_stats.json"))
+POLL_LEARN_MIN_SAMPLES = 5      # recorded waits needed before a LearnedPolicy trusts its histogram
+POLL_LEARN_QUANTILE = 0.5
+
+
+class WaitHistogram(LatencyHistogram):
+    def __init__(self, name):
+        LatencyHistogram.__init__(self, name)
+        self.timeouts = 0
+        self.reads = 0
+
+    def record(self, latency, reads=1, timeout=False):
+        LatencyHistogram.record(self, latency)
+        self.reads += reads
+        if timeout: self.timeouts += 1
+
+    def merge(self, other):
+        LatencyHistogram.merge(self, other)
+        self.timeouts += other.timeouts
+        self.reads += other.reads
+
+    def to_dict(self):
+        d = LatencyHistogram.to_dict(self)
+        d.update(timeouts=self.timeouts, reads=self.reads)
+        return d
+
+    @classmethod
+    def from_dict(cls, name, d):
+        hist = cls(name).load_dict(d)
+        hist.timeouts, hist.reads = d["timeouts"], d["reads"]
+        return hist
+
+    def __str__(self):
+        if self.count == 0: return "{}: no wait".format(self.name)
+        return "{}: {} waits ({} timeouts), {:.1f} reads/wait, {}".format(
+            self.name, self.count, self.timeouts, self.reads / self.count, self.latencies())
+
+
+wait_stats = {}     # policy name -> WaitHistogram of this run
+wait_history = None # policy name -> WaitHistogram of the previous runs (loaded on first use)
+
+def load_wait_history():
+    global wait_history
+    if wait_history is None:
+        wait_history = {}
+        try:
+            with open(POLL_STATS_FILE) as f:
+                for name, d in json.load(f).items(): wait_history[name] = WaitHistogram.from_dict(name, d)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return wait_history
+
+def save_wait_stats():
+    """ Merge the waits of this run into the stats file """
+    if not wait_stats: return
+    merged = {}
+    for name, hist in list(load_wait_history().items()) + list(wait_stats.items()):
+        merged.setdefault(name, WaitHistogram(name)).merge(hist)
+    try:
+        os.makedirs(os.path.dirname(POLL_STATS_FILE), exist_ok=True)
+        tmp = "{}.{}".format(POLL_STATS_FILE, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({name: hist.to_dict() for name, hist in merged.items()}, f)
+        os.replace(tmp, POLL_STATS_FILE)
+    except OSError as err:
+        logging.info("Could not save polling stats: {}".format(err))
+
+def record_wait(name, latency, reads, timeout=False):
+    hist = wait_stats.get(name)
+    if hist is None: hist = wait_stats[name] = WaitHistogram(name)
+    hist.record(latency, reads, timeout)
+
+def print_wait_stats():
+    for name in sorted(wait_stats): print(wait_stats[name])
+
+persist_wait_stats = True  # cleared when the buses are simulated or replayed, their latencies are not the hardware ones
+
+def at_exit():
+    for name in sorted(wait_stats): logging.info("Polling " + str(wait_stats[name]))
+    if persist_wait_stats: save_wait_stats()
+
+atexit.register(at_exit)
+
+
+class PollPolicy:
+    def __init__(self, name, first, maximum, factor=2.0):
+        self.name = name
+        self.first = first          # first sleep (s)
+        self.maximum = maximum      # longest sleep (s)
+        self.factor = factor
+
+    def intervals(self):
+        interval = self.first
+        while True:
+            yield interval
+            interval = min(interval * self.factor, self.maximum)
+
+
+class LearnedPolicy(PollPolicy):
+    def typical(self):
+        """ Median latency of this wait in the previous runs and this one, None if not enough data """
+        hist = WaitHistogram(self.name)
+        for stats in (load_wait_history(), wait_stats):
+            if self.name in stats: hist.merge(stats[self.name])
+        if hist.count < POLL_LEARN_MIN_SAMPLES: return None
+        return hist.quantile(POLL_LEARN_QUANTILE)
+
+    def intervals(self):
+        typical = self.typical()
+        if typical is not None and typical > self.first: yield typical
+        yield from PollPolicy.intervals(self)
+
+
+POLL_DEFAULT       = PollPolicy("default", 0.001, 0.1)
+POLL_FIRE_LINK     = LearnedPolicy("fire_link", 0.001, 0.05)        # OMI link training (Fire host status)
+POLL_EXP_DOORBELL  = LearnedPolicy("exp_doorbell", 0.01, 1.0)       # Explorer firmware command response
+POLL_EXP_BOOT      = LearnedPolicy("exp_boot", 0.1, 6.0)            # Explorer firmware boot (reg 02 ready)
+POLL_EXP_BUSY      = PollPolicy("exp_busy", 0.0005, 0.01)           # Explorer reg 02 status busy
+POLL_FW_READY      = PollPolicy("fw_ready", 0.005, 0.05)            # firmware update: burst handled
+POLL_FW_COMMIT     = LearnedPolicy("fw_commit", 0.5, 2.0)           # firmware update: image committed
+POLL_EEPROM_WRITE  = PollPolicy("eeprom_write", 0.001, 0.005)       # EEPROM internal write cycle
+
+
+"""
+    Read until (read_fn() & mask) == value.
+    deadline is the time (s) after which we give up, None to wait forever.
+    Returns (True, last value read), or (False, last value read) on timeout.
+    The wait is a span of the timeline, named after the policy.
+"""
+def wait_until(read_fn, mask, value, deadline=None, policy=POLL_DEFAULT):
+    with span("wait " + policy.name, "wait"):
+        start = monotonic()
+        end = None if deadline is None else start + deadline
+        reads = 1
+        val = read_fn()
+        intervals = policy.intervals()
+        while (val & mask) != value:
+            now = monotonic()
+            if end is not None and now >= end:
+                record_wait(policy.name, now - start, reads, timeout=True)
+                return False, val
+            interval = next(intervals)
+            if end is not None: interval = min(interval, end - now)
+            sleep(interval)
+            val = read_fn()
+            reads += 1
+        record_wait(policy.name, monotonic() - start, reads)
+        return True, val
@@ -0,0 +1,170 @@
+#
+# Copyright 2019 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+from array import array
+from constants import *
+
+OP_READ  = 0
+OP_WRITE = 1
+
+MASK_ALL  = 0xFFFFFFFFFFFFFFFF
+MASK_NONE = 0x0
+
+##################################################################################
+#   A register sequence in array-backed form: one opcode, one 64 bits address,  #
+#   one value and one mask per step. For a read, value is the expected content  #
+#   and mask selects the bits to check (0 = no expectation). For a write, value #
+#   is the data and mask the bits checked by the verify read.                    #
+#                                                                                #
+#   Step tables of Fire and Fbist are flat tuples:                               #
+#       (name, 'R'/'W', addr, value, comment, 'R'/'W', addr, value, comment ...) #
+#   compile_steps() turns one into a RegSequence for a port, addresses being     #
+#   relocated from port A to the selected port. The result is cached, so a table #
+#   is only compiled once per port.                                              #
+##################################################################################
+class RegSequence:
+    def __init__(self, name=""):
+        self.name   = name
+        self.ops    = array('B')
+        self.addrs  = array('Q')
+        self.values = array('Q')
+        self.masks  = array('Q')
+        self.labels = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def append(self, op, reg_addr, value, mask, label=""):
+        self.ops.append(op)
+        self.addrs.append(reg_addr)
+        self.values.append(value)
+        self.masks.append(mask)
+        self.labels.append(label)
+
+    def extend(self, seq):
+        self.ops.extend(seq.ops)
+        self.addrs.extend(seq.addrs)
+        self.values.extend(seq.values)
+        self.masks.extend(seq.masks)
+        self.labels.extend(seq.labels)
+
+    def steps(self):
+        """ Iterate over (op, reg_addr, value, mask, label) """
+        return zip(self.ops, self.addrs, self.values, self.masks, self.labels)
+
+
+compiled_sequences = {}
+
+def compile_steps(reg_list, _ddimm="a"):
+    """ Compile a flat step table for the given port (a or b) """
+    key = (reg_list, _ddimm)
+    seq = compiled_sequences.get(key)
+    if seq is not None: return seq
+
+    if _ddimm not in FIRE_DDIMM_ADDR_ADJ:
+        print("ERROR: incorrect ddimm selection !!")
+        return None
+    ddimm_add_adj = FIRE_DDIMM_ADDR_ADJ[_ddimm]
+    side_effects = side_effect_regs()
+
+    seq = RegSequence(reg_list[0])
+    for i in range(1, len(reg_list), 4):
+        """ Address is computed with port, based on port0 address """
+        reg = reg_list[i+1] + ddimm_add_adj
+        value = reg_list[i+2]
+        if reg_list[i] == 'R':
+            # a string (eg 'XXXXXXXXXXXXXXXXX') means there is no expectation on the read
+            if type(value) == str: seq.append(OP_READ, reg, 0, MASK_NONE, reg_list[i+3])
+            else:                  seq.append(OP_READ, reg, value, MASK_ALL, reg_list[i+3])
+        elif reg in side_effects:
+            # a doorbell (write 1 to set/clear) or a self clearing register does not read back what was written
+            seq.append(OP_WRITE, reg, value, MASK_NONE, reg_list[i+3])
+        else:
+            seq.append(OP_WRITE, reg, value, MASK_ALL, reg_list[i+3])
+
+    compiled_sequences[key] = seq
+    return seq
+
+
+##################################################################################
+#   Diff-apply of a sequence: given the current content of the registers it     #
+#   writes, keep only the writes that change the hardware state.                 #
+#   Accesses to side effect registers (doorbells) and to volatile ones are      #
+#   always kept, as are reads of registers the sequence does not write. Reads   #
+#   of written registers are dropped: their content, known from the bulk read   #
+#   or the write, is checked instead.                                            #
+##################################################################################
+class DiffReport:
+    def __init__(self, name):
+        self.name = name
+        self.applied = []       # addresses of the writes kept
+        self.skipped = []       # addresses of the writes not needed
+        self.dropped_reads = 0
+        self.mismatches = []    # (step, address, expected, known content, label) of the dropped reads that fail
+
+    def __str__(self):
+        return "{}: {} writes applied, {} skipped (already set), {} reads dropped, {} mismatching".format(
+            self.name, len(self.applied), len(self.skipped), self.dropped_reads, len(self.mismatches))
+
+
+def side_effect_regs():
+    regs = set()
+    for adj in FIRE_DDIMM_ADDR_ADJ.values():
+        for reg in FIRE_EXP_SIDE_EFFECT_REGS: regs.add(reg + adj)
+    return regs
+
+def write_targets(seq, is_volatile=None):
+    """ Addresses written by a sequence that are worth reading before a diff-apply.
+        Side effect registers and volatile ones (is_volatile(address) true) are always written. """
+    always = side_effect_regs()
+    targets = []
+    for op, reg_addr, value, mask, label in seq.steps():
+        if op != OP_WRITE or reg_addr in always or reg_addr in targets: continue
+        if is_volatile is not None and is_volatile(reg_addr): continue
+        targets.append(reg_addr)
+    return targets
+
+def diff_sequence(seq, current, is_volatile=None):
+    """ current maps each address of write_targets(seq, is_volatile) to its content.
+        A read of a known register is checked against the prefetched (or just written) content
+        instead of being issued. Returns (sequence to run, DiffReport) """
+    always = side_effect_regs()
+    state = dict(current)
+    out = RegSequence(seq.name)
+    report = DiffReport(seq.name)
+    for step, (op, reg_addr, value, mask, label) in enumerate(seq.steps()):
+        if reg_addr in always or (is_volatile is not None and is_volatile(reg_addr)):
+            out.append(op, reg_addr, value, mask, label)
+            if op == OP_WRITE: report.applied.append(reg_addr)
+        elif op == OP_READ:
+            if reg_addr not in state:
+                out.append(op, reg_addr, value, mask, label)
+                continue
+            report.dropped_reads += 1
+            if (state[reg_addr] & mask) != (value & mask):
+                report.mismatches.append((step, reg_addr, value, state[reg_addr], label))
+        elif state.get(reg_addr) == value:
+            report.skipped.append(reg_addr)
+        else:
+            out.append(op, reg_addr, value, mask, label)
+            report.applied.append(reg_addr)
+            state[reg_addr] = value
+    return out, report
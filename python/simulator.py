@@ -0,0 +1,597 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import os
+import errno
+import pickle
+import ctypes
+import logging
+from time import sleep
+
+from constants import *
+from components import use_bus_factory
+
+##################################################################################
+#   Simulated FMC+ board, in process.                                            #
+#   SimBus implements the SMBus calls the drivers use (i2c_rdwr, read_byte,     #
+#   write_quick, read_i2c_block_data, write_i2c_block_data) over a SimBoard:    #
+#                                                                                #
+#       Fire 0x38 ---- MUX 0x73 --ch0--> MUX 0x71 --ch0--> DDIMM a              #
+#                                                  --ch1--> DDIMM b              #
+#                                                                                #
+#   A DDIMM port holds either a DDIMM (EEPROM 0x50, PMICs 0x4f/0x67, Explorer   #
+#   0x20 powered by both PMICs) or a Gemini card (ICE 0x20, power controller    #
+#   0x64, clock generator 0x7c). Devices behind a mux answer only when the mux  #
+#   path is open, a mux setting applies at the end of the transfer (STOP), and  #
+#   an absent device NAKs (OSError EREMOTEIO) as on the real bus.               #
+#                                                                                #
+#   Once the link is up, the Explorer configuration space and registers are      #
+#   reached through the Fire windows. They hold what was written, the reset      #
+#   content and the firmware answers of the board the step tables were           #
+#   recorded on, so the bring-up (initpath, init, sync, ddimmcfg) runs clean.    #
+#                                                                                #
+#   Everything is deterministic: the delays of the hardware (Explorer boot,     #
+#   SerDes init, link training, firmware commands) are counted in polls of the  #
+#   register that reports them, not in seconds. The time a transfer would take  #
+#   at the bus frequency is added to bus_time (and slept if realtime is set).   #
+#                                                                                #
+#       simulator.install(cards={'a': SimDdimm(vendor="SMART", size=32)})        #
+#       fire = Fire(3)      # the pool now opens SimBus instead of SMBus         #
+##################################################################################
+
+I2C_M_RD = 0x0001
+
+SIM_BUS_FREQ     = 100000   # Hz, 100 kHz by default as the CRONUS -busspeed100 logs
+SIM_XFER_OVERHEAD = 0.00005 # s of driver/ioctl overhead per transfer
+SIM_FIRE_ID      = 0x2e29c7d2 & 0x0fffffff
+SIM_EXP_API      = 0x1B     # firmware API version in Explorer register 0x2
+SIM_ICE_ID       = 0x2e29c7d200000001
+
+# delays, in polls of the status register concerned
+SIM_BOOT_POLLS   = 3        # Explorer register 0x2 not ready after power on / reset
+SIM_SERDES_POLLS = 2        # Explorer register 0x2 busy after the SerDes init command
+SIM_TRAIN_POLLS  = 1        # training status (either side) before the link is up: the sequences sleep during training
+SIM_FW_POLLS     = 2        # outbound doorbell before a firmware command completes
+SIM_FW_INIT_POLLS = 1       # same for the DDR init commands of the step tables (steps25_a11 reads the doorbell set)
+
+# Explorer words (32 bits, address without the 0xA0000000 I2C offset)
+SIM_EXP_INBOUND_DOORBELL_SET   = 0x08084730
+SIM_EXP_INBOUND_DOORBELL_CLEAR = 0x08084738
+SIM_EXP_OUTBOUND_DOORBELL      = 0x00002058
+SIM_EXP_RSP_BUFFER             = 0x0103FF00     # 64 bytes firmware response, followed by
+SIM_EXP_CMD_BUFFER             = 0x0103FF40     # the 64 bytes command buffer
+SIM_EXP_DL0_STATUS             = 0x08094098     # SCOM 0x08012813: training status
+SIM_FW_COMMIT_OK               = 0x4c00         # response of a successful commit (firmware_update.py)
+SIM_EXP_PHY_COMMAND            = 0x0808C528     # SCOM 0x080118A5: reads 0, the command shows in
+SIM_EXP_PHY_STATUS             = 0x0808C530     # SCOM 0x080118A6 from its second read on (steps_26b0/b2)
+
+# Firmware responses to the DDR init commands (header word of the command buffer) of the
+# reference board the step tables were recorded on: response buffer offset -> 32 bits word
+SIM_FW_RESPONSES = {0x42430102: {0x04: 0x42430002, 0x38: 0x27941C5A},
+                    0x42440102: {0x00: 0x00000210, 0x04: 0x42440102, 0x0C: 0x335730B2, 0x38: 0x17E088B3}}
+
+# Reset content of the Explorer registers the step tables read before writing them (values
+# of the reference board): 64 bits SCOM registers by SCOM address, 32 bits ones by address
+SIM_EXP_SCOM_RESET = {0x0801140C: 0x18B0056072A315AC, 0x0801140D: 0xC448C44894A4CC30, 0x0801140E: 0x8810B5B4002CC480,
+                      0x0801140F: 0x79FFE0001BF7FD50, 0x08011410: 0xFC00084000000052, 0x08011415: 0x0000148082002B0C,
+                      0x08011416: 0x11635F11635F0500, 0x08011417: 0x4848121284842121, 0x08011418: 0x0000000000002000,
+                      0x08011419: 0x0010100010080000, 0x0801141A: 0x0400000000000000, 0x08011434: 0x0330C00230300D68,
+                      0x08011436: 0x0148400202102D00, 0x08011437: 0x0084C21000000001, 0x08011438: 0x4210000000000000,
+                      0x080118A7: 0x00FFFF0000001000, 0x08011C2D: 0x0813FE3800F00000}
+SIM_EXP_REG32_RESET = {0x0408016C: 0x00007429, 0x04340000: 0x00000001}
+
+# OpenCAPI configuration space of the Explorer (32 bits registers, by offset): reset values
+SIM_EXP_CONFIG_RESET = {0x00000: 0x06361014,        # device 0x0636, vendor 0x1014 (IBM)
+                        0x0021c: 0x00000493,
+                        0x10004: 0x00100000,
+                        0x10514: 0x80000000,
+                        0x10518: 0x00000001}
+
+def scom_word(reg_addr):
+    """ Word address of the MSBs of a 64 bits SCOM register (bit 27 set) """
+    return ((reg_addr & ~(1 << 27)) << 3) | (1 << 27)
+
+def exp_reset_words():
+    """ Reset content of the Explorer words that are not 0 """
+    words = dict(SIM_EXP_REG32_RESET)
+    for reg_addr, value in SIM_EXP_SCOM_RESET.items():
+        words[scom_word(reg_addr)] = value >> 32
+        words[scom_word(reg_addr) + 4] = value & 0xffffffff
+    return words
+
+
+class SimDevice:
+    """ A device answering on one I2C address """
+    i2c_addr = None
+
+    def write(self, data):
+        pass
+
+    def read(self, length):
+        return bytes(length)
+
+    def stop(self):
+        """ End of the transfer (STOP condition) """
+        pass
+
+
+class SimMux(SimDevice):
+    def __init__(self, i2c_addr):
+        self.i2c_addr = i2c_addr
+        self.value = 0
+        self.pending = None
+
+    def write(self, data):
+        if data: self.pending = data[-1]
+
+    def read(self, length):
+        return bytes([self.value] * length)
+
+    def stop(self):
+        if self.pending is not None: self.value, self.pending = self.pending, None
+
+
+class SimPmic(SimDevice):
+    def __init__(self, i2c_addr):
+        self.i2c_addr = i2c_addr
+        self.regs = bytearray(256)
+        self.pointer = 0
+
+    def write(self, data):
+        if not data: return
+        self.pointer = data[0]
+        for i, byte in enumerate(data[1:]): self.regs[(self.pointer + i) & 0xff] = byte
+
+    def read(self, length):
+        res = bytes(self.regs[(self.pointer + i) & 0xff] for i in range(length))
+        self.pointer = (self.pointer + length) & 0xff
+        return res
+
+    def powered(self):
+        return self.regs[0x32] == 0x80
+
+
+class SimEeprom(SimDevice):
+    i2c_addr = EEPROM_I2C_ADDR
+
+    def __init__(self, vendor="MICRON", size=64):
+        self.mem = bytearray(1024)
+        self.pointer = 0
+        self.mem[0x4] = 0x85 if size == 32 else 0x86
+        self.mem[0x1] = 0x4 if vendor == "SMART" else 0x9
+        self.mem[512:514] = {"MICRON": b"\x80\x2c", "SAMSUNG": b"\x80\xce", "SMART": b"\x01\x94"}.get(vendor, b"\xff\xff")
+
+    def write(self, data):
+        if len(data) < 2: return
+        self.pointer = ((data[0] << 8) | data[1]) % len(self.mem)
+        for i, byte in enumerate(data[2:]): self.mem[(self.pointer + i) % len(self.mem)] = byte
+
+    def read(self, length):
+        res = bytes(self.mem[(self.pointer + i) % len(self.mem)] for i in range(length))
+        self.pointer = (self.pointer + length) % len(self.mem)
+        return res
+
+
+class SimOcmb(SimDevice):
+    """
+        Explorer (or ICE) I2C command protocol. Frames: command, length, payload
+            0x01 04 <boot config>        0x0100008090+b SerDes init, 0x0100008190+b DL training start
+            0x03 04 <address>            address of the next read
+            0x04 04 <address>            read: the data is returned by the next read of the device
+            0x05 08 <address> <data>     write of a 32 bits word
+        A 1 byte write selects the register to read (0x2: status). The status is
+        0x00 <API> <busy/error> <last command>, its MSB is not 0 while the firmware boots.
+        """
+    i2c_addr = EXP_I2C_ADDR
+    reset_words = exp_reset_words() # words read before written are not 0 after reset
+
+    def __init__(self, port):
+        self.port = port            # SimPort, for the OMI link
+        self.words = {}             # 32 bits words written, address without the 0xA0000000 offset
+        self.out = b""              # bytes waiting to be read
+        self.pending = None         # data of the last 0x04 command
+        self.last_cmd = 0
+        self.boot_polls = SIM_BOOT_POLLS
+        self.busy_polls = 0
+        self.fw_polls = None        # firmware command in progress
+        self.dl_started = False
+        self.config = dict(SIM_EXP_CONFIG_RESET)    # configuration space, offset -> 32 bits value
+        self.phy_pending = 0        # PHY commands not shown in the PHY status yet
+
+    def reset(self):
+        self.__init__(self.port)
+
+    def status(self):
+        booting = 0
+        if self.boot_polls > 0: self.boot_polls -= 1; booting = 0xff
+        busy = 0
+        if self.busy_polls > 0: self.busy_polls -= 1; busy = 0x01
+        return (booting << 24) | (SIM_EXP_API << 16) | (busy << 8) | self.last_cmd
+
+    def write(self, data):
+        if len(data) == 1:
+            # register selection: the data of a 0x04 command is returned once, the status then
+            if self.pending is not None: value, self.pending = self.pending, None
+            else: value = self.status() if data[0] == 0x2 else 0
+            self.out = bytes([0x04]) + value.to_bytes(4, 'big')
+            return
+        if len(data) < 2: return
+        cmd, payload = data[0], int.from_bytes(data[2:], 'big')
+        self.last_cmd = cmd
+        if cmd == 0x01:
+            config = payload & 0xffffff00
+            if config == 0x00008000: self.busy_polls = SIM_SERDES_POLLS
+            elif config == 0x00008100: self.dl_started = True
+        elif cmd == 0x04:
+            self.pending = self.read_word((payload - EXP_ADDR_OFFSET) & 0xffffffff)
+        elif cmd == 0x05:
+            self.write_word(((payload >> 32) - EXP_ADDR_OFFSET) & 0xffffffff, payload & 0xffffffff)
+
+    def read(self, length):
+        if not self.out:
+            # read without register selection (ICE): data of the last 0x04 command or status
+            if self.pending is not None: value, self.pending = self.pending, None
+            else: value = self.status()
+            self.out = bytes([0x04]) + value.to_bytes(4, 'big')
+        res, self.out = self.out[:length], self.out[length:]
+        return res + bytes(length - len(res))
+
+    def read_word(self, word):
+        if word == SIM_EXP_OUTBOUND_DOORBELL and self.fw_polls is not None:
+            self.fw_polls -= 1
+            if self.fw_polls <= 0: self.fw_complete()
+        if word in (SIM_EXP_DL0_STATUS, SIM_EXP_DL0_STATUS + 4):
+            status = EXP_TRAINING_DONE if self.port.poll_training() else 0
+            return (status >> 32) if word == SIM_EXP_DL0_STATUS else (status & 0xffffffff)
+        if word == SIM_EXP_PHY_STATUS:
+            # the status read still returns the previous state, the commands show from the next one
+            status = self.word(word)
+            self.words[word], self.phy_pending = status | self.phy_pending, 0
+            return status
+        return self.word(word)
+
+    def word(self, word):
+        return self.words.get(word, self.reset_words.get(word, 0))
+
+    def write_word(self, word, data):
+        if word == SIM_EXP_OUTBOUND_DOORBELL:
+            self.words[word] = self.word(word) & ~data      # write 1 to clear
+            return
+        if word == SIM_EXP_PHY_COMMAND: self.phy_pending |= data
+        if word in (SIM_EXP_PHY_COMMAND, SIM_EXP_PHY_COMMAND + 4): return      # self clearing
+        self.words[word] = data
+        if word == SIM_EXP_INBOUND_DOORBELL_SET and data & 0x80000000:
+            header = self.word(SIM_EXP_CMD_BUFFER + 4)
+            self.fw_polls = SIM_FW_INIT_POLLS if header in SIM_FW_RESPONSES else SIM_FW_POLLS
+
+    def fw_complete(self):
+        """ The firmware answers the command of the command buffer """
+        self.fw_polls = None
+        command = self.word(SIM_EXP_CMD_BUFFER)
+        header = self.word(SIM_EXP_CMD_BUFFER + 4)
+        for word in range(SIM_EXP_RSP_BUFFER, SIM_EXP_CMD_BUFFER, 4): self.words[word] = 0
+        # status word of the response: 0 (success), or the commit result checked by firmware_update.py
+        if (command & 0xffff) == 0x0008: self.words[SIM_EXP_RSP_BUFFER + 0x20] = SIM_FW_COMMIT_OK
+        for offset, value in SIM_FW_RESPONSES.get(header, {}).items(): self.words[SIM_EXP_RSP_BUFFER + offset] = value
+        self.words[SIM_EXP_OUTBOUND_DOORBELL] = 1
+
+    def mmio_read(self, word, size):
+        if size == 4: return self.read_word(word)
+        return (self.read_word(word) << 32) | self.read_word(word + 4)
+
+    def mmio_write(self, word, data, size):
+        if size == 4: self.write_word(word, data & 0xffffffff)
+        else:
+            self.write_word(word, data >> 32)
+            self.write_word(word + 4, data & 0xffffffff)
+
+
+class SimIce(SimOcmb):
+    """ ICE: same protocol, no boot nor firmware, trains with the Fire alone """
+    reset_words = {}
+
+    def __init__(self, port):
+        SimOcmb.__init__(self, port)
+        self.boot_polls = 0
+        self.dl_started = True
+        self.words[scom_word(ICE_ID_NUM_REG)] = SIM_ICE_ID >> 32
+        self.words[scom_word(ICE_ID_NUM_REG) + 4] = SIM_ICE_ID & 0xffffffff
+
+
+class SimCard:
+    """ What is plugged in a port, its devices are built by the port """
+    def devices(self, port):
+        return {}
+
+
+class SimDdimm(SimCard):
+    def __init__(self, vendor="MICRON", size=64):
+        self.vendor = vendor
+        self.size = size
+
+    def devices(self, port):
+        port.ocmb = SimOcmb(port)
+        return {EEPROM_I2C_ADDR: SimEeprom(self.vendor, self.size), PMIC1_I2C_ADDR: SimPmic(PMIC1_I2C_ADDR),
+                PMIC2_I2C_ADDR: SimPmic(PMIC2_I2C_ADDR), EXP_I2C_ADDR: port.ocmb}
+
+
+class SimGemini(SimCard):
+    def devices(self, port):
+        port.ocmb = SimIce(port)
+        dev = SimPmic(POWER_CTRL_I2C_ADDR)
+        clk = SimPmic(GEM_CLK_GEN_ADDR)
+        return {POWER_CTRL_I2C_ADDR: dev, GEM_CLK_GEN_ADDR: clk, ICE_I2C_ADDR: port.ocmb}
+
+
+class SimPort:
+    """ A DDIMM port: the card devices and the OMI link state seen by the Fire """
+    def __init__(self, name, card):
+        self.name = name
+        self.card = card
+        self.ocmb = None
+        self.devices = card.devices(self) if card is not None else {}
+        self.in_reset = False
+        self.host_trained = False       # Fire side training started
+        self.train_polls = SIM_TRAIN_POLLS
+        self.up = False
+
+    def visible(self, i2c_addr):
+        dev = self.devices.get(i2c_addr)
+        if dev is None: return None
+        if isinstance(dev, SimOcmb) and not isinstance(dev, SimIce):
+            # Explorer powered by both PMICs, held by the Fire reset
+            if self.in_reset or not all(self.devices[a].powered() for a in (PMIC1_I2C_ADDR, PMIC2_I2C_ADDR)):
+                if dev.boot_polls != SIM_BOOT_POLLS or dev.words: dev.reset()
+                return None
+        return dev
+
+    def link_up(self):
+        return self.up
+
+    def poll_training(self):
+        """ A training status is read (on either side): the training goes on, True once the link is up """
+        if not self.up and self.host_trained and self.ocmb is not None and self.ocmb.dl_started and not self.in_reset:
+            self.train_polls -= 1
+            if self.train_polls <= 0: self.up = True
+        return self.up
+
+    def host_status(self):
+        """ Fire host conf status: bit 3 link up, bits 2:0 training state machine """
+        if self.poll_training(): return 0xF
+        return 0x1 if self.host_trained else 0x0
+
+    def start_training(self):
+        self.host_trained = True
+        self.up = False
+        self.train_polls = SIM_TRAIN_POLLS
+
+    def set_reset(self, in_reset):
+        if in_reset and not self.in_reset:
+            self.host_trained = self.up = False
+            if self.ocmb is not None: self.ocmb.reset()
+        self.in_reset = in_reset
+
+
+class SimFire(SimDevice):
+    """
+        Fire FIFO protocol: an 8 bytes write gives the address to read, the 8 bytes of
+        the register are then read (in one or several reads). A 16 bytes write is an
+        address and the data to write. Explorer registers are reached through the
+        MMIO windows when the OMI link of the port is up.
+        """
+    i2c_addr = FIRE_I2C_ADDR
+    RESET_BITS = {'a': FIRE_FML_DDIMMA_RESET_BIT, 'b': FIRE_FML_DDIMMB_RESET_BIT}
+    PORT_ADDR = {'a': FIRE_DDIMMA_HOST_CONF_BASE_ADDR, 'b': FIRE_DDIMMB_HOST_CONF_BASE_ADDR}
+
+    def __init__(self, board, freq=333):
+        self.board = board
+        self.fifo = b""
+        freq_def = {333: 0b001, 366: 0b010, 400: 0b011}.get(freq, 0b001)
+        self.regs = {FIRE_FML_FIRE_VERSION_REG: (freq_def << 29) | SIM_FIRE_ID,
+                     FIRE_FML_RESET_CONTROL_REG: 0x1F}      # every DDIMM out of reset
+
+    def write(self, data):
+        if len(data) >= 8: reg_addr = int.from_bytes(data[0:8], 'big')
+        if len(data) == 8: self.fifo = self.reg_read(reg_addr).to_bytes(8, 'big')
+        elif len(data) == 16: self.reg_write(reg_addr, int.from_bytes(data[8:16], 'big'))
+
+    def read(self, length):
+        res, self.fifo = self.fifo[:length], self.fifo[length:]
+        return res + bytes(length - len(res))
+
+    def config_space(self, reg_addr):
+        """ (port, offset) of an address of the OpenCAPI configuration space window, None if not one """
+        hi = reg_addr >> 32
+        if hi & ~0x400 == 0x20010000: return ('b' if hi & 0x400 else 'a'), reg_addr & 0xffffffff
+        return None
+
+    def mmio(self, reg_addr):
+        """ (port, Explorer word, size) of an address of the MMIO windows, None if not one """
+        hi, lo = reg_addr >> 32, reg_addr & 0xffffffff
+        port = 'b' if hi & 0x400 else 'a'
+        if hi & ~0x400 == 0x20010001: return port, lo, 4
+        if hi & ~0x400 == 0x30010001:
+            if lo >= 0x40000000: return port, (lo - 0x40000000) | (1 << 27), 8
+            return port, lo, 8
+        return None
+
+    def reg_read(self, reg_addr):
+        config = self.config_space(reg_addr)
+        if config is not None:
+            port = self.board.ports.get(config[0])
+            if port is None or not port.link_up(): return 0xdec0de00
+            return port.ocmb.config.get(config[1], 0)
+        window = self.mmio(reg_addr)
+        if window is not None:
+            port = self.board.ports.get(window[0])
+            if port is None or not port.link_up(): return 0xdec0de00
+            return port.ocmb.mmio_read(window[1], window[2])
+        if reg_addr >> 56 != 0x01: return I2C_REG_NOT_FOUND_READ_ERROR
+        if reg_addr == FIRE_FML_DDMIMM_DETECT_REG:
+            return sum(FIRE_FML_DDIMM_DETECT_BITS[name] for name, port in self.board.ports.items() if port.card is not None)
+        for name, base in self.PORT_ADDR.items():
+            if reg_addr == base + 0x20 and name in self.board.ports: return self.board.ports[name].host_status()
+        return self.regs.get(reg_addr, 0)
+
+    def reg_write(self, reg_addr, data):
+        config = self.config_space(reg_addr)
+        if config is not None:
+            port = self.board.ports.get(config[0])
+            if port is not None and port.link_up(): port.ocmb.config[config[1]] = data & 0xffffffff
+            return
+        window = self.mmio(reg_addr)
+        if window is not None:
+            port = self.board.ports.get(window[0])
+            if port is not None and port.link_up(): port.ocmb.mmio_write(window[1], data, window[2])
+            return
+        if reg_addr >> 56 != 0x01: return
+        self.regs[reg_addr] = data
+        if reg_addr == FIRE_FML_RESET_CONTROL_REG:
+            for name, bit in self.RESET_BITS.items():
+                if name in self.board.ports: self.board.ports[name].set_reset(not data & bit)
+        for name, base in self.PORT_ADDR.items():
+            if reg_addr == base + 0x10 and name in self.board.ports:
+                port = self.board.ports[name]
+                if data == 0x0000000004080045 or data & (1 << 24): port.start_training()
+
+
+class SimBoard:
+    """ Devices of one I2C bus """
+    def __init__(self, cards=None, fire_freq=333):
+        if cards is None: cards = {'a': SimDdimm()}
+        self.ports = {name: SimPort(name, cards.get(name)) for name in "ab"}
+        self.fire = SimFire(self, fire_freq)
+        self.mux2 = SimMux(MUX2_I2C_ADDR)
+        self.mux3 = SimMux(MUX3_I2C_ADDR)
+        self.transfers = 0
+        self.bus_time = 0.0     # s the transfers would have taken on the bus
+
+    def device(self, i2c_addr):
+        """ Device answering on an address with the current mux settings, None if none """
+        if i2c_addr == FIRE_I2C_ADDR: return self.fire
+        if i2c_addr == MUX2_I2C_ADDR: return self.mux2
+        if not self.mux2.value & 0x1: return None
+        if i2c_addr == MUX3_I2C_ADDR: return self.mux3
+        found = None
+        for name, channel in (('a', DDIMMA), ('b', DDIMMB)):
+            if self.mux3.value & (1 << channel):
+                dev = self.ports[name].visible(i2c_addr)
+                if dev is not None:
+                    if found is not None: return None      # two devices answering: garbage on the bus
+                    found = dev
+        return found
+
+    def stop(self):
+        for mux in (self.mux2, self.mux3): mux.stop()
+
+
+boards = {}     # bus number -> SimBoard, kept when the bus is closed and reopened
+
+
+class SimBus:
+    """ smbus2.SMBus stand-in on a SimBoard """
+    def __init__(self, i2c_bus_num, board=None, freq=SIM_BUS_FREQ, overhead=SIM_XFER_OVERHEAD, realtime=False):
+        if board is None: board = boards.setdefault(i2c_bus_num, SimBoard())
+        self.i2c_bus_num = i2c_bus_num
+        self.board = board
+        self.freq = freq
+        self.overhead = overhead
+        self.realtime = realtime
+
+    def account(self, lengths):
+        """ lengths: bytes of each message, the address byte not included """
+        bits = sum(9 * (1 + length) + 1 for length in lengths) + 1    # bytes + ACKs, (re)starts and stop
+        duration = self.overhead + bits / self.freq
+        self.board.transfers += 1
+        self.board.bus_time += duration
+        if self.realtime: sleep(duration)
+
+    def device(self, i2c_addr):
+        dev = self.board.device(i2c_addr)
+        if dev is None:
+            self.board.stop()
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        return dev
+
+    def i2c_rdwr(self, *msgs):
+        self.account([msg.len for msg in msgs])
+        for msg in msgs:
+            dev = self.device(msg.addr)
+            if msg.flags & I2C_M_RD:
+                ctypes.memmove(msg.buf, dev.read(msg.len), msg.len)
+            else:
+                dev.write(ctypes.string_at(msg.buf, msg.len))
+        self.board.stop()
+
+    def read_byte(self, i2c_addr, force=None):
+        self.account([1])
+        res = self.device(i2c_addr).read(1)[0]
+        self.board.stop()
+        return res
+
+    def write_quick(self, i2c_addr, force=None):
+        self.account([0])
+        self.device(i2c_addr)
+        self.board.stop()
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        self.account([1, length])
+        dev = self.device(i2c_addr)
+        dev.write(bytes([register]))
+        res = list(dev.read(length))
+        self.board.stop()
+        return res
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self.account([1 + len(data)])
+        self.device(i2c_addr).write(bytes([register] + list(data)))
+        self.board.stop()
+
+    def close(self):
+        pass
+
+
+def install(cards=None, fire_freq=333, freq=SIM_BUS_FREQ, overhead=SIM_XFER_OVERHEAD, realtime=False):
+    """ Open SimBus (on new boards with these cards) instead of SMBus from now on """
+    boards.clear()
+    def factory(i2c_bus_num):
+        board = boards.get(i2c_bus_num)
+        if board is None: board = boards[i2c_bus_num] = SimBoard(cards, fire_freq)
+        return SimBus(i2c_bus_num, board, freq, overhead, realtime)
+    use_bus_factory(factory)
+    logging.info("I2C buses are simulated ({} Hz)".format(freq))
+
+def bus_time():
+    """ Time the transfers would have taken on the bus, per simulated bus """
+    return {i2c_bus_num: board.bus_time for i2c_bus_num, board in boards.items()}
+
+def save_state(path):
+    """ Keep the simulated boards (DDIMMs powered, trained...) for the next run """
+    with open(path, "wb") as f:
+        pickle.dump(boards, f)
+
+def load_state(path):
+    try:
+        with open(path, "rb") as f:
+            boards.update(pickle.load(f))
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
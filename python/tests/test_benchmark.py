@@ -0,0 +1,59 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+
+import pytest
+
+import ddimm_plan
+import metrics
+import timeline
+from benchmark import *
+
+
+@pytest.fixture
+def measured(tmp_path, monkeypatch):
+    monkeypatch.setattr(ddimm_plan, "PLAN_CACHE_DIR", str(tmp_path))
+    timeline.fast_forward()
+    metrics.enable()
+    yield
+    metrics.disable()
+
+
+def test_compare_tolerance():
+    base = {"transfers": 100, "messages": 200, "written": 10, "read": 10, "bus_time": 1.0}
+    res = dict(base, transfers=105, messages=211)
+    regressions = compare("case", res, base, 5.0)
+    assert len(regressions) == 1 and regressions[0].startswith("case: messages 200 -> 211")
+    assert compare("case", res, None, 5.0) == []
+
+def test_run_reports_exit_codes():
+    def fails(): exit(1)
+    def passes(): exit(0)
+    assert run(fails) == "exit(1)"
+    assert run(passes) is None
+
+def test_bringup_cases_exit_0(measured):
+    for case in bench_cases():
+        if case.name.startswith("ddimmcfg") or case.name == "fbistcfg":
+            res = run_case(case)
+            assert "error" not in res, (case.name, res.get("error"))
+            assert res["transfers"] > 0
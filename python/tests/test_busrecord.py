@@ -0,0 +1,74 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import pytest
+
+from busrecord import *
+
+POLL = bytes([0x20, 0x02, 1])     # REC_READ_BLOCK requests: address, register, length
+OTHER = bytes([0x20, 0x04, 1])
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """ A poll answered 0, 0 then 1, another request, and the poll again """
+    recorder = BusRecorder()
+    for request, response in ((POLL, b"\x00"), (POLL, b"\x00"), (POLL, b"\x01"), (OTHER, b"\x0a"), (POLL, b"\x05")):
+        recorder.add(3, REC_READ_BLOCK, request, response)
+    recorder.add(3, REC_WRITE_QUICK, b"\x50", err=errno.EREMOTEIO)
+    path = str(tmp_path / "test.rec")
+    recorder.save(path)
+    return BusRecording.load(path)
+
+def replay(recording, requests):
+    return [recording.answer(3, REC_READ_BLOCK, request)[1] for request in requests]
+
+
+def test_load(recording):
+    assert recording.count == 6
+    assert recording.record(3)[4:] == (OTHER, b"\x0a")
+    assert recording.find(3, REC_READ_BLOCK, POLL) == [0, 1, 2, 4]
+    assert recording.find(4, REC_READ_BLOCK, POLL) == []
+
+def test_answer_in_recorded_order(recording):
+    assert replay(recording, [POLL, POLL, POLL, OTHER, POLL]) == [b"\x00", b"\x00", b"\x01", b"\x0a", b"\x05"]
+
+def test_answer_longer_poll(recording):
+    # the poll lasts longer than recorded: the last answer is repeated, the rest follows
+    assert replay(recording, [POLL, POLL, POLL, POLL, OTHER, POLL]) == [b"\x00", b"\x00", b"\x01", b"\x01", b"\x0a", b"\x05"]
+
+def test_answer_shorter_poll(recording):
+    # the poll ends sooner: the next request resumes after its recorded occurrence
+    assert replay(recording, [POLL, OTHER, POLL]) == [b"\x00", b"\x0a", b"\x05"]
+
+def test_answer_after_last_occurrence(recording):
+    assert replay(recording, [POLL, POLL, POLL, OTHER, POLL, POLL, OTHER]) == \
+        [b"\x00", b"\x00", b"\x01", b"\x0a", b"\x05", b"\x05", b"\x0a"]
+
+def test_answer_error_and_unknown(recording):
+    assert recording.answer(3, REC_WRITE_QUICK, b"\x50") == (errno.EREMOTEIO, b"")
+    assert recording.answer(3, REC_READ_BLOCK, bytes([0x21, 0x02, 1])) is None
+
+def test_load_not_a_recording(tmp_path):
+    path = tmp_path / "bad.rec"
+    path.write_bytes(b"not a recording")
+    assert BusRecording.load(str(path)) is None
@@ -0,0 +1,108 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+from constants import *
+from regseq import *
+from cronus import *
+
+SCOM_REG = 0x08012813       # 64 bits SCOM register, words 0x08094098 and 0x0809409C
+SCOM_REG2 = 0x08012811      # words 0x08094088 and 0x0809408C
+
+
+def put(data):
+    return "PUTI2C    : sio:k0:n0:s0:p00      : E: 6|P:30|A:0x20|S:100|O:0x000|OS:0x0    " + data
+
+def get_word(word, value):
+    """ CRONUS lines of the 0x04 read of an Explorer word """
+    return [put("0304{:08X}".format(word + EXP_ADDR_OFFSET)),
+            "GETI2C    : sio:k0:n0:s0:p00      : E: 6|P:30|A:0x20|S:100|O:0x002|OS:0x1",
+            "GETI2C    : sio:k0:n0:s0:p00      : COMPLETE             04001B0003",
+            "GETI2C    : sio:k0:n0:s0:p00      : E: 6|P:30|A:0x20|S:100|O:0x404{:08X}|OS:0x6".format(word + EXP_ADDR_OFFSET),
+            "GETI2C    : sio:k0:n0:s0:p00      : COMPLETE             04{:08X}".format(value)]
+
+def read_scom(reg_addr, value):
+    word = ((reg_addr & ~EXP_SCOM_BIT) << 3) | EXP_SCOM_BIT
+    return get_word(word, value >> 32) + get_word(word + 4, value & 0xFFFFFFFF)
+
+def write_scom(reg_addr, value):
+    word = ((reg_addr & ~EXP_SCOM_BIT) << 3) | EXP_SCOM_BIT
+    return [put("0508{:08X}{:08X}".format(word + EXP_ADDR_OFFSET, value >> 32)),
+            put("0508{:08X}{:08X}".format(word + 4 + EXP_ADDR_OFFSET, value & 0xFFFFFFFF))]
+
+
+def test_parse_pairs_words():
+    stats = ImportStats()
+    ops = parse_log(read_scom(SCOM_REG, 0x0000008000000000) + write_scom(SCOM_REG2, 0x0000040000000059), stats)
+    assert ops == [(OP_READ, SCOM_REG, 0x0000008000000000, MASK_ALL), (OP_WRITE, SCOM_REG2, 0x0000040000000059, MASK_ALL)]
+    assert stats.status_reads == 2
+
+def test_parse_double_read_expansion():
+    lines = ["i2c_double_read   : explorer:k0:n0:s0:p00 : 08012813"] + read_scom(SCOM_REG, 0x123) + \
+            ["i2c_double_read   : explorer:k0:n0:s0:p00 : COMPLETE             0000008000000000"]
+    # the expansion is skipped, the result is the one of the COMPLETE line
+    assert parse_log(lines) == [(OP_READ, SCOM_REG, 0x0000008000000000, MASK_ALL)]
+
+def test_parse_frames_and_unsupported():
+    stats = ImportStats()
+    lines = [put("0100008090"), "PUTI2C    : sio:k0:n0:s0:p00      : E: 6|P:30|A:0x50|S:100|O:0x000|OS:0x0    0102", "garbage"]
+    assert parse_log(lines, stats) == [(OP_FRAME, 0x0100008090, 0, MASK_NONE)]
+    assert stats.unsupported == 1 and stats.lines == 3
+
+def test_parse_lone_half_write_is_a_frame():
+    word = ((SCOM_REG & ~EXP_SCOM_BIT) << 3) | EXP_SCOM_BIT
+    ops = parse_log([put("0508{:08X}{:08X}".format(word + EXP_ADDR_OFFSET, 0x80))])
+    assert ops == [(OP_FRAME, 0x0508A000000000000000 + (word << 32) + 0x80, 0, MASK_NONE)]
+
+
+def test_optimize_drops_repeated_and_verify_reads():
+    stats = ImportStats()
+    ops = [(OP_WRITE, SCOM_REG2, 0x59, MASK_ALL), (OP_READ, SCOM_REG2, 0x59, MASK_ALL),
+           (OP_READ, SCOM_REG, 0x1, MASK_ALL), (OP_WRITE, SCOM_REG2, 0x60, MASK_ALL), (OP_READ, SCOM_REG, 0x1, MASK_ALL)]
+    assert optimize(ops, stats) == [ops[0], ops[2], ops[3]]
+    assert stats.verify_reads == 1 and stats.repeated_reads == 1
+
+def test_optimize_drops_repeated_writes():
+    stats = ImportStats()
+    ops = [(OP_WRITE, SCOM_REG2, 0x59, MASK_ALL), (OP_WRITE, SCOM_REG2, 0x59, MASK_ALL), (OP_WRITE, SCOM_REG2, 0x5a, MASK_ALL)]
+    assert optimize(ops, stats) == [ops[0], ops[2]]
+    assert stats.repeated_writes == 1
+
+def test_optimize_poll_becomes_wait():
+    stats = ImportStats()
+    ops = [(OP_READ, SCOM_REG, 0x0, MASK_ALL)] * 3 + [(OP_READ, SCOM_REG, 0x80, MASK_ALL), (OP_READ, SCOM_REG, 0x80, MASK_ALL)]
+    assert optimize(ops, stats) == [(OP_WAIT, SCOM_REG, 0x80, MASK_ALL)]
+    assert stats.polls == 5 and stats.repeated_reads == 0
+
+def test_optimize_frame_and_doorbell_forget_known_values():
+    doorbell = FIRE_EXP_OUTBOUND_DOORBELL - FIRE_EXP_MMIO_REG32_BASE
+    read = (OP_READ, SCOM_REG, 0x1, MASK_ALL)
+    ops = [read, (OP_FRAME, 0x0100008090, 0, MASK_NONE), read, (OP_WRITE, doorbell, 0x1, MASK_ALL), read]
+    assert optimize(ops) == ops
+
+
+def test_import_log_steps():
+    lines = read_scom(SCOM_REG, 0x1) + [put("0100008090")] + write_scom(SCOM_REG2, 0x59) + read_scom(SCOM_REG2, 0x59)
+    recipe = import_log(lines, "test")
+    assert [type(step) for step in recipe.steps] == [RegSequence, CronusFrame, RegSequence]
+    assert len(recipe) == 3
+    assert list(recipe.steps[2].addrs) == [SCOM_REG2]
+    assert recipe.steps[1].frame == 0x0100008090
@@ -0,0 +1,110 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+from constants import *
+from regseq import *
+
+DOORBELL = FIRE_EXP_OUTBOUND_DOORBELL
+VOLATILE = 0x2001000000000210
+
+
+def volatile(reg_addr):
+    return reg_addr == VOLATILE
+
+def sequence(*steps):
+    seq = RegSequence("test")
+    for op, reg_addr, value in steps: seq.append(op, reg_addr, value, MASK_ALL, "{:#x}".format(reg_addr))
+    return seq
+
+
+def test_compile_steps_ops_and_masks():
+    table = ("test_compile_ops", 'W', 0x0100000000000010, 0x5, "write",
+                                 'R', 0x0100000000000018, 0x7, "read",
+                                 'R', 0x0100000000000020, "XXXXXXXX", "no expectation")
+    seq = compile_steps(table, "a")
+    assert len(seq) == 3
+    assert list(seq.ops) == [OP_WRITE, OP_READ, OP_READ]
+    assert list(seq.addrs) == [0x0100000000000010, 0x0100000000000018, 0x0100000000000020]
+    assert list(seq.values) == [0x5, 0x7, 0x0]
+    assert list(seq.masks) == [MASK_ALL, MASK_ALL, MASK_NONE]
+    assert seq.labels == ["write", "read", "no expectation"]
+
+def test_compile_steps_port_b_and_cache():
+    table = ("test_compile_port", 'W', 0x0100000000000010, 0x5, "")
+    seq_b = compile_steps(table, "b")
+    assert seq_b.addrs[0] == 0x0100000000000010 + FIRE_DDIMM_ADDR_ADJ["b"]
+    assert compile_steps(table, "b") is seq_b
+    assert compile_steps(table, "a") is not seq_b
+
+def test_compile_steps_side_effect_writes_not_checked():
+    table = ("test_compile_side_effects", 'W', FIRE_EXP_OUTBOUND_DOORBELL, 0x1, "",
+                                          'W', FIRE_EXP_PHY_COMMAND_REG, 0x4000000000000000, "")
+    seq = compile_steps(table, "b")
+    assert list(seq.masks) == [MASK_NONE, MASK_NONE]
+    assert set(seq.addrs) <= side_effect_regs()
+
+def test_compile_steps_bad_port():
+    assert compile_steps(("test_compile_bad", 'W', 0x10, 0x5, ""), "z") is None
+
+def test_compile_steps_doorbell_not_compared():
+    seq = compile_steps(("test_compile_doorbell", 'W', DOORBELL, 0x1, "doorbell"), "a")
+    assert seq.masks[0] == MASK_NONE
+
+
+def test_diff_skips_writes_already_set():
+    seq = sequence((OP_WRITE, 0x100, 0x7), (OP_WRITE, 0x108, 0x1))
+    assert write_targets(seq) == [0x100, 0x108]
+    out, report = diff_sequence(seq, {0x100: 0x7, 0x108: 0x0})
+    assert list(out.addrs) == [0x108]
+    assert report.skipped == [0x100]
+    assert report.applied == [0x108]
+
+def test_diff_checks_dropped_reads():
+    # 0x100 reads back 0x5 in the table, while it holds (and is written) 0x7
+    seq = sequence((OP_WRITE, 0x100, 0x7), (OP_READ, 0x100, 0x5), (OP_READ, 0x200, 0xdead))
+    out, report = diff_sequence(seq, {0x100: 0x7})
+    assert report.dropped_reads == 1
+    assert report.mismatches == [(1, 0x100, 0x5, 0x7, "0x100")]
+    # 0x200 is not known: its read is issued
+    assert list(out.ops) == [OP_READ] and list(out.addrs) == [0x200]
+
+def test_diff_checks_reads_against_written_value():
+    seq = sequence((OP_WRITE, 0x100, 0x9), (OP_READ, 0x100, 0x9))
+    out, report = diff_sequence(seq, {0x100: 0x7})
+    assert list(out.addrs) == [0x100] and out.ops[0] == OP_WRITE
+    assert report.dropped_reads == 1
+    assert report.mismatches == []
+
+def test_diff_masked_read():
+    seq = RegSequence("test")
+    seq.append(OP_WRITE, 0x100, 0xff, MASK_ALL)
+    seq.append(OP_READ, 0x100, 0x0f, 0x0f)
+    out, report = diff_sequence(seq, {0x100: 0xff})
+    assert len(out) == 0 and report.mismatches == []
+
+def test_diff_keeps_volatile_and_doorbell_accesses():
+    seq = sequence((OP_WRITE, VOLATILE, 0x3), (OP_READ, VOLATILE, 0x3), (OP_WRITE, DOORBELL, 0x1))
+    assert write_targets(seq, volatile) == []
+    out, report = diff_sequence(seq, {}, volatile)
+    assert list(out.addrs) == [VOLATILE, VOLATILE, DOORBELL]
+    assert report.applied == [VOLATILE, DOORBELL]
+    assert report.skipped == [] and report.dropped_reads == 0
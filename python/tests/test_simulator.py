@@ -0,0 +1,115 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+
+import pytest
+
+from constants import *
+import ddimm_plan
+import simulator
+from regseq import *
+import timeline
+import omi
+from simulator import *
+
+
+@pytest.fixture
+def board():
+    """ DDIMMs on both ports, the link of port A up """
+    board = SimBoard({'a': SimDdimm(), 'b': SimDdimm()})
+    board.ports['a'].up = True
+    return board
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    """ Simulated buses, no sleep and a plan cache of its own """
+    monkeypatch.setattr(ddimm_plan, "PLAN_CACHE_DIR", str(tmp_path))
+    timeline.fast_forward()
+
+def run(*args):
+    try:
+        omi.main.main(args=list(args), prog_name="omi.py", standalone_mode=False)
+    except SystemExit as err:
+        return err.code or 0
+    return 0
+
+
+def test_config_space(board):
+    fire = board.fire
+    assert fire.reg_read(0x2001000000000000) == 0x06361014
+    fire.reg_write(0x2001000000000224, 0x221)
+    assert fire.reg_read(0x2001000000000224) == 0x221
+    # port B has its own configuration space, unreachable while its link is down
+    assert fire.reg_read(0x2001040000000224) == 0xdec0de00
+    board.ports['b'].up = True
+    assert fire.reg_read(0x2001040000000224) == 0
+
+def test_reset_values(board):
+    ocmb = board.ports['a'].ocmb
+    assert ocmb.mmio_read(scom_word(0x08011438), 8) == 0x4210000000000000
+    ocmb.mmio_write(scom_word(0x08011438), 0x5, 8)
+    assert ocmb.mmio_read(scom_word(0x08011438), 8) == 0x5
+    ocmb.reset()
+    assert ocmb.mmio_read(scom_word(0x08011438), 8) == 0x4210000000000000
+
+def test_ddr_init_response(board):
+    ocmb = board.ports['a'].ocmb
+    ocmb.write_word(SIM_EXP_CMD_BUFFER + 4, 0x42430102)
+    ocmb.write_word(SIM_EXP_INBOUND_DOORBELL_SET, 0x80000000)
+    assert ocmb.read_word(SIM_EXP_OUTBOUND_DOORBELL) == 1
+    assert ocmb.mmio_read(SIM_EXP_RSP_BUFFER, 8) == 0x0000000042430002
+    assert ocmb.mmio_read(SIM_EXP_RSP_BUFFER + 0x38, 8) == 0x27941C5A00000000
+
+def test_phy_command(board):
+    ocmb = board.ports['a'].ocmb
+    ocmb.mmio_write(SIM_EXP_PHY_COMMAND, 0x4000000000000000, 8)
+    assert ocmb.mmio_read(SIM_EXP_PHY_COMMAND, 8) == 0
+    assert ocmb.mmio_read(SIM_EXP_PHY_STATUS, 8) == 0
+    ocmb.mmio_write(SIM_EXP_PHY_COMMAND, 0x8000000000000000, 8)
+    assert ocmb.mmio_read(SIM_EXP_PHY_STATUS, 8) == 0x4000000000000000
+
+@pytest.mark.parametrize("vendor", ["MICRON", "SMART"])
+@pytest.mark.parametrize("size", [32, 64])
+@pytest.mark.parametrize("port", ["a", "b"])
+def test_bringup_runs_clean(bench, capsys, vendor, size, port):
+    simulator.install({port: SimDdimm(vendor, size)})
+    for args in (["initpath", "-d", port], ["init"], ["sync", "-d", port, "--no-retrain"], ["ddimmcfg", "-d", port]):
+        assert run(*args) == 0, args
+    assert "WARNING" not in capsys.readouterr().out
+
+def test_second_diff_run_skips_window_writes(bench, capsys):
+    simulator.install({'a': SimDdimm("MICRON", 64)})
+    for args in (["initpath", "-d", "a"], ["init"], ["sync", "-d", "a", "--no-retrain"], ["ddimmcfg", "-d", "a"]):
+        assert run(*args) == 0, args
+    capsys.readouterr()
+    run("ddimmcfg", "-d", "a", "--diff")
+    line = [l for l in capsys.readouterr().out.splitlines() if l.startswith("Diff-apply")][0]
+    applied, skipped = [int(word) for word in line.split() if word.isdigit()]
+
+    # written again: the side effect registers, and the ones the plan sets to several values
+    writes, values = [], {}
+    for seg in ddimm_plan.get_plan("MICRON", 64, "a").segments:
+        for op, reg_addr, value, mask, label in seg.steps():
+            if op == OP_WRITE: writes.append(reg_addr); values.setdefault(reg_addr, set()).add(value)
+    needed = [reg for reg in writes if reg in side_effect_regs() or len(values[reg]) > 1]
+    assert applied + skipped == len(writes)
+    assert applied <= len(needed) and skipped >= len(writes) - len(needed)
@@ -0,0 +1,288 @@
+#
+# Copyright 2022 International Business Machines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# The patent license granted to you in Section 3 of the License, as applied
+# to the "Work," hereby includes implementations of the Work in physical form.
+#
+# Unless required by applicable law or agreed to in writing, the reference design
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The background Specification upon which this is based is managed by and available from
+# the OpenCAPI Consortium.  More information can be found at https://opencapi.org.
+#
+
+
+import sys
+import json
+import time
+import threading
+from functools import wraps
+from time import perf_counter
+
+from constants import *
+from functions import bus_pool
+
+##################################################################################
+#   Timeline of the bring-up stages.                                             #
+#   A span times a stage (omi.py command, PMIC power-up, Explorer boot, SerDes   #
+#   init, training, a reg_ops table, a polling wait, ...). Spans nest: a span   #
+#   opened while another one runs in the same thread is its child. Each span    #
+#   carries the number of I2C transactions issued and the time spent sleeping   #
+#   while it was open (its children included).                                   #
+#   The timeline is saved as a Chrome trace-event JSON file, to be opened in    #
+#   chrome://tracing or https://ui.perfetto.dev                                  #
+#                                                                                #
+#   While disabled, span() and @spanned do nothing but test a flag, and the     #
+#   driver methods and the buses are not wrapped.                               #
+#                                                                                #
+#       timeline.enable(); ...; timeline.save("bringup.json")                   #
+##################################################################################
+
+# class name -> (method, span name, label function of the call arguments or None)
+TIMELINE_METHODS = {
+    "Fire":      (("reg_ops", "reg_ops", lambda reg_list, *a, **k: reg_list[0]),
+                  ("sync", "Fire OMI training", None), ("check_sync", "Fire check_sync", None),
+                  ("retrain", "Fire retrain", None), ("set_ddimm_on_reset", "DDIMM on reset", None),
+                  ("set_ddimm_off_reset", "DDIMM off reset", None)),
+    "Explorer":  (("init", "Explorer init", None), ("sync", "Explorer OMI training", None),
+                  ("check_sync", "Explorer check_sync", None), ("get_firmware_info", "Explorer firmware info", None)),
+    "DdimmPlan": (("run", "ddimm plan", None),),
+    "Fbist":     (("fbist", "fbist", None),),
+    "Eeprom":    (("get_info", "EEPROM info", None),),
+}
+# modules whose sleep() is accounted to the spans
+TIMELINE_SLEEPERS = ("fire", "explorer", "ice", "components", "fbist", "firmware_update", "omi", "polling", "__main__")
+
+
+class Timeline:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()      # per thread: stack of the open spans, transactions, sleep time
+        self.events = []                    # closed spans: (name, cat, thread, start, end, transactions, sleep, args)
+        self.threads = {}                   # thread ident -> name
+        self.t0 = perf_counter()
+
+    def counters(self):
+        local = self.local
+        if not hasattr(local, "stack"):
+            local.stack = []
+            local.transactions = 0
+            local.sleep = 0.0
+            with self.lock: self.threads[threading.get_ident()] = threading.current_thread().name
+        return local
+
+    def begin(self, name, cat, args):
+        local = self.counters()
+        frame = (name, cat, args, perf_counter(), local.transactions, local.sleep)
+        local.stack.append(frame)
+        return frame
+
+    def end(self, frame):
+        local = self.counters()
+        if frame in local.stack: local.stack.remove(frame)
+        name, cat, args, start, transactions, sleep = frame
+        with self.lock:
+            self.events.append((name, cat, threading.get_ident(), start, perf_counter(),
+                                local.transactions - transactions, local.sleep - sleep, args))
+
+    def close_open_spans(self):
+        """ End the spans still open in this thread (eg when leaving with exit()) """
+        local = self.counters()
+        while local.stack: self.end(local.stack[-1])
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.t0 = perf_counter()
+
+    def chrome_events(self):
+        pid = 1
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        out = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+               for tid, name in threads.items()]
+        for name, cat, tid, start, end, transactions, sleep, args in sorted(events, key=lambda e: (e[3], -e[4])):
+            span_args = {"transactions": transactions, "sleep_ms": round(sleep * 1000, 3)}
+            if args: span_args.update(args)
+            out.append({"name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                        "ts": round((start - self.t0) * 1e6, 1), "dur": round((end - start) * 1e6, 1), "args": span_args})
+        return out
+
+    def save(self, path):
+        """ Write the spans in the Chrome trace-event format """
+        self.close_open_spans()
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.chrome_events(), "displayTimeUnit": "ms"}, f)
+
+
+timeline = Timeline()
+enabled = False
+
+
+class span:
+    """
+        with span("SerDes init", port="a"): ...
+        Times the block when the timeline is enabled, keyword arguments are added to the span args.
+        """
+    __slots__ = ("name", "cat", "args", "frame")
+
+    def __init__(self, name, cat="stage", **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.frame = None
+
+    def __enter__(self):
+        if enabled: self.frame = timeline.begin(self.name, self.cat, self.args)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.frame is not None:
+            timeline.end(self.frame)
+            self.frame = None
+
+
+def spanned(name, cat="stage"):
+    """ Decorator: the calls of the function are spans of the timeline """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled: return fn(*args, **kwargs)
+            frame = timeline.begin(name, cat, None)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timeline.end(frame)
+        return wrapper
+    return decorator
+
+
+class CountingBus:
+    """ Counts the I2C transactions of the calling thread """
+    def __init__(self, bus, i2c_bus_num):
+        self.bus = bus
+        self.i2c_bus_num = i2c_bus_num
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def i2c_rdwr(self, *msgs):
+        timeline.counters().transactions += 1
+        return self.bus.i2c_rdwr(*msgs)
+
+    def read_byte(self, *args):
+        timeline.counters().transactions += 1
+        return self.bus.read_byte(*args)
+
+    def write_quick(self, *args):
+        timeline.counters().transactions += 1
+        return self.bus.write_quick(*args)
+
+    def read_i2c_block_data(self, *args):
+        timeline.counters().transactions += 1
+        return self.bus.read_i2c_block_data(*args)
+
+    def write_i2c_block_data(self, *args):
+        timeline.counters().transactions += 1
+        return self.bus.write_i2c_block_data(*args)
+
+
+def timed_sleep(seconds):
+    start = perf_counter()
+    time.sleep(seconds)
+    timeline.counters().sleep += perf_counter() - start
+
+timed_methods = {}   # (class, method) -> wrapper installed by timed_method()
+
+def timed_method(cls, method, name, label):
+    def wrapper(self, *args, **kwargs):
+        args_label = None if label is None else label(*args, **kwargs)
+        frame = timeline.begin(name if args_label is None else "{} {}".format(name, args_label), "driver", None)
+        try:
+            # looked up on each call, so that untimed_method() can splice this wrapper out of a chain
+            return wrapper.__wrapped__(self, *args, **kwargs)
+        finally:
+            timeline.end(frame)
+    wrapper.__wrapped__ = getattr(cls, method)
+    timed_methods[(cls, method)] = wrapper
+    setattr(cls, method, wrapper)
+
+def untimed_method(cls, method):
+    """ Remove our wrapper, even when another layer (metrics) wrapped the method after us """
+    wrapper = timed_methods.pop((cls, method))
+    outer = getattr(cls, method)
+    if outer is wrapper:
+        setattr(cls, method, wrapper.__wrapped__)
+        return
+    while getattr(outer, "__wrapped__", None) is not wrapper:
+        outer = outer.__wrapped__
+    outer.__wrapped__ = wrapper.__wrapped__
+
+def driver_classes():
+    # imported here, the drivers themselves import this module for their spans
+    from fire import Fire
+    from explorer import Explorer
+    from components import Eeprom
+    from fbist import Fbist
+    from ddimm_plan import DdimmPlan
+    classes = {cls.__name__: cls for cls in (Fire, Explorer, Eeprom, Fbist, DdimmPlan)}
+    return [(classes[name], methods) for name, methods in TIMELINE_METHODS.items()]
+
+def enable():
+    """ Start recording spans (wraps the buses, the driver stages and the sleeps) """
+    global enabled
+    if enabled: return
+    enabled = True
+    timeline.reset()
+    bus_pool.add_wrapper(CountingBus)
+    for cls, methods in driver_classes():
+        for method, name, label in methods: timed_method(cls, method, name, label)
+    for module in TIMELINE_SLEEPERS:
+        module = sys.modules.get(module)
+        if module is not None and getattr(module, "sleep", None) is time.sleep: module.sleep = timed_sleep
+
+def disable():
+    """ Stop recording, the spans recorded so far are kept """
+    global enabled
+    if not enabled: return
+    enabled = False
+    bus_pool.remove_wrapper(CountingBus)
+    for cls, methods in driver_classes():
+        for method, name, label in methods: untimed_method(cls, method)
+    for module in TIMELINE_SLEEPERS:
+        module = sys.modules.get(module)
+        if module is not None and getattr(module, "sleep", None) is timed_sleep: module.sleep = time.sleep
+
+def save(path):
+    timeline.save(path)
+
+
+skipped = 0.0       # s of sleep skipped since fast_forward()
+
+def skipped_sleep(seconds):
+    """ sleep() of fast_forward(): the time is only accounted """
+    global skipped
+    skipped += seconds
+    if enabled: timeline.counters().sleep += seconds
+
+def virtual_monotonic():
+    """ Clock of the polling deadlines in fast_forward(), the skipped sleeps included """
+    return time.monotonic() + skipped
+
+def fast_forward():
+    """ Skip the sleeps from now on, for buses which do not need the time to pass (simulated, replayed).
+        The polling loops still give up after the same number of reads, their deadlines run on virtual_monotonic() """
+    for module in TIMELINE_SLEEPERS:
+        module = sys.modules.get(module)
+        if module is None: continue
+        if getattr(module, "sleep", None) in (time.sleep, timed_sleep): module.sleep = skipped_sleep
+        if getattr(module, "monotonic", None) is time.monotonic: module.monotonic = virtual_monotonic